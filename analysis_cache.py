@@ -0,0 +1,80 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+import storage
+
+DB_NAME = "analyses.db"
+TTL_SECONDS = float(os.getenv("ANALYSIS_CACHE_TTL_HOURS", "168")) * 3600
+MAX_CACHE_BYTES = int(os.getenv("ANALYSIS_CACHE_MAX_MB", "50")) * 1024 * 1024
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS analyses (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    result TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_analyses_access ON analyses (last_access);
+"""
+
+_lock = threading.Lock()
+
+
+def _conn():
+    return storage.connect(DB_NAME, _SCHEMA)
+
+
+def request_key(request):
+    # Hash da requisição completa (prompt de sistema, mensagem, modelo,
+    # temperature, max_tokens): qualquer mudança gera outra chave
+    payload = json.dumps(request, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def get(key):
+    with _lock:
+        conn = _conn()
+        row = conn.execute(
+            "SELECT result, created_at FROM analyses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        if time.time() - row["created_at"] > TTL_SECONDS:
+            conn.execute("DELETE FROM analyses WHERE key = ?", (key,))
+            conn.commit()
+            return None
+        conn.execute("UPDATE analyses SET last_access = ? WHERE key = ?", (time.time(), key))
+        conn.commit()
+    return json.loads(row["result"])
+
+
+def put(key, model, result):
+    data = json.dumps(result, ensure_ascii=False)
+    now = time.time()
+    with _lock:
+        conn = _conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO analyses (key, model, result, size, created_at, last_access) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (key, model, data, len(data.encode("utf-8")), now, now),
+        )
+        conn.commit()
+        _evict(conn)
+
+
+def _evict(conn):
+    conn.execute("DELETE FROM analyses WHERE created_at < ?", (time.time() - TTL_SECONDS,))
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM analyses").fetchone()[0]
+    if total > MAX_CACHE_BYTES:
+        rows = conn.execute("SELECT key, size FROM analyses ORDER BY last_access ASC").fetchall()
+        for row in rows:
+            if total <= MAX_CACHE_BYTES:
+                break
+            conn.execute("DELETE FROM analyses WHERE key = ?", (row["key"],))
+            total -= row["size"]
+    conn.commit()
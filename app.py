@@ -1,6 +1,5 @@
 import streamlit as st
 import os
-import tempfile
 import warnings
 
 from helpers import (
@@ -8,6 +7,7 @@ from helpers import (
     validate_api_credentials,
     validate_claude_key,
     run_async_in_thread,
+    iter_async_in_thread,
 )
 from telegram_ops import (
     get_session_name,
@@ -15,17 +15,81 @@ from telegram_ops import (
     send_code,
     sign_in,
     sign_in_password,
-    fetch_messages,
+    iter_message_batches,
+    fetch_many,
 )
-from claude_analysis import CLAUDE_MODELS, analyze_with_claude
-from media_processing import extract_video_urls, process_all_media
-from data_preparation import prepare_analysis_input, get_media_summary
+from claude_analysis import CLAUDE_MODELS
+from media_processing import extract_video_urls
+from data_preparation import prepare_analysis_windows, get_media_summary
+from multi_chat import parse_chat_list, analyze_chats
+from transcription import (
+    CPU_COUNT,
+    WHISPER_SETTINGS,
+    cache_settings,
+    configure as configure_whisper,
+    max_concurrent_transcriptions,
+    warm_up as warm_up_whisper,
+)
+import link_index
+import media_cache
+import transcript_cache
+import jobs
 import dashboard
 
 warnings.filterwarnings("ignore", category=RuntimeWarning)
 
 st.set_page_config(page_title="Telegram Group Analyze MVP", layout="wide")
 
+
+@st.cache_resource
+def _startup():
+    # Uma vez por processo do servidor: começa a carregar o modelo Whisper,
+    # limpa downloads órfãos de execuções anteriores e retoma jobs
+    # interrompidos por um restart
+    warm_up_whisper()
+    media_cache.cleanup_workspaces()
+    jobs.resume_interrupted()
+    return True
+
+
+_startup()
+
+
+def _start_job(key, kind, params, secrets=None):
+    # O job roda fora do script do Streamlit; o id fica na sessão e na URL,
+    # assim um refresh do navegador reencontra o job em andamento
+    job_id = jobs.submit(kind, params, secrets)
+    st.session_state[key] = job_id
+    st.query_params[key] = job_id
+
+
+def _current_job(key):
+    if key not in st.session_state and key in st.query_params:
+        st.session_state[key] = st.query_params[key]
+    job_id = st.session_state.get(key)
+    return jobs.get(job_id) if job_id else None
+
+
+def _finish_job(key):
+    st.session_state.pop(key, None)
+    if key in st.query_params:
+        del st.query_params[key]
+
+
+@st.fragment(run_every=1)
+def _job_progress(job_id):
+    job = jobs.get(job_id)
+    if job is None or job["status"] not in jobs.ACTIVE:
+        st.rerun()
+    st.progress(job["current"] / job["total"] if job["total"] else 0)
+    st.text(f"[{job['current']}/{job['total']}] {job['message'] or 'Na fila...'}")
+    if job["kind"] == "analysis" and job["result"]:
+        dashboard.render_partial(job["result"])
+    if job["cancel_requested"]:
+        st.caption("Cancelando...")
+    elif st.button("⏹️ Cancelar", key=f"cancel_{job_id}"):
+        jobs.cancel(job_id)
+
 if "messages_data" not in st.session_state:
     st.session_state.messages_data = []
 if "media_files" not in st.session_state:
@@ -34,6 +98,8 @@ if "transcriptions" not in st.session_state:
     st.session_state.transcriptions = []
 if "analysis_results" not in st.session_state:
     st.session_state.analysis_results = None
+if "multi_results" not in st.session_state:
+    st.session_state.multi_results = None
 if "client_state" not in st.session_state:
     st.session_state.client_state = "disconnected"
 
@@ -66,6 +132,42 @@ with st.sidebar.expander("Anthropic Claude AI", expanded=True):
     if claude_key:
         st.caption("✅ API Key configurada")
 
+with st.sidebar.expander("Transcrição (Whisper)", expanded=False):
+    # A configuração é global do servidor: só muda quando alguém clica em
+    # Aplicar, não a cada rerun com os valores dos widgets de cada sessão
+    with st.form("whisper_settings"):
+        whisper_sizes = ["tiny", "base", "small", "medium", "large-v3"]
+        whisper_model_size = st.selectbox(
+            "Modelo",
+            whisper_sizes,
+            index=whisper_sizes.index(WHISPER_SETTINGS["model_size"])
+            if WHISPER_SETTINGS["model_size"] in whisper_sizes else 1,
+            help="Modelos maiores transcrevem melhor, mas são mais lentos.",
+        )
+        whisper_beam_size = st.number_input(
+            "Beam size", min_value=1, max_value=10, value=WHISPER_SETTINGS["beam_size"]
+        )
+        whisper_num_workers = st.number_input(
+            "Transcrições simultâneas", min_value=1, max_value=CPU_COUNT,
+            value=min(WHISPER_SETTINGS["num_workers"], CPU_COUNT),
+        )
+        whisper_cpu_threads = st.number_input(
+            "Threads por transcrição (0 = automático)", min_value=0, max_value=CPU_COUNT,
+            value=min(WHISPER_SETTINGS["cpu_threads"], CPU_COUNT),
+        )
+        if st.form_submit_button("Aplicar"):
+            configure_whisper(
+                model_size=whisper_model_size,
+                beam_size=int(whisper_beam_size),
+                num_workers=int(whisper_num_workers),
+                cpu_threads=int(whisper_cpu_threads),
+            )
+            st.success("Configuração aplicada para todas as sessões.")
+    st.caption(
+        f"Modelo compartilhado entre as sessões; até {max_concurrent_transcriptions()} "
+        f"transcrições ao mesmo tempo no servidor (as demais aguardam na fila)."
+    )
+
 st.title("🕵️ Analisador de Grupos Telegram MVP")
 
 if api_id and api_hash and phone:
@@ -141,43 +243,74 @@ if api_id and api_hash and phone:
 else:
     st.warning("Preencha as credenciais na barra lateral para começar.")
 
+multi_mode = False
 if st.session_state.client_state == "connected":
     st.divider()
+    multi_mode = st.checkbox("Analisar vários grupos de uma vez", key="multi_mode")
+
+if st.session_state.client_state == "connected" and not multi_mode:
     col1, col2 = st.columns([3, 1])
     with col1:
         target_chat = st.text_input(
             "Link ou Username do Grupo/Canal", placeholder="ex: https://t.me/pythonbrasil"
         )
     with col2:
-        msg_limit = st.number_input("Qtd. Mensagens", min_value=10, max_value=2000, value=100)
+        msg_limit = st.number_input("Qtd. Mensagens", min_value=10, value=100, step=100)
 
     # --- ETAPA 1: Baixar Mensagens ---
     if st.button("📥 Baixar Mensagens"):
         if not target_chat:
             st.error("Informe o grupo alvo!")
         else:
+            fetch_bar = st.progress(0)
+            fetch_text = st.empty()
+            download_text = st.empty()
+
+            def update_download_progress(done, total, message):
+                download_text.text(f"🎬 [{done}/{total}] {message}")
+
             with st.spinner("Baixando mensagens e mídias do Telegram..."):
                 try:
-                    media_tmp = tempfile.mkdtemp(prefix="tg_downloads_")
-                    msgs, media_files, err = run_async_in_thread(
-                        fetch_messages, session_name, api_id, api_hash,
-                        target_chat, msg_limit, media_tmp
-                    )
-                    if err:
-                        st.error(f"Erro ao baixar mensagens: {err}")
-                    else:
-                        st.session_state.messages_data = msgs
-                        st.session_state.media_files = media_files
-                        st.session_state.transcriptions = []
+                    msgs = []
+                    media_files = []
+                    video_urls = []
+                    seen_urls = set()
+                    for batch in iter_async_in_thread(
+                        iter_message_batches, session_name, api_id, api_hash,
+                        target_chat, msg_limit, True,
+                        audio_only=True,
+                        progress_callback=update_download_progress,
+                    ):
+                        msgs.extend(batch["messages"])
+                        media_files.extend(batch["media_files"])
+                        for item in extract_video_urls(batch["messages"]):
+                            if item["url"] not in seen_urls:
+                                seen_urls.add(item["url"])
+                                video_urls.append(item)
 
-                        video_urls = extract_video_urls(msgs)
-                        st.success(
-                            f"{len(msgs)} mensagens baixadas! "
-                            f"{len(media_files)} vídeos do chat + "
-                            f"{len(video_urls)} links de vídeo encontrados."
+                        fetch_bar.progress(min(batch["count"] / msg_limit, 1.0))
+                        fetch_text.text(
+                            f"{batch['count']} mensagens lidas — "
+                            f"{len(media_files)} vídeos e áudios do chat, "
+                            f"{len(video_urls)} links de vídeo até agora..."
                         )
+
+                    fetch_bar.empty()
+                    fetch_text.empty()
+                    download_text.empty()
+                    st.session_state.messages_data = msgs
+                    st.session_state.media_files = media_files
+                    st.session_state.transcriptions = []
+                    _finish_job("media_job")
+                    _finish_job("analysis_job")
+
+                    st.success(
+                        f"{len(msgs)} mensagens baixadas! "
+                        f"{len(media_files)} vídeos e áudios do chat + "
+                        f"{len(video_urls)} links de vídeo encontrados."
+                    )
                 except Exception as e:
-                    st.error(f"Erro crítico: {e}")
+                    st.error(f"Erro ao baixar mensagens: {e}")
 
     if st.session_state.get("messages_data"):
         msgs_count = len(st.session_state.messages_data)
@@ -192,42 +325,81 @@ if st.session_state.client_state == "connected":
             st.divider()
             st.subheader("🎬 Processamento de Mídias")
             st.caption(
-                f"{len(video_urls)} links de vídeo + {media_count} vídeos do chat = "
+                f"{len(video_urls)} links de vídeo + {media_count} vídeos e áudios do chat = "
                 f"{total_videos} vídeos para processar"
             )
+            link_keys = [v["cache_key"] for v in video_urls]
+            transcribed_links = transcript_cache.cached_keys(link_keys, *cache_settings())
+            failed_links = link_index.get_statuses(link_keys)
+            if transcribed_links:
+                st.caption(
+                    f"🔁 {len(transcribed_links)} links já transcritos com este modelo "
+                    f"vêm do cache, sem novo download."
+                )
+            if failed_links:
+                st.caption(
+                    f"⚠️ {len(failed_links)} links falharam recentemente e serão pulados "
+                    f"desta vez (tentados de novo mais tarde)."
+                )
+
+            budget_col1, budget_col2 = st.columns(2)
+            with budget_col1:
+                time_budget_min = st.number_input(
+                    "Orçamento de tempo (min, 0 = sem limite)", min_value=0, value=0,
+                    help="Estimado antes de baixar: prioriza vídeos recentes e curtos"
+                )
+            with budget_col2:
+                byte_budget_mb = st.number_input(
+                    "Orçamento de download (MB, 0 = sem limite)", min_value=0, value=0
+                )
 
             if st.button("🎙️ Processar Vídeos (Baixar + Transcrever)"):
-                progress_bar = st.progress(0)
-                status_text = st.empty()
+                _start_job("media_job", "media", {
+                    "messages": st.session_state.messages_data,
+                    "media_files": st.session_state.media_files,
+                    "time_budget": time_budget_min * 60 or None,
+                    "byte_budget": byte_budget_mb * 1024 * 1024 or None,
+                })
 
-                def update_progress(current, total, message):
-                    progress_bar.progress(current / total)
-                    status_text.text(f"[{current}/{total}] {message}")
+            media_job = _current_job("media_job")
+            if media_job and media_job["status"] in jobs.ACTIVE:
+                _job_progress(media_job["id"])
+            elif media_job:
+                _finish_job("media_job")
+                if media_job["status"] == jobs.DONE:
+                    result = media_job["result"]
+                    transcriptions = result["transcriptions"]
+                    st.session_state.transcriptions = transcriptions
 
-                with st.spinner("Processando vídeos..."):
-                    try:
-                        transcriptions = process_all_media(
-                            st.session_state.messages_data,
-                            st.session_state.media_files,
-                            progress_callback=update_progress,
+                    summary = get_media_summary(transcriptions)
+                    if summary:
+                        st.success(
+                            f"Transcrição concluída! "
+                            f"{summary['total_transcribed']} vídeos transcritos "
+                            f"({summary['from_links']} de links, "
+                            f"{summary['from_telegram']} do Telegram)."
                         )
-                        st.session_state.transcriptions = transcriptions
-                        progress_bar.progress(1.0)
-
-                        summary = get_media_summary(transcriptions)
-                        if summary:
-                            status_text.empty()
-                            st.success(
-                                f"Transcrição concluída! "
-                                f"{summary['total_transcribed']} vídeos transcritos "
-                                f"({summary['from_links']} de links, "
-                                f"{summary['from_telegram']} do Telegram)."
-                            )
-                        else:
-                            status_text.empty()
-                            st.warning("Nenhum vídeo pôde ser transcrito.")
-                    except Exception as e:
-                        st.error(f"Erro no processamento de mídias: {e}")
+                    else:
+                        st.warning("Nenhum vídeo pôde ser transcrito.")
+
+                    st.caption(
+                        f"♻️ Cache de transcrições: "
+                        f"{result['cache_hits']} reaproveitadas, "
+                        f"{result['cache_misses']} novas "
+                        f"({result['cache_entries']} no cache)."
+                    )
+                    audio_seconds = result["audio_seconds"]
+                    if audio_seconds > 0:
+                        processing_seconds = result["processing_seconds"]
+                        st.caption(
+                            f"⏱️ Whisper: {audio_seconds / 60:.1f} min de áudio em "
+                            f"{processing_seconds:.0f}s "
+                            f"(RTF {processing_seconds / audio_seconds:.2f})."
+                        )
+                elif media_job["status"] == jobs.CANCELLED:
+                    st.warning("Processamento de mídias cancelado.")
+                else:
+                    st.error(f"Erro no processamento de mídias: {media_job['error']}")
 
             if st.session_state.get("transcriptions"):
                 with st.expander("Ver transcrições", expanded=False):
@@ -238,36 +410,147 @@ if st.session_state.client_state == "connected":
 
         # --- ETAPA 3: Analisar com IA ---
         st.divider()
+        force_refresh = st.checkbox(
+            "🔄 Forçar nova análise",
+            value=False,
+            help="Ignora o resultado salvo de uma análise idêntica e chama o modelo de novo",
+        )
         if st.button("🤖 Analisar com IA"):
             claude_valid, claude_error = validate_claude_key(claude_key)
             if not claude_valid:
                 st.error(claude_error)
             else:
-                prepared_text = prepare_analysis_input(
+                windows = prepare_analysis_windows(
                     st.session_state.messages_data,
                     st.session_state.get("transcriptions", []),
+                    model=claude_model,
+                )
+                _start_job(
+                    "analysis_job",
+                    "analysis",
+                    {
+                        "messages": st.session_state.messages_data,
+                        "model": claude_model,
+                        "windows": windows,
+                        "refresh": force_refresh,
+                    },
+                    secrets={"api_key": claude_key},
+                )
+
+        analysis_job = _current_job("analysis_job")
+        if analysis_job and analysis_job["status"] in jobs.ACTIVE:
+            _job_progress(analysis_job["id"])
+        elif analysis_job:
+            _finish_job("analysis_job")
+            analysis = analysis_job["result"] or {}
+            if analysis_job["status"] == jobs.CANCELLED:
+                st.warning("Análise cancelada.")
+            elif analysis_job["status"] == jobs.FAILED:
+                st.error(f"Erro na análise: {analysis_job['error']}")
+            elif "error" in analysis:
+                st.error(f"Erro na análise: {analysis['error']}")
+            else:
+                st.session_state.analysis_results = analysis
+                model_used = analysis.get("_model_used", "desconhecido")
+                has_videos = len(st.session_state.get("transcriptions", [])) > 0
+                extra = " (com transcrições de vídeos)" if has_videos else ""
+                if analysis.get("_cached"):
+                    extra += " — resultado salvo, sem nova chamada"
+                if analysis.get("_windows", 1) > 1:
+                    extra += f" — {analysis['_windows']} partes combinadas"
+                st.success(
+                    f"✅ Análise concluída com sucesso usando o modelo "
+                    f"**{model_used}**!{extra}"
                 )
-                with st.spinner(f"Analisando com {claude_model}..."):
-                    status_box = st.empty()
-                    analysis = analyze_with_claude(
-                        st.session_state.messages_data,
-                        claude_key,
-                        claude_model,
-                        status_box,
-                        prepared_text=prepared_text,
+                if analysis.get("_failed_windows"):
+                    st.warning(
+                        f"⚠️ {analysis['_failed_windows']} partes do conteúdo não puderam "
+                        "ser analisadas e ficaram fora do resultado."
                     )
-                    if "error" in analysis:
-                        st.error(f"Erro na análise: {analysis['error']}")
-                    else:
-                        st.session_state.analysis_results = analysis
-                        status_box.empty()
-                        model_used = analysis.get("_model_used", "desconhecido")
-                        has_videos = len(st.session_state.get("transcriptions", [])) > 0
-                        extra = " (com transcrições de vídeos)" if has_videos else ""
-                        st.success(
-                            f"✅ Análise concluída com sucesso usando o modelo "
-                            f"**{model_used}**!{extra}"
-                        )
 
-if st.session_state.get("analysis_results"):
+if st.session_state.client_state == "connected" and multi_mode:
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        chats_text = st.text_area(
+            "Grupos/Canais (um por linha)",
+            placeholder="https://t.me/grupo1\n@grupo2",
+        )
+    with col2:
+        multi_limit = st.number_input(
+            "Qtd. Mensagens por grupo", min_value=10, value=100, step=100, key="multi_limit"
+        )
+        multi_process_media = st.checkbox("Transcrever vídeos", value=True)
+
+    if st.button("🚀 Baixar e Analisar Todos"):
+        chats = parse_chat_list(chats_text)
+        claude_valid, claude_error = validate_claude_key(claude_key)
+        if not chats:
+            st.error("Informe pelo menos um grupo!")
+        elif not claude_valid:
+            st.error(claude_error)
+        else:
+            progress_bar = st.progress(0)
+            status_text = st.empty()
+
+            def update_multi_progress(done, total, message):
+                if total:
+                    progress_bar.progress(done / total)
+                status_text.text(f"[{done}/{total}] {message}")
+
+            try:
+                with st.spinner(f"Baixando mensagens de {len(chats)} grupos..."):
+                    chat_data = run_async_in_thread(
+                        fetch_many, session_name, api_id, api_hash,
+                        chats, multi_limit, multi_process_media,
+                        audio_only=True,
+                        progress_callback=update_multi_progress,
+                    )
+                with st.spinner("Processando e analisando os grupos..."):
+                    analyses = analyze_chats(
+                        chat_data, claude_key, claude_model,
+                        process_media=multi_process_media,
+                        progress_callback=update_multi_progress,
+                    )
+                for chat, data in chat_data.items():
+                    data.update(analyses.get(chat, {}))
+                    analysis = data.get("analysis") or {}
+                    if not data["error"] and "error" in analysis:
+                        data["error"] = analysis["error"]
+
+                st.session_state.multi_results = chat_data
+                progress_bar.empty()
+                status_text.empty()
+                failed = [c for c, d in chat_data.items() if d["error"]]
+                st.success(f"{len(chat_data) - len(failed)} de {len(chat_data)} grupos analisados!")
+                for chat in failed:
+                    st.warning(f"{chat}: {chat_data[chat]['error']}")
+            except Exception as e:
+                st.error(f"Erro crítico: {e}")
+
+    multi_results = st.session_state.get("multi_results")
+    if multi_results:
+        st.dataframe(
+            [
+                {
+                    "Grupo": chat,
+                    "Mensagens": len(data["messages"]),
+                    "Mídias do chat": len(data["media_files"]),
+                    "Transcrições": len(data.get("transcriptions", [])),
+                    "Problemas": len((data.get("analysis") or {}).get("problemas_operacionais", [])),
+                    "Oportunidades": len((data.get("analysis") or {}).get("oportunidades_ia", [])),
+                    "Status": data["error"] or "✅",
+                }
+                for chat, data in multi_results.items()
+            ],
+            width="stretch",
+        )
+        analyzed = [c for c, d in multi_results.items() if not d["error"] and d.get("analysis")]
+        if analyzed:
+            selected_chat = st.selectbox("Ver dashboard do grupo", analyzed)
+            dashboard.render(
+                multi_results[selected_chat]["analysis"],
+                messages=multi_results[selected_chat]["messages"],
+            )
+
+if st.session_state.get("analysis_results") and not multi_mode:
     dashboard.render(st.session_state.analysis_results)
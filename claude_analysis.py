@@ -1,10 +1,40 @@
+import os
 import json
+import asyncio
 import logging
-from anthropic import Anthropic
+from anthropic import Anthropic, AsyncAnthropic
+
+import token_budget
+import analysis_cache
+from json_stream import ItemStream
+from helpers import run_async_in_thread
+from data_preparation import prepare_analysis_windows, split_window
 
 logger = logging.getLogger(__name__)
 
-MAX_PROMPT_CHARS = 12000
+# Chamadas simultâneas à API na análise em janelas (map-reduce)
+MAX_CONCURRENT_WINDOWS = int(os.getenv("ANALYSIS_MAX_CONCURRENCY", "4"))
+
+# Listas do resultado combinadas no map-reduce e o campo que identifica
+# um item repetido (None = o próprio item)
+MERGED_LISTS = {
+    "problemas_operacionais": "problema",
+    "solucoes_ia_implementadas": "solucao",
+    "oportunidades_ia": "oportunidade",
+    "links_ferramentas": None,
+    "areas_impactadas": None,
+}
+
+# Contadores de response.usage guardados em result["_usage"]
+USAGE_FIELDS = (
+    "input_tokens",
+    "cache_read_input_tokens",
+    "cache_creation_input_tokens",
+    "output_tokens",
+)
+
+# Listas enviadas item a item para a interface durante o streaming
+STREAMED_LISTS = ("problemas_operacionais", "oportunidades_ia")
 
 CLAUDE_MODELS = [
     "claude-sonnet-4-5-20250929",
@@ -13,10 +43,12 @@ CLAUDE_MODELS = [
     "claude-3-haiku-20240307",
 ]
 
-ANALYSIS_PROMPT_TEMPLATE = """Você é um analista de negócios especializado em identificar oportunidades de automação com IA em empresas.
+# Instruções fixas: vão no system com cache_control, então o prefixo é
+# reaproveitado entre chamadas (janelas, repetições e fallbacks do mesmo modelo)
+ANALYSIS_SYSTEM_PROMPT = """Você é um analista de negócios especializado em identificar oportunidades de automação com IA em empresas.
 
 CONTEXTO: Este grupo discute PROBLEMAS REAIS DO NEGÓCIO e como usar IA para resolvê-los.
-Os dados abaixo incluem mensagens de texto E transcrições de vídeos/reels compartilhados no grupo.
+As mensagens enviadas pelo usuário incluem mensagens de texto E transcrições de vídeos/reels compartilhados no grupo.
 Analise AMBOS com o mesmo peso — os vídeos frequentemente contêm relatos detalhados de problemas e soluções.
 
 ═══════════════════════════════════════════════════════════════════
@@ -36,16 +68,16 @@ Analise AMBOS com o mesmo peso — os vídeos frequentemente contêm relatos det
    ✓ Dificuldades de escala
 
    FORMATO DE SAÍDA:
-   {{
+   {
      "problema": "descrição do problema específico",
      "area": "departamento/área afetada (ex: Atendimento, Vendas, RH, Financeiro)",
      "frequencia": "diária/semanal/mensal ou número de vezes mencionado",
      "impacto": "alto/médio/baixo (baseado em palavras como 'crítico', 'urgente', 'perco tempo')"
-   }}
+   }
 
    EXEMPLOS:
-   ❌ ERRADO: {{"problema": "ChatGPT está lento"}}
-   ✅ CORRETO: {{"problema": "Atendimento demora 2h para responder cada cliente", "area": "Atendimento", "frequencia": "diária", "impacto": "alto"}}
+   ❌ ERRADO: {"problema": "ChatGPT está lento"}
+   ✅ CORRETO: {"problema": "Atendimento demora 2h para responder cada cliente", "area": "Atendimento", "frequencia": "diária", "impacto": "alto"}
 
 ═══════════════════════════════════════════════════════════════════
 
@@ -57,15 +89,15 @@ Analise AMBOS com o mesmo peso — os vídeos frequentemente contêm relatos det
    ✓ Resultados obtidos (tempo economizado, erros reduzidos)
 
    FORMATO DE SAÍDA:
-   {{
+   {
      "solucao": "o que foi feito com IA",
      "problema_resolvido": "qual problema foi resolvido",
      "resultado": "resultado obtido (tempo economizado, etc.)",
      "ferramenta": "ChatGPT/Claude/Make/n8n/etc"
-   }}
+   }
 
    EXEMPLO:
-   {{"solucao": "Usei ChatGPT para gerar respostas padrão", "problema_resolvido": "Demora para responder clientes", "resultado": "Reduziu tempo de 2h para 15min", "ferramenta": "ChatGPT"}}
+   {"solucao": "Usei ChatGPT para gerar respostas padrão", "problema_resolvido": "Demora para responder clientes", "resultado": "Reduziu tempo de 2h para 15min", "ferramenta": "ChatGPT"}
 
 ═══════════════════════════════════════════════════════════════════
 
@@ -77,11 +109,11 @@ Analise AMBOS com o mesmo peso — os vídeos frequentemente contêm relatos det
    ✓ Problemas sem solução atual
 
    FORMATO DE SAÍDA:
-   {{
+   {
      "oportunidade": "descrição da oportunidade",
      "problema_alvo": "qual problema resolveria",
      "viabilidade": "alta/média/baixa (baseado em complexidade mencionada)"
-   }}
+   }
 
 ═══════════════════════════════════════════════════════════════════
 
@@ -116,101 +148,409 @@ Analise AMBOS com o mesmo peso — os vídeos frequentemente contêm relatos det
 
 ═══════════════════════════════════════════════════════════════════
 
-MENSAGENS:
-
-{messages}
-
-═══════════════════════════════════════════════════════════════════
-
 RESPONDA APENAS COM JSON VÁLIDO (sem comentários, sem ```):
 
-{{
+{
   "problemas_operacionais": [
-    {{"problema": "...", "area": "...", "frequencia": "...", "impacto": "..."}},
+    {"problema": "...", "area": "...", "frequencia": "...", "impacto": "..."},
     ...
   ],
   "solucoes_ia_implementadas": [
-    {{"solucao": "...", "problema_resolvido": "...", "resultado": "...", "ferramenta": "..."}},
+    {"solucao": "...", "problema_resolvido": "...", "resultado": "...", "ferramenta": "..."},
     ...
   ],
   "oportunidades_ia": [
-    {{"oportunidade": "...", "problema_alvo": "...", "viabilidade": "..."}},
+    {"oportunidade": "...", "problema_alvo": "...", "viabilidade": "..."},
     ...
   ],
   "links_ferramentas": ["url1", "url2", ...],
   "areas_impactadas": ["area1", "area2", ...]
-}}
+}
 
 LEMBRE-SE: Foque em PROBLEMAS DE NEGÓCIO, não problemas técnicos com IA."""
 
+ANALYSIS_USER_TEMPLATE = "MENSAGENS:\n\n{messages}"
 
-def analyze_with_claude(messages, api_key, model, status_placeholder, prepared_text=None):
-    client = Anthropic(api_key=api_key)
 
-    if prepared_text:
-        truncated_input = prepared_text[:MAX_PROMPT_CHARS]
-        if len(prepared_text) > MAX_PROMPT_CHARS:
-            chars_removed = len(prepared_text) - MAX_PROMPT_CHARS
-            status_placeholder.warning(
-                f"⚠️ Conteúdo muito longo! Analisando apenas os primeiros {MAX_PROMPT_CHARS} "
-                f"caracteres ({chars_removed} caracteres ignorados)."
-            )
-    else:
-        text_blob = "\n".join([f"- {m['text']}" for m in messages])
-        truncated_input = text_blob[:MAX_PROMPT_CHARS]
-        if len(text_blob) > MAX_PROMPT_CHARS:
-            chars_removed = len(text_blob) - MAX_PROMPT_CHARS
-            status_placeholder.warning(
-                f"⚠️ Mensagens muito longas! Analisando apenas os primeiros {MAX_PROMPT_CHARS} "
-                f"caracteres ({chars_removed} caracteres ignorados)."
-            )
+def analyze_with_claude(messages, api_key, model, status_placeholder, prepared_text=None,
+                        windows=None, refresh=False, on_item=None, on_reset=None,
+                        cancelled=None):
+    # Conteúdo que cabe num prompt: uma chamada só. Mais que isso: map-reduce,
+    # uma chamada por janela em paralelo e os resultados combinados no fim.
+    # Respostas já obtidas para a mesma requisição vêm do cache (refresh=True ignora).
+    # A resposta chega por streaming: on_item(janela, chave, item) recebe cada
+    # item de STREAMED_LISTS assim que ele se completa, antes do JSON inteiro;
+    # on_reset(janela) avisa que os itens já recebidos daquela janela devem ser
+    # descartados porque outra tentativa (fallback de modelo) vai começar.
+    # cancelled (threading.Event) interrompe as requisições em andamento
+    # levantando AnalysisCancelled
+    if windows is None:
+        windows = [prepared_text] if prepared_text else prepare_analysis_windows(messages, model=model)
+
+    client = Anthropic(api_key=api_key)
+    windows = _fit_windows(client, model, windows or [""], refresh)
+    if len(windows) > 1:
+        return _analyze_windows_sync(
+            windows, api_key, model, status_placeholder, refresh, on_item, on_reset, cancelled
+        )
 
-    prompt = ANALYSIS_PROMPT_TEMPLATE.format(messages=truncated_input)
+    content = windows[0]
 
     models_to_try = [model] + [m for m in CLAUDE_MODELS if m != model]
 
     last_error = None
     for try_model in models_to_try:
+        request = _build_request(try_model, content)
+        cache_key = analysis_cache.request_key(request)
+        cached = None if refresh else _from_cache(analysis_cache.get(cache_key))
+        if cached is not None:
+            status_placeholder.success(f"✅ Resultado salvo de **{try_model}** (sem nova chamada)")
+            return cached
+
         status_placeholder.markdown(f"🔄 Tentando analisar com **{try_model}**...")
 
         try:
-            response = client.messages.create(
-                model=try_model,
-                max_tokens=4000,
-                temperature=0.1,
-                messages=[{"role": "user", "content": prompt}],
+            _check_cancelled(cancelled)
+            # Sair do bloco with fecha a conexão e interrompe a geração
+            if on_reset:
+                on_reset(0)
+            with client.messages.stream(**request) as stream:
+                items = ItemStream(
+                    STREAMED_LISTS,
+                    lambda key, item: on_item(0, key, item) if on_item else None,
+                )
+                for text in stream.text_stream:
+                    _check_cancelled(cancelled)
+                    items.feed(text)
+                response = stream.get_final_message()
+            result = _parse_response(response, try_model)
+            analysis_cache.put(cache_key, try_model, result)
+            # A contagem calibrada vale para as próximas preparações de conteúdo
+            token_budget.maybe_calibrate(client, model, content)
+            status_placeholder.success(
+                f"✅ Sucesso com modelo: **{try_model}** — {format_usage(result['_usage'])}"
             )
-
-            response_text = response.content[0].text.strip()
-            json_str = response_text
-            if json_str.startswith("```json"):
-                json_str = json_str[7:-3]
-            elif json_str.startswith("```"):
-                json_str = json_str[3:-3]
-
-            result = json.loads(json_str)
-            result["_model_used"] = try_model
-            result["_raw_response"] = response_text
-            status_placeholder.success(f"✅ Sucesso com modelo: **{try_model}**")
             return result
 
+        except AnalysisCancelled:
+            raise
+        except TruncatedResponse as e:
+            # Outro modelo receberia (e cobraria) o mesmo prompt enorme para
+            # provavelmente parar no mesmo ponto
+            return {"error": str(e)}
         except Exception as e:
             error_str = str(e)
             last_error = error_str
             logger.warning("Erro com modelo %s: %s", try_model, error_str)
+            fatal = _fatal_error(error_str)
+            if fatal:
+                return fatal
+
+    return _no_model_error(last_error)
+
+
+class TruncatedResponse(Exception):
+    pass
+
+
+class AnalysisCancelled(Exception):
+    pass
+
+
+def _check_cancelled(cancelled):
+    if cancelled is not None and cancelled.is_set():
+        raise AnalysisCancelled()
 
-            if "404" in error_str or "not_found" in error_str.lower():
-                continue
-            elif "429" in error_str or "rate_limit" in error_str.lower():
-                return {
-                    "error": f"Limite de taxa excedido. Aguarde alguns minutos e tente novamente. Erro: {error_str}"
-                }
-            elif "authentication" in error_str.lower() or "api_key" in error_str.lower():
-                return {
-                    "error": f"Erro de autenticação. Verifique sua API Key. Erro: {error_str}"
-                }
 
+def _fit_windows(client, model, windows, refresh):
+    # A estimativa local de tokens pode errar; perto do orçamento, a contagem
+    # exata da API decide, e a janela que não cabe é dividida ao meio
+    fitted = []
+    pending = list(windows)
+    while pending:
+        window = pending.pop(0)
+        if not token_budget.near_budget(window, model) or (
+            not refresh and analysis_cache.get(
+                analysis_cache.request_key(_build_request(model, window))
+            ) is not None
+        ):
+            fitted.append(window)
+            continue
+        counted = token_budget.count_tokens(client, model, window)
+        if counted is None or counted <= token_budget.input_budget(model):
+            fitted.append(window)
+            continue
+        logger.info(
+            "Janela com %s tokens passa do orçamento de %s: dividindo",
+            counted, token_budget.input_budget(model),
+        )
+        pending[:0] = split_window(window)
+    return fitted
+
+
+def _build_request(model, content):
+    return {
+        "model": model,
+        "max_tokens": token_budget.output_tokens(model, content),
+        "temperature": 0.1,
+        "system": [
+            {
+                "type": "text",
+                "text": ANALYSIS_SYSTEM_PROMPT,
+                "cache_control": {"type": "ephemeral"},
+            }
+        ],
+        "messages": [
+            {"role": "user", "content": ANALYSIS_USER_TEMPLATE.format(messages=content)}
+        ],
+    }
+
+
+def _usage(response):
+    usage = getattr(response, "usage", None)
+    return {field: getattr(usage, field, None) or 0 for field in USAGE_FIELDS}
+
+
+def format_usage(usage):
+    return (
+        f"tokens de entrada: {usage.get('input_tokens', 0)} "
+        f"(+{usage.get('cache_read_input_tokens', 0)} lidos do cache, "
+        f"{usage.get('cache_creation_input_tokens', 0)} gravados no cache), "
+        f"saída: {usage.get('output_tokens', 0)}"
+    )
+
+
+def _from_cache(result):
+    # O uso de tokens gravado é o da chamada original; esta não custou nada
+    if result is None:
+        return None
+    result.pop("_usage", None)
+    result["_cached"] = True
+    return result
+
+
+def _parse_response(response, model):
+    if getattr(response, "stop_reason", None) == "max_tokens":
+        raise TruncatedResponse(
+            f"A resposta de {model} foi cortada no limite de tokens de saída. "
+            "Reduza o conteúdo (ANALYSIS_MAX_INPUT_TOKENS) e tente novamente."
+        )
+    response_text = response.content[0].text.strip()
+    json_str = response_text
+    if json_str.startswith("```json"):
+        json_str = json_str[7:-3]
+    elif json_str.startswith("```"):
+        json_str = json_str[3:-3]
+
+    result = json.loads(json_str)
+    result["_model_used"] = model
+    result["_raw_response"] = response_text
+    result["_usage"] = _usage(response)
+    logger.info("Uso de tokens (%s): %s", model, result["_usage"])
+    return result
+
+
+def _fatal_error(error_str):
+    # Erros que outro modelo não resolve; os demais (404 etc.) passam para o próximo
+    if "prompt is too long" in error_str.lower():
+        return {
+            "error": f"O conteúdo passou do limite de contexto do modelo. Erro: {error_str}"
+        }
+    if "429" in error_str or "rate_limit" in error_str.lower():
+        return {
+            "error": f"Limite de taxa excedido. Aguarde alguns minutos e tente novamente. Erro: {error_str}"
+        }
+    if "authentication" in error_str.lower() or "api_key" in error_str.lower():
+        return {
+            "error": f"Erro de autenticação. Verifique sua API Key. Erro: {error_str}"
+        }
+    return None
+
+
+def _no_model_error(last_error):
     return {
         "error": f"Nenhum modelo disponível funcionou. Último erro: {last_error}. "
         "Verifique sua API Key em console.anthropic.com e confirme quais modelos você tem acesso."
     }
+
+
+def _analyze_windows_sync(windows, api_key, model, status_placeholder, refresh=False,
+                          on_item=None, on_reset=None, cancelled=None):
+    status_placeholder.markdown(
+        f"🔄 Conteúdo grande: analisando **{len(windows)} partes** em paralelo com **{model}**..."
+    )
+
+    def progress(kind, *args):
+        # Eventos do event loop: ("item", janela, chave, item), ("reset", janela)
+        # ou ("window", feitas, total)
+        if kind == "item":
+            if on_item:
+                on_item(*args)
+        elif kind == "reset":
+            if on_reset:
+                on_reset(*args)
+        else:
+            status_placeholder.markdown(f"🔄 Partes analisadas: {args[0]}/{args[1]}")
+
+    results = run_async_in_thread(
+        _analyze_windows, windows, api_key, model, refresh, cancelled,
+        progress_callback=progress,
+    )
+    failures = [r for r in results if "error" in r]
+    if len(failures) == len(results):
+        return failures[0]
+
+    merged = merge_results([r for r in results if "error" not in r])
+    if failures:
+        merged["_failed_windows"] = len(failures)
+        status_placeholder.warning(
+            f"⚠️ {len(failures)} de {len(windows)} partes falharam: {failures[0]['error']}"
+        )
+    elif merged.get("_cached"):
+        status_placeholder.success(
+            f"✅ {len(windows)} partes com resultado salvo de **{merged['_model_used']}** "
+            "(sem nova chamada)"
+        )
+    else:
+        status_placeholder.success(
+            f"✅ {len(windows)} partes analisadas com: **{merged['_model_used']}** — "
+            f"{format_usage(merged['_usage'])}"
+        )
+    return merged
+
+
+def _ignore_started():
+    pass
+
+
+async def _analyze_windows(windows, api_key, model, refresh=False, cancelled=None,
+                           progress_callback=None):
+    # Janelas em paralelo, limitadas por MAX_CONCURRENT_WINDOWS: o tempo total
+    # fica perto do da janela mais lenta. A primeira sai sozinha e as demais
+    # esperam ela começar a responder: a essa altura o prefixo de sistema já
+    # está no cache de prompt, e elas o leem em vez de gravá-lo de novo. Se o
+    # prefixo for curto demais para o cache do modelo, não há o que esperar
+    client = AsyncAnthropic(api_key=api_key)
+    semaphore = asyncio.Semaphore(max(1, MAX_CONCURRENT_WINDOWS))
+    models_to_try = [model] + [m for m in CLAUDE_MODELS if m != model]
+    done = 0
+
+    def event(*args):
+        if progress_callback:
+            progress_callback(*args)
+
+    first_started = asyncio.Event()
+
+    async def run(index, on_started=_ignore_started):
+        nonlocal done
+        async with semaphore:
+            result = await _analyze_window(
+                client,
+                windows[index],
+                models_to_try,
+                refresh,
+                lambda key, item: event("item", index, key, item),
+                lambda: event("reset", index),
+                on_started,
+                cancelled,
+            )
+        done += 1
+        if progress_callback:
+            progress_callback("window", done, len(windows))
+        return result
+
+    tasks = []
+    try:
+        tasks.append(asyncio.ensure_future(run(0, first_started.set)))
+        if token_budget.prompt_cacheable(model, ANALYSIS_SYSTEM_PROMPT):
+            await first_started.wait()
+            _check_cancelled(cancelled)
+        tasks.extend(asyncio.ensure_future(run(index)) for index in range(1, len(windows)))
+        return await asyncio.gather(*tasks)
+    finally:
+        # Cancelamento (ou erro inesperado) numa janela derruba as outras
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await client.close()
+
+
+
+async def _analyze_window(client, window, models_to_try, refresh, on_item, on_reset,
+                         on_started=_ignore_started, cancelled=None):
+    # on_started é chamado no primeiro texto da resposta (ou quando a janela
+    # termina sem chegar a responder)
+    try:
+        return await _analyze_window_models(
+            client, window, models_to_try, refresh, on_item, on_reset, on_started, cancelled
+        )
+    finally:
+        on_started()
+
+
+async def _analyze_window_models(client, window, models_to_try, refresh, on_item, on_reset,
+                                 on_started, cancelled):
+    last_error = None
+    for try_model in models_to_try:
+        request = _build_request(try_model, window)
+        cache_key = analysis_cache.request_key(request)
+        if not refresh:
+            cached = _from_cache(await asyncio.to_thread(analysis_cache.get, cache_key))
+            if cached is not None:
+                return cached
+        try:
+            _check_cancelled(cancelled)
+            on_reset()
+            async with client.messages.stream(**request) as stream:
+                items = ItemStream(STREAMED_LISTS, on_item)
+                async for text in stream.text_stream:
+                    _check_cancelled(cancelled)
+                    on_started()
+                    items.feed(text)
+                response = await stream.get_final_message()
+            result = _parse_response(response, try_model)
+            await asyncio.to_thread(analysis_cache.put, cache_key, try_model, result)
+            return result
+        except AnalysisCancelled:
+            raise
+        except TruncatedResponse as e:
+            return {"error": str(e)}
+        except Exception as e:
+            error_str = str(e)
+            last_error = error_str
+            logger.warning("Erro com modelo %s: %s", try_model, error_str)
+            fatal = _fatal_error(error_str)
+            if fatal:
+                return fatal
+    return _no_model_error(last_error)
+
+
+def merge_results(results):
+    # Listas concatenadas na ordem das janelas; itens repetidos (mesmo texto
+    # principal) e links/áreas repetidos entram uma vez só
+    merged = {}
+    for key, field in MERGED_LISTS.items():
+        seen = set()
+        items = []
+        for result in results:
+            for item in result.get(key) or []:
+                value = item.get(field, "") if isinstance(item, dict) and field else item
+                if isinstance(value, str):
+                    value = " ".join(value.split())
+                marker = json.dumps(value, sort_keys=True, ensure_ascii=False).lower()
+                if marker in seen:
+                    continue
+                seen.add(marker)
+                items.append(item)
+        merged[key] = items
+
+    models = list(dict.fromkeys(r.get("_model_used") for r in results if r.get("_model_used")))
+    merged["_model_used"] = ", ".join(models) or "desconhecido"
+    merged["_raw_response"] = "\n\n".join(r.get("_raw_response", "") for r in results)
+    merged["_usage"] = {
+        field: sum(r.get("_usage", {}).get(field, 0) for r in results) for field in USAGE_FIELDS
+    }
+    merged["_windows"] = len(results)
+    if all(r.get("_cached") for r in results):
+        merged["_cached"] = True
+    return merged
@@ -2,9 +2,10 @@ import streamlit as st
 import pandas as pd
 from helpers import priority_sort_key, priority_color
 from report_export import generate_html_report
+from claude_analysis import format_usage
 
 
-def render(res):
+def render(res, messages=None):
     st.divider()
 
     col_title, col_export = st.columns([3, 1])
@@ -22,6 +23,9 @@ def render(res):
     model_used = res.get("_model_used")
     if model_used:
         st.caption(f"🤖 Análise realizada com: **{model_used}**")
+    usage = res.get("_usage")
+    if usage:
+        st.caption(f"🧮 Uso de tokens — {format_usage(usage)}")
 
     problemas = res.get("problemas_operacionais", [])
     solucoes = res.get("solucoes_ia_implementadas", [])
@@ -40,10 +44,25 @@ def render(res):
     _render_recommendations(problemas, solucoes)
     st.divider()
     _render_links(links)
-    _render_raw_data()
+    _render_raw_data(messages)
     _render_debug(res)
 
 
+def render_partial(partial):
+    # Itens que já chegaram pelo streaming, enquanto a análise continua
+    problemas = partial.get("problemas_operacionais", [])
+    oportunidades = partial.get("oportunidades_ia", [])
+    st.caption(
+        f"Encontrados até agora: {len(problemas)} problemas, {len(oportunidades)} oportunidades"
+    )
+    for prob in problemas:
+        cor = priority_color(prob.get("impacto", "baixo"))
+        st.markdown(f"{cor} **{prob.get('area', 'Não especificado')}** — {prob.get('problema', 'N/A')}")
+    for oport in oportunidades:
+        cor = priority_color(oport.get("viabilidade", "baixa"), invert=True)
+        st.markdown(f"💡 {cor} {oport.get('oportunidade', 'N/A')}")
+
+
 def _render_metrics(problemas, solucoes, oportunidades, areas, links):
     c1, c2, c3, c4, c5 = st.columns(5)
     with c1:
@@ -160,9 +179,11 @@ def _render_links(links):
         st.info("Nenhum link de ferramenta compartilhado.")
 
 
-def _render_raw_data():
+def _render_raw_data(messages=None):
+    if messages is None:
+        messages = st.session_state.get("messages_data", [])
     with st.expander("📄 Ver dados brutos (Mensagens originais)"):
-        df = pd.DataFrame(st.session_state.get("messages_data", []))
+        df = pd.DataFrame(messages)
         st.dataframe(df, width="stretch")
 
 
@@ -1,58 +1,166 @@
-MAX_TOTAL_CHARS = 12000
-TEXT_PRIORITY_RATIO = 0.6
+import logging
 
+import token_budget
 
-def prepare_analysis_input(messages, transcriptions=None):
-    if transcriptions is None:
-        transcriptions = []
+logger = logging.getLogger(__name__)
 
-    text_section = _build_text_section(messages)
-    video_section = _build_video_section(transcriptions)
+# O conteúdo é medido com a razão fixa de token_budget (estimate_tokens sem
+# modelo), não com a calibrada: a mesma conversa gera sempre as mesmas janelas,
+# e o analysis_cache continua valendo depois de um restart ou recalibração.
+# Janelas perto do limite são contadas pela API em claude_analysis._fit_windows.
 
-    if not video_section:
-        return text_section[:MAX_TOTAL_CHARS]
+TEXT_PRIORITY_RATIO = 0.6
 
-    text_limit = int(MAX_TOTAL_CHARS * TEXT_PRIORITY_RATIO)
-    video_limit = MAX_TOTAL_CHARS - min(len(text_section), text_limit)
+MEDIA_LABELS = {"voice": "Nota de voz", "video_note": "Vídeo redondo"}
 
-    truncated_text = text_section[:text_limit]
-    truncated_video = video_section[:video_limit]
+TEXT_HEADER = "MENSAGENS DE TEXTO DO GRUPO:\n"
+VIDEO_HEADER = (
+    "TRANSCRIÇÕES DE VÍDEOS E ÁUDIOS COMPARTILHADOS NO GRUPO:\n"
+    "(Conteúdo extraído automaticamente dos vídeos e notas de voz enviados nas mensagens)\n"
+)
 
-    return f"{truncated_text}\n\n{truncated_video}"
 
+def prepare_analysis_input(messages, transcriptions=None, model=None):
+    # Preenche o orçamento de tokens do modelo: até TEXT_PRIORITY_RATIO para as
+    # mensagens de texto e o resto para as transcrições; o que uma parte não
+    # usar fica para a outra
+    if transcriptions is None:
+        transcriptions = []
 
-def _build_text_section(messages):
-    if not messages:
-        return ""
+    budget = token_budget.input_budget(model)
+    text_entries = _build_text_entries(messages)
+    video_entries = _build_video_entries(transcriptions)
 
-    lines = ["MENSAGENS DE TEXTO DO GRUPO:", ""]
-    for msg in messages:
-        date = msg.get("date", "")
-        text = msg.get("text", "")
-        lines.append(f"[{date}] {text}")
+    if not video_entries:
+        return _pack(TEXT_HEADER, text_entries, budget)
 
-    return "\n".join(lines)
+    text_tokens = sum(token_budget.estimate_tokens(e) for e in text_entries)
+    text_limit = int(budget * TEXT_PRIORITY_RATIO)
+    video_section = _pack(VIDEO_HEADER, video_entries, budget - min(text_tokens, text_limit))
+    text_section = _pack(
+        TEXT_HEADER, text_entries, budget - token_budget.estimate_tokens(video_section)
+    )
 
+    return f"{text_section}\n\n{video_section}" if text_section else video_section
 
-def _build_video_section(transcriptions):
-    if not transcriptions:
-        return ""
 
-    lines = [
-        "TRANSCRIÇÕES DE VÍDEOS COMPARTILHADOS NO GRUPO:",
-        "(Conteúdo extraído automaticamente dos vídeos enviados nas mensagens)",
-        "",
+def prepare_analysis_windows(messages, transcriptions=None, model=None):
+    # Todo o conteúdo, sem descartar nada: se não couber num prompt só, é
+    # dividido em janelas do tamanho do orçamento do modelo (análise map-reduce)
+    if transcriptions is None:
+        transcriptions = []
+
+    budget = token_budget.input_budget(model)
+    sections = [
+        (TEXT_HEADER, _build_text_entries(messages)),
+        (VIDEO_HEADER, _build_video_entries(transcriptions)),
     ]
+    total = sum(
+        token_budget.estimate_tokens(header)
+        + sum(token_budget.estimate_tokens(e) for e in entries)
+        for header, entries in sections
+        if entries
+    )
+    if total <= budget:
+        return [prepare_analysis_input(messages, transcriptions, model=model)]
+
+    windows = _split_windows(sections, budget)
+    logger.info("Conteúdo dividido em %s janelas de até %s tokens", len(windows), budget)
+    return windows
+
+
+def _split_windows(sections, budget):
+    # Entradas em ordem, cada janela com o cabeçalho das seções que contém;
+    # só uma entrada maior que a janela inteira é cortada
+    windows = []
+    lines = []
+    used = 0
+    current_header = None
+    for header, entries in sections:
+        header_tokens = token_budget.estimate_tokens(header)
+        for entry in entries:
+            tokens = token_budget.estimate_tokens(entry)
+            if header_tokens + tokens > budget:
+                entry = token_budget.truncate_to_tokens(entry, budget - header_tokens)
+                tokens = token_budget.estimate_tokens(entry)
+
+            needed = tokens + (header_tokens if header is not current_header else 0)
+            if lines and used + needed > budget:
+                windows.append("\n".join(lines))
+                lines, used, current_header = [], 0, None
+                needed = tokens + header_tokens
+
+            if header is not current_header:
+                if lines:
+                    lines.append("")
+                lines.append(header)
+                current_header = header
+            lines.append(entry)
+            used += needed
+
+    if lines:
+        windows.append("\n".join(lines))
+    return windows
+
+
+def split_window(window):
+    # Divide uma janela ao meio numa fronteira de entrada ("[data] ..."),
+    # repetindo na segunda metade o cabeçalho da seção em que o corte caiu
+    lines = window.split("\n")
+    starts = [i for i, line in enumerate(lines) if line.startswith("[")][1:]
+    if not starts:
+        middle = len(window) // 2
+        return [window[:middle], window[middle:]]
+
+    cut = min(starts, key=lambda i: abs(i - len(lines) / 2))
+    header = None
+    for line in lines[:cut]:
+        for candidate in (TEXT_HEADER, VIDEO_HEADER):
+            if line == candidate.split("\n")[0]:
+                header = candidate
+    second = "\n".join(lines[cut:])
+    if header:
+        second = f"{header}\n{second}"
+    return ["\n".join(lines[:cut]).rstrip("\n"), second]
+
+
+def _pack(header, entries, budget):
+    # Entradas inteiras, na ordem, enquanto couberem; uma entrada grande demais
+    # é pulada para as seguintes ainda aproveitarem o espaço
+    if not entries:
+        return ""
+    used = token_budget.estimate_tokens(header)
+    packed = [header]
+    for entry in entries:
+        tokens = token_budget.estimate_tokens(entry)
+        if used + tokens > budget:
+            continue
+        packed.append(entry)
+        used += tokens
+
+    skipped = len(entries) - (len(packed) - 1)
+    if skipped:
+        logger.info(
+            "%s de %s entradas ficaram fora do orçamento de %s tokens",
+            skipped, len(entries), budget,
+        )
+    return "\n".join(packed)
+
+
+def _build_text_entries(messages):
+    return [f"[{msg.get('date', '')}] {msg.get('text', '')}" for msg in messages or []]
+
+
+def _build_video_entries(transcriptions):
+    entries = []
     for t in transcriptions:
         source = t.get("origin", "desconhecido")
         date = t.get("date", "")
         text = t.get("transcription", "")
         if text:
-            lines.append(f"[{date}] Vídeo ({source}):")
-            lines.append(f"  {text}")
-            lines.append("")
-
-    return "\n".join(lines)
+            label = MEDIA_LABELS.get(t.get("kind"), "Vídeo")
+            entries.append(f"[{date}] {label} ({source}):\n  {text}\n")
+    return entries
 
 
 def get_media_summary(transcriptions):
@@ -1,7 +1,12 @@
+import os
+import uuid
 import asyncio
+import logging
 import threading
 import queue
 
+logger = logging.getLogger(__name__)
+
 PRIORITY_ORDER = {
     "alto": 1, "alta": 1,
     "médio": 2, "medio": 2, "média": 2, "media": 2,
@@ -51,25 +56,156 @@ def validate_claude_key(key):
     return True, None
 
 
-def run_async_in_thread(async_func, *args):
-    result_queue = queue.Queue()
+# Identifica esta execução do processo. Depois de um restart o pid costuma
+# se repetir (num contêiner o app é sempre o mesmo pid), o token não.
+PROCESS_TOKEN = uuid.uuid4().hex[:12]
+
+
+def process_owner():
+    # "<pid>-<token>": gravado em jobs e nos diretórios de download
+    return f"{os.getpid()}-{PROCESS_TOKEN}"
+
+
+def owner_alive(owner):
+    pid, _, token = str(owner or "").partition("-")
+    if not pid.isdigit():
+        return False
+    if token == PROCESS_TOKEN:
+        return True
+    if int(pid) == os.getpid():
+        # Mesmo pid de uma execução anterior: o dono já morreu
+        return False
+    return process_alive(int(pid))
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class StatusRecorder:
+    # Substituto de st.empty() para código que roda fora da thread do Streamlit:
+    # guarda as mensagens de status em vez de desenhá-las na tela.
+    def __init__(self, on_update=None):
+        self.messages = []
+        self.on_update = on_update
+
+    def _record(self, level, text):
+        self.messages.append((level, text))
+        if self.on_update:
+            self.on_update(level, text)
+
+    def markdown(self, text):
+        self._record("info", text)
+
+    def info(self, text):
+        self._record("info", text)
+
+    def success(self, text):
+        self._record("success", text)
+
+    def warning(self, text):
+        self._record("warning", text)
+
+    def error(self, text):
+        self._record("error", text)
+
+    def empty(self):
+        pass
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_event_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            t = threading.Thread(target=_loop.run_forever, name="async-loop", daemon=True)
+            t.start()
+        return _loop
+
+
+def run_async_in_thread(async_func, *args, progress_callback=None, **kwargs):
+    # Todas as chamadas compartilham um único event loop em background, para que
+    # clientes do Telegram criados nele possam ser reutilizados entre reruns.
+    if progress_callback is None:
+        future = asyncio.run_coroutine_threadsafe(async_func(*args, **kwargs), get_event_loop())
+        return future.result()
+
+    events = queue.Queue()
+    future = asyncio.run_coroutine_threadsafe(
+        async_func(*args, progress_callback=lambda *event: events.put(event), **kwargs),
+        get_event_loop(),
+    )
+    return _wait_relaying_progress(future, events, progress_callback)
+
+
+def iter_async_in_thread(async_gen_func, *args, progress_callback=None, **kwargs):
+    # Versão síncrona de um async generator: cada item é produzido no event loop
+    # de background e entregue à thread chamadora assim que fica pronto.
+    loop = get_event_loop()
+    events = queue.Queue()
+    if progress_callback is None:
+        agen = async_gen_func(*args, **kwargs)
+    else:
+        agen = async_gen_func(
+            *args, progress_callback=lambda *event: events.put(event), **kwargs
+        )
+
+    future = None
+    try:
+        while True:
+            future = asyncio.run_coroutine_threadsafe(_anext(agen), loop)
+            item = _wait_relaying_progress(future, events, progress_callback)
+            if item is _EXHAUSTED:
+                return
+            yield item
+    finally:
+        # O chamador pode sair no meio de um __anext__ (exceção no callback,
+        # rerun do Streamlit): cancela o passo em andamento antes de fechar o
+        # generator, sem deixar um erro do fechamento esconder o original
+        if future is not None and not future.done():
+            future.cancel()
+        try:
+            asyncio.run_coroutine_threadsafe(_aclose(agen), loop).result()
+        except (RuntimeError, asyncio.CancelledError) as e:
+            logger.warning("Erro ao fechar o generator assíncrono: %s", e)
+
+
+_EXHAUSTED = object()
+
+
+async def _anext(agen):
+    try:
+        return await agen.__anext__()
+    except StopAsyncIteration:
+        return _EXHAUSTED
+
+
+async def _aclose(agen):
+    # Espera o passo cancelado terminar de desfazer o generator
+    while agen.ag_running:
+        await asyncio.sleep(0.01)
+    await agen.aclose()
+
 
-    def target():
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+def _wait_relaying_progress(future, events, progress_callback):
+    # O callback de progresso é repassado para a thread chamadora, já que o
+    # Streamlit só aceita atualizações de tela a partir da thread do script.
+    if progress_callback is None:
+        return future.result()
+    while not (future.done() and events.empty()):
         try:
-            result = loop.run_until_complete(async_func(*args))
-            result_queue.put(("success", result))
-        except Exception as e:
-            result_queue.put(("error", e))
-        finally:
-            loop.close()
-
-    t = threading.Thread(target=target)
-    t.start()
-    t.join()
-
-    status, value = result_queue.get()
-    if status == "error":
-        raise value
-    return value
+            event = events.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        progress_callback(*event)
+    return future.result()
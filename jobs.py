@@ -0,0 +1,261 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import storage
+import transcript_cache
+from helpers import StatusRecorder, owner_alive, process_owner
+from media_processing import process_all_media
+from claude_analysis import STREAMED_LISTS, AnalysisCancelled, analyze_with_claude
+from transcription import get_transcription_stats
+
+logger = logging.getLogger(__name__)
+
+DB_NAME = "jobs.db"
+MAX_RUNNING_JOBS = int(os.getenv("MAX_BACKGROUND_JOBS", "2"))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+ACTIVE = (QUEUED, RUNNING)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    current INTEGER NOT NULL DEFAULT 0,
+    total INTEGER NOT NULL DEFAULT 0,
+    message TEXT,
+    result TEXT,
+    error TEXT,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    owner TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status);
+"""
+
+_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=MAX_RUNNING_JOBS, thread_name_prefix="job")
+_cancel_events = {}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _conn():
+    return storage.connect(DB_NAME, _SCHEMA)
+
+
+def submit(kind, params, secrets=None):
+    # params vai para o disco (para retomar depois de um restart); secrets
+    # (API keys) fica só em memória
+    if kind not in _RUNNERS:
+        raise ValueError(f"Tipo de job desconhecido: {kind}")
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with _lock:
+        conn = _conn()
+        conn.execute(
+            "INSERT INTO jobs (id, kind, status, params, owner, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, kind, QUEUED, json.dumps(params), process_owner(), now, now),
+        )
+        conn.commit()
+    _start(job_id, secrets or {})
+    return job_id
+
+
+def get(job_id):
+    with _lock:
+        row = _conn().execute(
+            "SELECT id, kind, status, current, total, message, result, error, cancel_requested "
+            "FROM jobs WHERE id = ?",
+            (job_id,),
+        ).fetchone()
+    if row is None:
+        return None
+    job = dict(row)
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    return job
+
+
+def cancel(job_id):
+    with _lock:
+        conn = _conn()
+        conn.execute(
+            "UPDATE jobs SET cancel_requested = 1, updated_at = ? WHERE id = ?",
+            (time.time(), job_id),
+        )
+        conn.commit()
+    event = _cancel_events.get(job_id)
+    if event:
+        event.set()
+
+
+def resume_interrupted():
+    # Na inicialização: jobs que estavam na fila ou rodando num processo que
+    # morreu voltam a rodar. Itens já concluídos não são refeitos: as
+    # transcrições prontas estão no cache de transcrições.
+    with _lock:
+        conn = _conn()
+        rows = conn.execute(
+            f"SELECT id, owner FROM jobs WHERE status IN ({','.join('?' * len(ACTIVE))})",
+            ACTIVE,
+        ).fetchall()
+        orphans = [row["id"] for row in rows if not owner_alive(row["owner"])]
+        for job_id in orphans:
+            conn.execute(
+                "UPDATE jobs SET status = ?, owner = ?, message = ?, updated_at = ? WHERE id = ?",
+                (QUEUED, process_owner(), "Retomado após reinício", time.time(), job_id),
+            )
+        conn.commit()
+
+    for job_id in orphans:
+        logger.info("Retomando job %s", job_id)
+        _start(job_id, {})
+    return orphans
+
+
+def _start(job_id, secrets):
+    _cancel_events[job_id] = threading.Event()
+    _executor.submit(_run, job_id, secrets)
+
+
+def _update(job_id, **fields):
+    fields["updated_at"] = time.time()
+    with _lock:
+        conn = _conn()
+        conn.execute(
+            f"UPDATE jobs SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?",
+            (*fields.values(), job_id),
+        )
+        conn.commit()
+
+
+def _run(job_id, secrets):
+    cancelled = _cancel_events[job_id]
+    with _lock:
+        row = _conn().execute(
+            "SELECT kind, params, cancel_requested FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+    if row["cancel_requested"]:
+        cancelled.set()
+
+    try:
+        if cancelled.is_set():
+            raise JobCancelled()
+        _update(job_id, status=RUNNING)
+
+        def report(current, total, message, partial=None):
+            # Enquanto o job roda, result guarda o resultado parcial (se houver)
+            fields = {"current": current, "total": total, "message": message}
+            if partial is not None:
+                fields["result"] = json.dumps(partial)
+            _update(job_id, **fields)
+
+        result = _RUNNERS[row["kind"]](json.loads(row["params"]), secrets, report, cancelled)
+        if cancelled.is_set():
+            raise JobCancelled()
+        _update(job_id, status=DONE, result=json.dumps(result), message="Concluído")
+    except JobCancelled:
+        _update(job_id, status=CANCELLED, message="Cancelado")
+    except Exception as e:
+        logger.exception("Erro no job %s", job_id)
+        _update(job_id, status=FAILED, error=str(e))
+    finally:
+        _cancel_events.pop(job_id, None)
+
+
+def _run_media(params, secrets, report, cancelled):
+    def progress(current, total, message):
+        # O pipeline interrompe os estágios quando o callback levanta exceção
+        if cancelled.is_set():
+            raise JobCancelled()
+        report(current, total, message)
+
+    cache_before = transcript_cache.stats()
+    whisper_before = get_transcription_stats()
+    transcriptions = process_all_media(
+        params["messages"],
+        params.get("media_files", []),
+        progress_callback=progress,
+        time_budget=params.get("time_budget"),
+        byte_budget=params.get("byte_budget"),
+    )
+    cache_after = transcript_cache.stats()
+    whisper_after = get_transcription_stats()
+    return {
+        "transcriptions": transcriptions,
+        "cache_hits": cache_after["hits"] - cache_before["hits"],
+        "cache_misses": cache_after["misses"] - cache_before["misses"],
+        "cache_entries": cache_after["entries"],
+        "audio_seconds": whisper_after["audio_seconds"] - whisper_before["audio_seconds"],
+        "processing_seconds": (
+            whisper_after["processing_seconds"] - whisper_before["processing_seconds"]
+        ),
+    }
+
+
+def _run_analysis(params, secrets, report, cancelled):
+    # Depois de um restart a chave só existe se vier do ambiente
+    api_key = secrets.get("api_key") or os.getenv("ANTHROPIC_API_KEY")
+    if not api_key:
+        return {"error": "Análise interrompida: informe a API Key e rode de novo."}
+    # Itens parciais por janela: uma nova tentativa (fallback de modelo)
+    # descarta os itens da tentativa anterior daquela janela
+    partial_by_window = {}
+    last_message = ""
+
+    def status_update(level, text):
+        nonlocal last_message
+        last_message = text
+        report(0, 1, text)
+
+    def publish():
+        partial = {key: [] for key in STREAMED_LISTS}
+        for window in sorted(partial_by_window):
+            for key, items in partial_by_window[window].items():
+                partial[key].extend(items)
+        report(0, 1, last_message, partial=partial)
+
+    def item_found(window, key, item):
+        partial_by_window.setdefault(window, {k: [] for k in STREAMED_LISTS})[key].append(item)
+        publish()
+
+    def attempt_started(window):
+        if partial_by_window.pop(window, None):
+            publish()
+
+    status = StatusRecorder(on_update=status_update)
+    try:
+        return analyze_with_claude(
+            params["messages"],
+            api_key,
+            params["model"],
+            status,
+            prepared_text=params.get("prepared_text"),
+            windows=params.get("windows"),
+            refresh=params.get("refresh", False),
+            on_item=item_found,
+            on_reset=attempt_started,
+            cancelled=cancelled,
+        )
+    except AnalysisCancelled:
+        raise JobCancelled()
+
+
+_RUNNERS = {
+    "media": _run_media,
+    "analysis": _run_analysis,
+}
@@ -0,0 +1,65 @@
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ItemStream:
+    # Lê o JSON da resposta em pedaços, conforme chega do streaming, e chama
+    # on_item(chave, item) para cada objeto completo das listas em `keys` do
+    # objeto principal. Texto antes do primeiro "{" (```json) é ignorado.
+    def __init__(self, keys, on_item):
+        self.keys = set(keys)
+        self.on_item = on_item
+        self.text = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._last_string = None
+        self._key = None
+        self._list_key = None
+        self._item_start = None
+
+    def feed(self, chunk):
+        self.text += chunk
+        text = self.text
+        for i in range(self._pos, len(text)):
+            c = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._last_string = text[self._string_start + 1:i]
+            elif c == '"':
+                self._in_string = True
+                self._string_start = i
+            elif c == ":" and self._depth == 1:
+                self._key = self._last_string
+            elif c in "{[":
+                self._depth += 1
+                if c == "[" and self._depth == 2:
+                    self._list_key = self._key if self._key in self.keys else None
+                elif c == "{" and self._depth == 3 and self._list_key:
+                    self._item_start = i
+            elif c in "}]":
+                if c == "}" and self._depth == 3 and self._item_start is not None:
+                    self._emit(text[self._item_start:i + 1])
+                    self._item_start = None
+                self._depth -= 1
+                if self._depth <= 1:
+                    self._list_key = None
+        self._pos = len(text)
+
+    def _emit(self, raw):
+        try:
+            item = json.loads(raw)
+        except ValueError:
+            logger.debug("Item parcial inválido ignorado: %s", raw[:200])
+            return
+        self.on_item(self._list_key, item)
@@ -0,0 +1,67 @@
+import os
+import time
+import threading
+
+import storage
+
+DB_NAME = "links.db"
+# Links que falharam só são tentados de novo depois de um tempo: falhas
+# permanentes (removido, privado, grande demais) em horas, falhas passageiras
+# (rede, limite de requisições, download interrompido) em minutos
+RETRY_FAILED_SECONDS = int(os.getenv("LINK_RETRY_FAILED_HOURS", "24")) * 3600
+RETRY_TRANSIENT_SECONDS = int(os.getenv("LINK_RETRY_TRANSIENT_MINUTES", "30")) * 60
+
+FAILED = "failed"
+TRANSIENT = "transient"
+
+_RETRY_SECONDS = {FAILED: RETRY_FAILED_SECONDS, TRANSIENT: RETRY_TRANSIENT_SECONDS}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS links (
+    key TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    status TEXT NOT NULL,
+    reason TEXT,
+    updated_at REAL NOT NULL
+);
+"""
+
+_lock = threading.Lock()
+
+
+def _conn():
+    return storage.connect(DB_NAME, _SCHEMA)
+
+
+def get_statuses(keys):
+    # {key: status} dos links que falharam recentemente; falhas antigas são esquecidas
+    keys = [k for k in keys if k]
+    if not keys:
+        return {}
+    with _lock:
+        conn = _conn()
+        rows = conn.execute(
+            f"SELECT key, status, updated_at FROM links WHERE key IN ({','.join('?' * len(keys))})",
+            keys,
+        ).fetchall()
+    now = time.time()
+    return {
+        row["key"]: row["status"]
+        for row in rows
+        if now - row["updated_at"] < _RETRY_SECONDS.get(row["status"], 0)
+    }
+
+
+def mark(key, url, status, reason=None):
+    # status: FAILED ou TRANSIENT
+    if not key:
+        return
+    with _lock:
+        conn = _conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO links (key, url, status, reason, updated_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (key, url, status, reason, time.time()),
+        )
+        conn.commit()
+
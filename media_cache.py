@@ -0,0 +1,286 @@
+import os
+import time
+import shutil
+import re
+import hashlib
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+import storage
+from helpers import owner_alive, process_owner
+
+logger = logging.getLogger(__name__)
+
+DB_NAME = "media_cache.db"
+CACHE_DIR = os.path.join(storage.DATA_DIR, "media_cache")
+MAX_CACHE_BYTES = int(os.getenv("MEDIA_CACHE_MAX_MB", "2048")) * 1024 * 1024
+
+# Parâmetros de URL que identificam o vídeo; o resto (utm_*, igsh, si, t...) é descartado
+_KEPT_QUERY_PARAMS = {"v"}
+
+# Plataforma + id do vídeo: youtu.be/X, youtube.com/watch?v=X&t=10 e
+# youtube.com/shorts/X são o mesmo vídeo
+_VIDEO_ID_PATTERNS = [
+    ("youtube", re.compile(
+        r"(?:youtube\.com/(?:watch\?(?:[^#\s]*&)?v=|shorts/|live/|embed/)|youtu\.be/)([\w-]+)",
+        re.IGNORECASE,
+    )),
+    ("instagram", re.compile(r"instagram\.com/(?:[\w.]+/)?(?:reels?|p|tv)/([\w-]+)", re.IGNORECASE)),
+    ("tiktok", re.compile(r"tiktok\.com/(?:@[\w.-]+/video|v|embed(?:/v2)?)/(\d+)", re.IGNORECASE)),
+    ("x", re.compile(r"(?:x|twitter)\.com/(?:\w+|i/web)/status(?:es)?/(\d+)", re.IGNORECASE)),
+]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    content_hash TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_entries_hash ON entries (content_hash);
+CREATE INDEX IF NOT EXISTS idx_entries_access ON entries (last_access);
+"""
+
+_lock = threading.Lock()
+# Bytes prometidos a downloads em andamento (ainda fora de entries) e blobs
+# em uso pelo pipeline, que não podem ser removidos pelo LRU
+_space = threading.Condition()
+_reserved = 0
+_pinned = {}
+
+
+def _conn():
+    return storage.connect(DB_NAME, _SCHEMA)
+
+
+def telegram_key(document_id):
+    return f"tg:{document_id}"
+
+
+def canonical_id(url):
+    # "youtube:dQw4w9WgXcQ", "instagram:C1a2b3", ... ou None se o link não
+    # tiver um id reconhecível (ex.: links encurtados do TikTok)
+    for platform, pattern in _VIDEO_ID_PATTERNS:
+        match = pattern.search(url)
+        if match:
+            return f"{platform}:{match.group(1)}"
+    return None
+
+
+def url_key(url):
+    video_id = canonical_id(url)
+    if video_id:
+        return f"url:{video_id}"
+
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    query = urlencode([(k, v) for k, v in parse_qsl(parts.query) if k in _KEPT_QUERY_PARAMS])
+    path = parts.path.rstrip("/")
+    return f"url:{host}{path}" + (f"?{query}" if query else "")
+
+
+@contextmanager
+def download_dir(reserved_bytes=0):
+    # Downloads são feitos num diretório temporário dentro do cache e depois
+    # movidos com put(); o que sobrar é apagado na saída, junto com a reserva
+    # feita com reserve(). O dono no nome (pid e token da execução, ver
+    # helpers.process_owner) permite achar diretórios órfãos.
+    root = os.path.join(CACHE_DIR, "tmp")
+    os.makedirs(root, exist_ok=True)
+    path = tempfile.mkdtemp(prefix=f"{process_owner()}-", dir=root)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+        unreserve(reserved_bytes)
+
+
+def reserve(nbytes):
+    # Back-pressure: bloqueia até o download caber na cota (blobs + downloads
+    # em andamento), liberando blobs antigos se preciso. Retorna o valor a
+    # passar para download_dir()/unreserve().
+    global _reserved
+    nbytes = min(max(int(nbytes or 0), 0), MAX_CACHE_BYTES)
+    with _space:
+        while True:
+            with _lock:
+                conn = _conn()
+                _evict(conn, MAX_CACHE_BYTES - _reserved - nbytes)
+                used = _total_size(conn)
+                busy = _reserved > 0 or bool(_pinned)
+            # Sem downloads nem blobs em uso não há o que esperar: segue mesmo acima da cota
+            if used + _reserved + nbytes <= MAX_CACHE_BYTES or not busy:
+                break
+            _space.wait(timeout=5)
+        _reserved += nbytes
+    return nbytes
+
+
+def unreserve(nbytes):
+    global _reserved
+    if not nbytes:
+        return
+    with _space:
+        _reserved -= nbytes
+        _space.notify_all()
+
+
+def pin(path):
+    # Protege o arquivo do LRU até unpin(); False se ele já não existe
+    with _lock:
+        if not path or not os.path.exists(path):
+            return False
+        _pinned[path] = _pinned.get(path, 0) + 1
+        return True
+
+
+def unpin(path):
+    with _lock:
+        count = _pinned.get(path, 0) - 1
+        if count > 0:
+            _pinned[path] = count
+        else:
+            _pinned.pop(path, None)
+    with _space:
+        _space.notify_all()
+
+
+def discard(keys):
+    # Remove as chaves e apaga os blobs que ficaram sem nenhuma chave
+    with _lock:
+        conn = _conn()
+        for key in keys:
+            row = conn.execute(
+                "SELECT content_hash, path FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                continue
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            still_used = conn.execute(
+                "SELECT 1 FROM entries WHERE content_hash = ?", (row["content_hash"],)
+            ).fetchone()
+            if not still_used:
+                _remove(row["path"])
+        conn.commit()
+    with _space:
+        _space.notify_all()
+
+
+def cleanup_workspaces():
+    # Na inicialização: apaga diretórios de download de processos que já
+    # morreram e blobs que não estão em entries (queda entre move e INSERT)
+    root = os.path.join(CACHE_DIR, "tmp")
+    if os.path.isdir(root):
+        for name in os.listdir(root):
+            owner = "-".join(name.split("-")[:2])
+            if not owner_alive(owner):
+                shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+    with _lock:
+        conn = _conn()
+        known = {row["path"] for row in conn.execute("SELECT path FROM entries")}
+        blobs_dir = os.path.join(CACHE_DIR, "blobs")
+        for dirpath, _, filenames in os.walk(blobs_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if path not in known:
+                    _remove(path)
+        for path in known:
+            if not os.path.exists(path):
+                conn.execute("DELETE FROM entries WHERE path = ?", (path,))
+        conn.commit()
+
+
+def get(key, pin=False):
+    # pin=True prende o arquivo no mesmo passo (ver pin()), sem janela para o
+    # LRU de outra thread removê-lo antes
+    with _lock:
+        conn = _conn()
+        row = conn.execute("SELECT path FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if not os.path.exists(row["path"]):
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            conn.commit()
+            return None
+        conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+        conn.commit()
+        if pin:
+            _pinned[row["path"]] = _pinned.get(row["path"], 0) + 1
+        return row["path"]
+
+
+def put(key, src_path, pin=False):
+    content_hash = file_hash(src_path)
+    ext = os.path.splitext(src_path)[1]
+    blob_path = os.path.join(CACHE_DIR, "blobs", content_hash[:2], content_hash + ext)
+
+    with _lock:
+        # Conteúdo idêntico (o mesmo vídeo vindo de chaves diferentes) é guardado uma vez só
+        if os.path.exists(blob_path):
+            os.remove(src_path)
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            shutil.move(src_path, blob_path)
+
+        conn = _conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO entries (key, content_hash, path, size, last_access) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (key, content_hash, blob_path, os.path.getsize(blob_path), time.time()),
+        )
+        conn.commit()
+        if pin:
+            _pinned[blob_path] = _pinned.get(blob_path, 0) + 1
+        _evict(conn)
+    return blob_path
+
+
+def _evict(conn, limit=None):
+    # LRU por arquivo: o último acesso de um blob é o mais recente entre suas chaves
+    if limit is None:
+        limit = MAX_CACHE_BYTES
+    blobs = conn.execute(
+        "SELECT content_hash, path, MAX(size) AS size, MAX(last_access) AS last_access "
+        "FROM entries GROUP BY content_hash ORDER BY last_access ASC"
+    ).fetchall()
+    total = sum(b["size"] for b in blobs)
+    for blob in blobs:
+        if total <= limit:
+            break
+        if blob["path"] in _pinned:
+            continue
+        conn.execute("DELETE FROM entries WHERE content_hash = ?", (blob["content_hash"],))
+        _remove(blob["path"])
+        total -= blob["size"]
+    conn.commit()
+
+
+def _total_size(conn):
+    return conn.execute(
+        "SELECT COALESCE(SUM(size), 0) FROM "
+        "(SELECT MAX(size) AS size FROM entries GROUP BY content_hash)"
+    ).fetchone()[0]
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning("Erro ao remover %s do cache: %s", path, e)
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
@@ -0,0 +1,63 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RTF = 0.3
+DOWNLOAD_BYTES_PER_SECOND = 2 * 1024 * 1024
+UNKNOWN_DURATION_SECONDS = 120
+
+
+def estimate_seconds(item, rtf=DEFAULT_RTF, max_audio_seconds=0):
+    duration = item.get("duration") or UNKNOWN_DURATION_SECONDS
+    if max_audio_seconds:
+        duration = min(duration, max_audio_seconds)
+    return duration * rtf + (item.get("size") or 0) / DOWNLOAD_BYTES_PER_SECOND
+
+
+def plan_media(items, time_budget=None, byte_budget=None, max_bytes=None, rtf=None,
+               max_audio_seconds=0):
+    # Decide o que processar antes de baixar qualquer coisa: descarta links mortos
+    # e vídeos grandes demais, ordena priorizando itens recentes e curtos e corta
+    # o que não cabe no orçamento de tempo (segundos) e de download (bytes)
+    rtf = rtf or DEFAULT_RTF
+    selected = []
+    skipped = []
+
+    candidates = []
+    for item in items:
+        if item.get("unavailable"):
+            skipped.append((item, "indisponível"))
+        elif max_bytes and (item.get("size") or 0) > max_bytes:
+            skipped.append((item, "grande demais"))
+        else:
+            candidates.append(item)
+
+    # Soma das posições no ranking por data (mais recente primeiro) e por duração
+    # (mais curto primeiro)
+    rank = {id(item): 0 for item in candidates}
+    by_date = sorted(candidates, key=lambda i: i.get("date", ""), reverse=True)
+    by_duration = sorted(candidates, key=lambda i: i.get("duration") or UNKNOWN_DURATION_SECONDS)
+    for position, item in enumerate(by_date):
+        rank[id(item)] += position
+    for position, item in enumerate(by_duration):
+        rank[id(item)] += position
+    ordered = sorted(candidates, key=lambda i: rank[id(i)])
+
+    spent_seconds = 0
+    spent_bytes = 0
+    for item in ordered:
+        cost_seconds = estimate_seconds(item, rtf, max_audio_seconds)
+        cost_bytes = item.get("size") or 0
+        if time_budget and spent_seconds + cost_seconds > time_budget:
+            skipped.append((item, "fora do orçamento de tempo"))
+            continue
+        if byte_budget and spent_bytes + cost_bytes > byte_budget:
+            skipped.append((item, "fora do orçamento de download"))
+            continue
+        selected.append(item)
+        spent_seconds += cost_seconds
+        spent_bytes += cost_bytes
+
+    for item, reason in skipped:
+        logger.info("Pulando %s: %s", item.get("origin"), reason)
+    return selected, skipped
@@ -1,9 +1,33 @@
 import re
 import os
+import asyncio
+import queue
+import threading
 import logging
 import subprocess
-import tempfile
 import shlex
+import wave
+import hashlib
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+
+import numpy as np
+
+import link_index
+import work_queue
+import media_cache
+import transcript_cache
+from media_planner import plan_media
+from transcription import (
+    BATCH_AUDIO_SECONDS,
+    SAMPLE_RATE,
+    SHORT_AUDIO_SECONDS,
+    WHISPER_SETTINGS,
+    cache_settings,
+    get_transcription_stats,
+    transcribe_audio,
+    transcribe_batch,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -11,40 +35,49 @@ MAX_VIDEO_SIZE_MB = 100
 DOWNLOAD_TIMEOUT = 60
 
 VIDEO_URL_PATTERNS = [
-    r'https?://(?:www\.)?instagram\.com/reel/[\w-]+',
-    r'https?://(?:www\.)?youtube\.com/watch\?v=[\w-]+',
-    r'https?://(?:www\.)?youtube\.com/shorts/[\w-]+',
+    r'https?://(?:www\.)?instagram\.com/(?:[\w.]+/)?(?:reels?|p|tv)/[\w-]+',
+    r'https?://(?:www\.|m\.)?youtube\.com/watch\?(?:[^\s#]*&)?v=[\w-]+',
+    r'https?://(?:www\.|m\.)?youtube\.com/(?:shorts|live)/[\w-]+',
     r'https?://youtu\.be/[\w-]+',
-    r'https?://(?:www\.)?tiktok\.com/@[\w.-]+/video/\d+',
-    r'https?://(?:vm\.)?tiktok\.com/[\w-]+',
-    r'https?://(?:www\.)?x\.com/\w+/status/\d+',
-    r'https?://(?:www\.)?twitter\.com/\w+/status/\d+',
+    r'https?://(?:www\.|m\.)?tiktok\.com/@[\w.-]+/video/\d+',
+    r'https?://(?:vm|vt)\.tiktok\.com/[\w-]+',
+    r'https?://(?:www\.|mobile\.)?x\.com/\w+/status/\d+',
+    r'https?://(?:www\.|mobile\.)?twitter\.com/\w+/status/\d+',
 ]
 
 COMBINED_PATTERN = re.compile('|'.join(VIDEO_URL_PATTERNS), re.IGNORECASE)
 
-_whisper_model = None
+CPU_COUNT = os.cpu_count() or 2
 
+# Estágios do pipeline de mídia: downloads são limitados pela rede e a extração
+# roda em processos ffmpeg; a transcrição usa WHISPER_SETTINGS["num_workers"]
+DOWNLOAD_WORKERS = int(os.getenv("MEDIA_DOWNLOAD_WORKERS", "4"))
+EXTRACT_WORKERS = int(os.getenv("MEDIA_EXTRACT_WORKERS", str(max(1, CPU_COUNT // 2))))
+STAGE_QUEUE_SIZE = 4
+METADATA_WORKERS = int(os.getenv("MEDIA_METADATA_WORKERS", "8"))
+SHORT_MEDIA_KINDS = ("voice", "video_note")
 
-def _get_whisper_model(model_size="base"):
-    global _whisper_model
-    if _whisper_model is None:
-        from faster_whisper import WhisperModel
-        _whisper_model = WhisperModel(model_size, device="cpu", compute_type="int8")
-    return _whisper_model
+# Com TRANSCRIPTION_WORKERS=1 a transcrição sai deste processo: os arquivos vão
+# para a fila em ANALYZER_DATA_DIR e são transcritos por worker.py
+USE_TRANSCRIPTION_WORKERS = os.getenv("TRANSCRIPTION_WORKERS", "0") != "0"
+QUEUE_POLL_SECONDS = 1
 
 
 def extract_video_urls(messages):
+    # Um resultado por vídeo: variações do mesmo link (youtu.be/X, watch?v=X&t=10,
+    # shorts/X, parâmetros de rastreio) contam uma vez só
     results = []
-    seen_urls = set()
+    seen_keys = set()
     for msg in messages:
         text = msg.get("text", "")
         urls = COMBINED_PATTERN.findall(text)
         for url in urls:
-            if url not in seen_urls:
-                seen_urls.add(url)
+            key = media_cache.url_key(url)
+            if key not in seen_keys:
+                seen_keys.add(key)
                 results.append({
                     "url": url,
+                    "cache_key": key,
                     "date": msg.get("date", ""),
                     "text": text,
                 })
@@ -58,45 +91,117 @@ def _is_safe_url(url):
     return not any(c in url for c in dangerous)
 
 
-def download_video(url, output_dir):
+def download_video(url, output_dir=None, expected_bytes=None, pin=False, info=None):
+    # pin=True devolve o arquivo já preso no cache (media_cache.pin); info é o
+    # resultado de probe_video, que evita extrair os metadados de novo
     if not _is_safe_url(url):
         logger.warning("URL rejeitada por segurança: %s", url)
         return None
 
+    cache_key = media_cache.url_key(url)
+    cached = media_cache.get(cache_key, pin=pin)
+    if cached:
+        return cached
+
+    # O arquivo baixado vai para o cache; o diretório é só área de trabalho,
+    # aberto só quando o tamanho esperado cabe na cota do cache
+    if output_dir is None:
+        reserved = media_cache.reserve(expected_bytes or MAX_VIDEO_SIZE_MB * 1024 * 1024)
+        with media_cache.download_dir(reserved) as tmp_dir:
+            return download_video(url, tmp_dir, pin=pin, info=info)
+
     try:
-        output_template = os.path.join(output_dir, "%(id)s.%(ext)s")
-        cmd = [
-            "yt-dlp",
-            "--no-playlist",
-            "--max-filesize", f"{MAX_VIDEO_SIZE_MB}M",
-            "--socket-timeout", str(DOWNLOAD_TIMEOUT),
-            "--output", output_template,
-            "--quiet",
-            "--no-warnings",
-            url,
-        ]
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=DOWNLOAD_TIMEOUT + 30,
-        )
-        if result.returncode != 0:
-            logger.warning("yt-dlp falhou para %s: %s", url, result.stderr[:200])
+        ydl = _get_downloader()
+        ydl.params["paths"] = {"home": output_dir}
+        _downloader_state.filepath = None
+        info = _download_info(ydl, url, info)
+
+        path = _downloader_state.filepath
+        if not path and info:
+            downloads = info.get("requested_downloads") or []
+            path = downloads[0].get("filepath") if downloads else None
+        if not path or not os.path.exists(path):
+            logger.warning("yt-dlp não gerou arquivo para %s (limite de tamanho?)", url)
             return None
+        return media_cache.put(cache_key, path, pin=pin)
 
-        files = os.listdir(output_dir)
-        video_files = [f for f in files if not f.endswith((".wav", ".mp3", ".part"))]
-        if video_files:
-            return os.path.join(output_dir, video_files[-1])
+    except Exception as e:
+        logger.warning("Erro ao baixar %s: %s", url, str(e)[:200])
         return None
 
-    except subprocess.TimeoutExpired:
-        logger.warning("Timeout ao baixar: %s", url)
-        return None
+
+def _download_info(ydl, url, info):
+    if info:
+        try:
+            return ydl.process_ie_result(info, download=True)
+        except Exception as e:
+            # Ex.: as URLs dos formatos expiraram desde a verificação
+            logger.info(
+                "Download com os metadados da verificação falhou para %s: %s", url, str(e)[:200]
+            )
+            _downloader_state.filepath = None
+    return ydl.extract_info(url, download=True)
+
+
+_downloader_state = threading.local()
+
+# Mensagens do yt-dlp de links que não vão voltar a funcionar
+_PERMANENT_ERROR = re.compile(
+    r"unsupported url|private|removed|deleted|(?<!service )unavailable|does not exist|not found"
+    r"|no video formats|HTTP Error (?:404|410)",
+    re.IGNORECASE,
+)
+
+
+def _get_downloader():
+    # Um YoutubeDL por thread (a instância não é thread-safe), reaproveitado
+    # entre URLs para não recriar extractors a cada download
+    ydl = getattr(_downloader_state, "ydl", None)
+    if ydl is None:
+        from yt_dlp import YoutubeDL
+        ydl = YoutubeDL({
+            # Só o áudio é usado: menor formato só-áudio, senão o menor formato completo
+            "format": "worstaudio/worst",
+            "outtmpl": "%(id)s.%(ext)s",
+            "noplaylist": True,
+            "max_filesize": MAX_VIDEO_SIZE_MB * 1024 * 1024,
+            "socket_timeout": DOWNLOAD_TIMEOUT,
+            "quiet": True,
+            "no_warnings": True,
+            "noprogress": True,
+        })
+        ydl.add_postprocessor_hook(_on_postprocessed)
+        _downloader_state.ydl = ydl
+    return ydl
+
+
+def _on_postprocessed(d):
+    # Caminho final exato do arquivo, depois de todos os pós-processamentos
+    if d.get("status") == "finished":
+        _downloader_state.filepath = d.get("info_dict", {}).get("filepath")
+
+
+def probe_video(url):
+    # Metadados sem baixar nada: duração, tamanho do formato que seria baixado
+    # e se o link ainda está disponível. "transient" marca falhas que podem
+    # passar sozinhas (rede, limite de requisições, transmissão ao vivo). O
+    # info extraído segue com o item para download_video não extrair de novo
+    if not _is_safe_url(url):
+        return {"unavailable": True}
+    try:
+        info = _get_downloader().extract_info(url, download=False)
     except Exception as e:
-        logger.warning("Erro ao baixar %s: %s", url, e)
-        return None
+        logger.info("Link indisponível %s: %s", url, str(e)[:200])
+        return {"unavailable": True, "transient": not _PERMANENT_ERROR.search(str(e))}
+    if not info:
+        return {"unavailable": True}
+    if info.get("is_live"):
+        return {"unavailable": True, "transient": True}
+    return {
+        "duration": info.get("duration"),
+        "size": info.get("filesize") or info.get("filesize_approx"),
+        "info": info,
+    }
 
 
 def extract_audio(video_path, output_dir):
@@ -135,89 +240,502 @@ def extract_audio(video_path, output_dir):
         return None
 
 
-def transcribe_audio(audio_path, model_size="base"):
+def decode_audio(media_path):
+    # Decodifica direto para um array float32 (16 kHz mono) em memória: o ffmpeg
+    # escreve PCM cru no stdout em vez de gravar um WAV em disco
     try:
-        model = _get_whisper_model(model_size)
-        segments, info = model.transcribe(audio_path, language="pt")
-        text = " ".join(segment.text.strip() for segment in segments)
-        return text if text.strip() else ""
+        samples = _read_pcm_wav(media_path)
+        if samples is not None:
+            return samples
+
+        cmd = [
+            "ffmpeg",
+            "-nostdin",
+            "-loglevel", "error",
+            "-i", media_path,
+            "-vn",
+            "-f", "s16le",
+            "-acodec", "pcm_s16le",
+            "-ar", str(SAMPLE_RATE),
+            "-ac", "1",
+            "pipe:1",
+        ]
+        result = subprocess.run(cmd, capture_output=True, timeout=60)
+        if result.returncode != 0:
+            logger.warning(
+                "ffmpeg falhou para %s: %s", media_path, result.stderr.decode(errors="replace")[:200]
+            )
+            return None
+        if not result.stdout:
+            return None
+        return np.frombuffer(result.stdout, np.int16).astype(np.float32) / 32768.0
+
+    except subprocess.TimeoutExpired:
+        logger.warning("Timeout ao decodificar áudio: %s", media_path)
+        return None
     except Exception as e:
-        logger.warning("Erro ao transcrever %s: %s", audio_path, e)
-        return ""
+        logger.warning("Erro ao decodificar áudio de %s: %s", media_path, e)
+        return None
+
+
+def _read_pcm_wav(path):
+    # WAVs gerados por extract_audio já estão no formato certo: lê sem ffmpeg
+    if not path.endswith(".wav"):
+        return None
+    try:
+        with wave.open(path, "rb") as wav:
+            if (wav.getframerate(), wav.getnchannels(), wav.getsampwidth()) != (SAMPLE_RATE, 1, 2):
+                return None
+            frames = wav.readframes(wav.getnframes())
+    except (wave.Error, EOFError):
+        return None
+    return np.frombuffer(frames, np.int16).astype(np.float32) / 32768.0
+
+
+async def extract_audio_from_stream(chunks, audio_path):
+    # Mesmo resultado de extract_audio, mas lendo o vídeo de um async iterator
+    # de bytes pelo stdin do ffmpeg, sem arquivo de vídeo intermediário
+    proc = await asyncio.create_subprocess_exec(
+        "ffmpeg",
+        "-loglevel", "error",
+        "-i", "pipe:0",
+        "-vn",
+        "-acodec", "pcm_s16le",
+        "-ar", "16000",
+        "-ac", "1",
+        "-y",
+        audio_path,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stderr_task = asyncio.ensure_future(proc.stderr.read())
+    try:
+        try:
+            async for chunk in chunks:
+                proc.stdin.write(chunk)
+                await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg desistiu antes do fim (formato não suportado via pipe);
+            # o código de saída abaixo diz o que aconteceu
+            pass
+        finally:
+            proc.stdin.close()
+    except BaseException:
+        # Falha na origem dos bytes: o áudio estaria truncado, então descarta
+        proc.kill()
+        await proc.wait()
+        stderr_task.cancel()
+        raise
+
+    stderr = await stderr_task
+    if await proc.wait() != 0:
+        logger.warning("ffmpeg (stream) falhou para %s: %s", audio_path, stderr.decode(errors="replace").strip()[:200])
+        return None
 
+    if os.path.exists(audio_path) and os.path.getsize(audio_path) > 0:
+        return audio_path
+    return None
 
-def process_all_media(messages, telegram_media_files=None, progress_callback=None):
+
+def process_all_media(messages, telegram_media_files=None, progress_callback=None,
+                      time_budget=None, byte_budget=None):
     if telegram_media_files is None:
         telegram_media_files = []
 
-    video_urls = extract_video_urls(messages)
-    total_items = len(video_urls) + len(telegram_media_files)
-
-    if total_items == 0:
+    items = [
+        {
+            "source": "link",
+            "url": v["url"],
+            "origin": v["url"],
+            "date": v["date"],
+            "cache_key": v["cache_key"],
+        }
+        for v in extract_video_urls(messages)
+    ] + [
+        {
+            "source": "telegram",
+            "path": m.get("path"),
+            "audio_path": m.get("audio_path"),
+            "origin": m.get("filename", "vídeo do chat"),
+            "cache_key": m.get("cache_key"),
+            "date": m.get("date", ""),
+            "duration": m.get("duration"),
+            "kind": m.get("kind", "video"),
+        }
+        for m in telegram_media_files
+    ]
+    if not items:
         return []
 
-    transcriptions = []
-    processed = 0
+    for index, item in enumerate(items):
+        item["index"] = index
+
+    # Já transcritos antes (mesmo link ou mesmo vídeo do Telegram): nem baixa.
+    # Links que falharam recentemente também não são tentados de novo.
+    failed = link_index.get_statuses([i["cache_key"] for i in items if i["source"] == "link"])
+    results = {}
+    pending = []
+    for item in items:
+        if _cached_transcription(item, [item.get("cache_key")]) is not None:
+            transcript_cache.record(hit=True)
+            results[item["index"]] = item["transcription"] or None
+        elif item["cache_key"] not in failed:
+            pending.append(item)
+
+    _prefetch_metadata([i for i in pending if i["source"] == "link"], progress_callback)
+    stats = get_transcription_stats()
+    selected, skipped = plan_media(
+        pending,
+        time_budget=time_budget,
+        byte_budget=byte_budget,
+        max_bytes=MAX_VIDEO_SIZE_MB * 1024 * 1024,
+        rtf=stats["rtf"],
+        max_audio_seconds=WHISPER_SETTINGS["max_audio_seconds"],
+    )
+    for item, reason in skipped:
+        if item["source"] == "link" and reason in ("indisponível", "grande demais"):
+            status = link_index.TRANSIENT if item.get("transient") else link_index.FAILED
+            link_index.mark(item["cache_key"], item["url"], status, reason)
+    if skipped and progress_callback:
+        progress_callback(0, len(items), f"{len(skipped)} vídeos ignorados antes do download")
+
+    short = [
+        item for item in selected
+        if item.get("kind") in SHORT_MEDIA_KINDS
+        and (item.get("duration") or SHORT_AUDIO_SECONDS + 1) <= SHORT_AUDIO_SECONDS
+    ]
+    results.update(_transcribe_short_media(short, progress_callback))
+    rest = [i for i in selected if i not in short]
+    if USE_TRANSCRIPTION_WORKERS:
+        results.update(_run_with_workers(rest, progress_callback))
+    else:
+        results.update(_run_media_pipeline(rest, progress_callback))
+
+    return [
+        {
+            "source": item["source"],
+            "origin": item["origin"],
+            "transcription": results[item["index"]],
+            "date": item["date"],
+            "kind": item.get("kind", "video"),
+        }
+        for item in items
+        if results.get(item["index"])
+    ]
+
+
+def _transcribe_short_media(items, progress_callback):
+    # Notas de voz e vídeos redondos: decodificados no próprio processo e
+    # transcritos em lotes, sem um ffmpeg nem um passe do modelo por arquivo
+    results = {}
+    clips = []
+    for done, item in enumerate(items, 1):
+        if progress_callback:
+            progress_callback(0, len(items), f"Decodificando áudios curtos ({done}/{len(items)})...")
+        source = item.get("audio_path") or item.get("path")
+        samples = _decode_short_audio(source) if source and os.path.exists(source) else None
+        if samples is None or not len(samples):
+            logger.info("Pulando áudio (decodificação falhou): %s", item["origin"])
+            continue
+        item["audio_key"] = f"pcm:{hashlib.sha256(samples.tobytes()).hexdigest()}"
+        if _cached_transcription(item, [item["audio_key"]]) is not None:
+            transcript_cache.record(hit=True)
+            transcript_cache.put([item.get("cache_key")], *cache_settings(), item["transcription"])
+            _discard_media(item)
+            results[item["index"]] = item["transcription"] or None
+            continue
+        clips.append((item, samples))
+
+    batches = []
+    for item, samples in clips:
+        seconds = len(samples) / SAMPLE_RATE
+        if not batches or batches[-1][0] + seconds > BATCH_AUDIO_SECONDS:
+            batches.append([0, []])
+        batches[-1][0] += seconds
+        batches[-1][1].append((item, samples))
+
+    done = 0
+
+    def report_queue(position):
+        if progress_callback:
+            progress_callback(done, len(clips), f"Na fila para transcrição (posição {position})...")
+
+    for _, batch in batches:
+        if progress_callback:
+            progress_callback(done, len(clips), f"Transcrevendo {len(batch)} áudios curtos...")
+        texts = transcribe_batch([samples for _, samples in batch], on_wait=report_queue)
+        done += len(batch)
+        if texts is None:
+            continue
+        for (item, _), text in zip(batch, texts):
+            transcript_cache.record(hit=False)
+            transcript_cache.put([item.get("cache_key"), item["audio_key"]], *cache_settings(), text)
+            _discard_media(item)
+            results[item["index"]] = text or None
+    return results
+
+
+def _decode_short_audio(path):
+    # PyAV (que já vem com o faster-whisper) decodifica Opus/MP4 curtos sem
+    # abrir um processo ffmpeg; o ffmpeg fica de reserva
+    try:
+        from faster_whisper import decode_audio as decode_in_process
+        return decode_in_process(path, sampling_rate=SAMPLE_RATE)
+    except Exception as e:
+        logger.info("Decodificação em processo falhou para %s: %s", path, e)
+        return decode_audio(path)
+
 
-    with tempfile.TemporaryDirectory(prefix="tg_media_") as tmp_dir:
-        # Processar links de vídeo externos
-        for item in video_urls:
-            processed += 1
+def _prefetch_metadata(items, progress_callback):
+    if not items:
+        return
+    with ThreadPoolExecutor(max_workers=METADATA_WORKERS) as executor:
+        futures = {executor.submit(probe_video, item["url"]): item for item in items}
+        for done, future in enumerate(as_completed(futures), 1):
+            futures[future].update(future.result())
             if progress_callback:
-                progress_callback(processed, total_items, f"Baixando: {item['url'][:50]}...")
+                progress_callback(0, len(items), f"Verificando links ({done}/{len(items)})...")
+
+
+_STOP = object()
+
+
+def _run_media_pipeline(items, progress_callback):
+    # Produtor/consumidor em três estágios com filas limitadas: enquanto um
+    # vídeo é transcrito, os próximos já estão sendo baixados e decodificados.
+    # Só a thread chamadora chama progress_callback (exigência do Streamlit).
+    if not items:
+        return {}
+    events = queue.Queue()
+    cancelled = threading.Event()
+    download_q = queue.Queue()
+    extract_q = queue.Queue(maxsize=STAGE_QUEUE_SIZE)
+    transcribe_q = queue.Queue(maxsize=STAGE_QUEUE_SIZE)
+
+    stages = [
+        (_download_stage, download_q, extract_q, DOWNLOAD_WORKERS),
+        (_extract_stage, extract_q, transcribe_q, EXTRACT_WORKERS),
+        (_transcribe_stage, transcribe_q, None, max(1, WHISPER_SETTINGS["num_workers"])),
+    ]
+    threads = []
+    for i, (func, inbox, outbox, workers) in enumerate(stages):
+        next_workers = stages[i + 1][3] if i + 1 < len(stages) else 0
+        remaining = [workers]
+        lock = threading.Lock()
+        for _ in range(workers):
+            t = threading.Thread(
+                target=_stage_worker,
+                args=(func, inbox, outbox, next_workers, remaining, lock, events, cancelled),
+                daemon=True,
+            )
+            t.start()
+            threads.append(t)
+
+    for item in items:
+        download_q.put(item)
+
+    results = {}
+    done = 0
+    try:
+        while done < len(items):
+            kind, item, payload = events.get()
+            if kind == "done":
+                done += 1
+                results[item["index"]] = payload
+            elif progress_callback:
+                progress_callback(done, len(items), payload)
+        if progress_callback:
+            progress_callback(done, len(items), "Processamento concluído")
+    finally:
+        cancelled.set()
+        for _ in range(DOWNLOAD_WORKERS):
+            download_q.put(_STOP)
+        if done == len(items):
+            for t in threads:
+                t.join()
 
-            video_dir = os.path.join(tmp_dir, f"video_{processed}")
-            os.makedirs(video_dir, exist_ok=True)
+    return results
 
-            video_path = download_video(item["url"], video_dir)
-            if not video_path:
-                logger.info("Pulando vídeo (download falhou): %s", item["url"])
-                continue
 
-            audio_path = extract_audio(video_path, video_dir)
-            if not audio_path:
-                logger.info("Pulando vídeo (extração de áudio falhou): %s", item["url"])
+def _run_with_workers(items, progress_callback):
+    # Baixa aqui, enfileira o arquivo e espera os workers devolverem o texto.
+    # Os resultados são consumidos enquanto os downloads continuam: cada
+    # transcrição pronta libera seu arquivo, e só assim os downloads que
+    # esperam espaço na cota do cache (media_cache.reserve) podem seguir
+    if not items:
+        return {}
+    events = queue.Queue()
+    waiting = {}
+    settings = dict(zip(("model_size", "language", "compute_type"), cache_settings()))
+
+    def relay_events():
+        while not events.empty():
+            _, _, message = events.get()
+            if progress_callback:
+                progress_callback(len(results), len(items), message)
+
+    def enqueue_downloaded(future, item):
+        try:
+            ready = future.result()
+        except Exception as e:
+            logger.warning("Erro ao baixar %s: %s", item["origin"], e)
+            ready = None
+        source = ready and (item.get("audio_path") or item.get("path"))
+        if not source or not os.path.exists(source):
+            _release_item(item)
+            return
+        task_id = work_queue.enqueue(item["cache_key"], os.path.abspath(source), settings)
+        waiting.setdefault(task_id, []).append(item)
+
+    def collect_finished():
+        for task_id, task in work_queue.get_results(waiting).items():
+            if task["status"] not in work_queue.FINISHED:
                 continue
+            for item in waiting.pop(task_id):
+                text = task["result"] if task["status"] == work_queue.DONE else None
+                if text is None:
+                    logger.info("Worker não transcreveu %s: %s", item["origin"], task["error"])
+                else:
+                    transcript_cache.record(hit=False)
+                    transcript_cache.put([item["cache_key"]], *cache_settings(), text)
+                    _discard_media(item)
+                _release_item(item)
+                results[item["index"]] = text or None
+
+    results = {}
+    executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS)
+    try:
+        downloads = {executor.submit(_download_stage, item, events): item for item in items}
+        while downloads or waiting:
+            finished = set()
+            if downloads:
+                finished, _ = wait(downloads, timeout=QUEUE_POLL_SECONDS, return_when=FIRST_COMPLETED)
+            for future in finished:
+                enqueue_downloaded(future, downloads.pop(future))
+            relay_events()
+            collect_finished()
+            if waiting and not finished:
+                if progress_callback:
+                    progress_callback(
+                        len(results), len(items),
+                        f"Aguardando workers de transcrição ({work_queue.pending_count()} na fila)...",
+                    )
+                if not downloads:
+                    time.sleep(QUEUE_POLL_SECONDS)
+    finally:
+        # Cancelado (ex.: job interrompido): tira da fila o que ainda não
+        # começou e solta os arquivos antes de esperar os downloads em
+        # andamento, que podem estar esperando justamente esse espaço
+        work_queue.cancel(list(waiting))
+        for item in items:
+            _release_item(item)
+        executor.shutdown(wait=True, cancel_futures=True)
+        for item in items:
+            _release_item(item)
+    return results
 
-            if progress_callback:
-                progress_callback(processed, total_items, f"Transcrevendo: {item['url'][:50]}...")
-
-            text = transcribe_audio(audio_path)
-            if text:
-                transcriptions.append({
-                    "source": "link",
-                    "origin": item["url"],
-                    "transcription": text,
-                    "date": item["date"],
-                })
 
-        # Processar vídeos baixados diretamente do Telegram
-        for media in telegram_media_files:
-            processed += 1
-            if progress_callback:
-                progress_callback(processed, total_items, "Processando vídeo do Telegram...")
+def _stage_worker(func, inbox, outbox, next_workers, remaining, lock, events, cancelled):
+    while True:
+        item = inbox.get()
+        if item is _STOP:
+            break
+        result = None
+        if not cancelled.is_set():
+            try:
+                result = func(item, events)
+            except Exception as e:
+                logger.warning("Erro ao processar %s: %s", item["origin"], e)
+
+        if outbox is None or result is None:
+            _release_item(item)
+            events.put(("done", item, result))
+        else:
+            outbox.put(result)
+
+    # O último worker de um estágio encerra os workers do estágio seguinte
+    with lock:
+        remaining[0] -= 1
+        last = remaining[0] == 0
+    if last and outbox is not None:
+        for _ in range(next_workers):
+            outbox.put(_STOP)
+
+
+def _cached_transcription(item, keys):
+    text = transcript_cache.get(keys, *cache_settings())
+    if text is None:
+        return None
+    item["transcription"] = text
+    return item
 
-            video_path = media.get("path")
-            if not video_path or not os.path.exists(video_path):
-                continue
 
-            audio_dir = os.path.join(tmp_dir, f"tg_audio_{processed}")
-            os.makedirs(audio_dir, exist_ok=True)
+def _release_item(item):
+    # Fim do item (transcrito, falhou ou cancelado): o arquivo volta a poder
+    # ser removido pelo LRU do cache
+    for path in item.pop("pinned", []):
+        media_cache.unpin(path)
 
-            audio_path = extract_audio(video_path, audio_dir)
-            if not audio_path:
-                continue
 
-            if progress_callback:
-                progress_callback(processed, total_items, "Transcrevendo vídeo do Telegram...")
-
-            text = transcribe_audio(audio_path)
-            if text:
-                transcriptions.append({
-                    "source": "telegram",
-                    "origin": media.get("filename", "vídeo do chat"),
-                    "transcription": text,
-                    "date": media.get("date", ""),
-                })
+def _download_stage(item, events):
+    if item["source"] == "link":
+        events.put(("progress", item, f"Baixando: {item['url'][:50]}..."))
+        # Espera espaço na cota do cache antes de baixar (back-pressure)
+        item["path"] = download_video(
+            item["url"], expected_bytes=item.get("size"), pin=True, info=item.pop("info", None)
+        )
+        if not item["path"]:
+            logger.info("Pulando vídeo (download falhou): %s", item["url"])
+            link_index.mark(item["cache_key"], item["url"], link_index.TRANSIENT, "download falhou")
+            return None
+        # Já vem preso do download: outro reserve() não pode removê-lo antes
+        item["pinned"] = [item["path"]]
+        return item
+
+    item["pinned"] = [p for p in (item.get("audio_path"), item.get("path")) if media_cache.pin(p)]
+    return item
+
+
+def _extract_stage(item, events):
+    # Áudio já extraído durante o download (streaming do Telegram para o ffmpeg)
+    source = item.get("audio_path")
+    if not source or not os.path.exists(source):
+        source = item.get("path")
+    if not source or not os.path.exists(source):
+        return None
+
+    events.put(("progress", item, f"Extraindo áudio: {item['origin'][:50]}..."))
+    item["samples"] = decode_audio(source)
+    if item["samples"] is None or not len(item["samples"]):
+        logger.info("Pulando vídeo (extração de áudio falhou): %s", item["origin"])
+        return None
+    return item
+
+
+def _transcribe_stage(item, events):
+    samples = item.pop("samples")
+    # Conteúdo idêntico pode chegar por chaves diferentes (repost, outro link)
+    audio_key = f"pcm:{hashlib.sha256(samples.tobytes()).hexdigest()}"
+    if _cached_transcription(item, [audio_key]) is not None:
+        transcript_cache.record(hit=True)
+        transcript_cache.put([item.get("cache_key")], *cache_settings(), item["transcription"])
+        _discard_media(item)
+        return item["transcription"] or None
+
+    transcript_cache.record(hit=False)
+    events.put(("progress", item, f"Transcrevendo: {item['origin'][:50]}..."))
+    text = transcribe_audio(samples, on_wait=lambda position: events.put(
+        ("progress", item, f"Na fila para transcrição (posição {position}): {item['origin'][:50]}")
+    ))
+    if text is None:
+        return None
+    transcript_cache.put([item.get("cache_key"), audio_key], *cache_settings(), text)
+    _discard_media(item)
+    return text or None
+
 
-    return transcriptions
+def _discard_media(item):
+    # Com a transcrição salva, o vídeo/áudio não é mais necessário em disco
+    if item.get("cache_key"):
+        media_cache.discard([item["cache_key"], f"{item['cache_key']}:audio"])
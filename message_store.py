@@ -0,0 +1,119 @@
+import json
+import threading
+from datetime import datetime
+
+import storage
+
+DB_NAME = "messages.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    sender_id INTEGER,
+    text TEXT,
+    media TEXT,
+    PRIMARY KEY (chat_id, message_id)
+);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    chat_id INTEGER PRIMARY KEY,
+    max_id INTEGER NOT NULL,
+    min_id INTEGER NOT NULL,
+    complete INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT
+);
+"""
+
+_lock = threading.Lock()
+
+
+def _conn():
+    return storage.connect(DB_NAME, _SCHEMA)
+
+
+def get_checkpoint(chat_id):
+    with _lock:
+        row = _conn().execute(
+            "SELECT max_id, min_id, complete FROM checkpoints WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+    if row is None:
+        return None
+    return {"max_id": row["max_id"], "min_id": row["min_id"], "complete": bool(row["complete"])}
+
+
+def save_checkpoint(chat_id, max_id, min_id, complete):
+    with _lock:
+        conn = _conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO checkpoints (chat_id, max_id, min_id, complete, updated_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (chat_id, max_id, min_id, int(complete), datetime.now().isoformat(timespec="seconds")),
+        )
+        conn.commit()
+
+
+def save_messages(chat_id, rows):
+    if not rows:
+        return
+    with _lock:
+        conn = _conn()
+        conn.executemany(
+            "INSERT INTO messages (chat_id, message_id, date, sender_id, text, media) "
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (chat_id, message_id) DO UPDATE SET "
+            "date = excluded.date, sender_id = excluded.sender_id, text = excluded.text, "
+            "media = COALESCE(messages.media, excluded.media)",
+            [
+                (
+                    chat_id,
+                    r["message_id"],
+                    r["date"],
+                    r.get("sender_id"),
+                    r.get("text") or "",
+                    json.dumps(r["media"]) if r.get("media") else None,
+                )
+                for r in rows
+            ],
+        )
+        conn.commit()
+
+
+def update_media(chat_id, message_id, media):
+    with _lock:
+        conn = _conn()
+        conn.execute(
+            "UPDATE messages SET media = ? WHERE chat_id = ? AND message_id = ?",
+            (json.dumps(media), chat_id, message_id),
+        )
+        conn.commit()
+
+
+def get_media(chat_id, message_id):
+    with _lock:
+        row = _conn().execute(
+            "SELECT media FROM messages WHERE chat_id = ? AND message_id = ?",
+            (chat_id, message_id),
+        ).fetchone()
+    if row is None or not row["media"]:
+        return None
+    return json.loads(row["media"])
+
+
+def load_messages(chat_id, limit, min_id=0):
+    with _lock:
+        rows = _conn().execute(
+            "SELECT message_id, date, sender_id, text, media FROM messages "
+            "WHERE chat_id = ? AND message_id >= ? ORDER BY message_id DESC LIMIT ?",
+            (chat_id, min_id, limit),
+        ).fetchall()
+    return [
+        {
+            "message_id": r["message_id"],
+            "date": r["date"],
+            "sender_id": r["sender_id"],
+            "text": r["text"],
+            "media": json.loads(r["media"]) if r["media"] else None,
+        }
+        for r in rows
+    ]
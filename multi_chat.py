@@ -0,0 +1,83 @@
+import os
+import queue
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from helpers import StatusRecorder
+from media_processing import process_all_media
+from data_preparation import prepare_analysis_windows
+from claude_analysis import analyze_with_claude
+
+logger = logging.getLogger(__name__)
+
+MAX_PARALLEL_CHATS = int(os.getenv("MAX_PARALLEL_CHATS", "4"))
+
+
+def parse_chat_list(text):
+    chats = []
+    for line in text.replace(",", "\n").splitlines():
+        chat = line.strip()
+        if chat and chat not in chats:
+            chats.append(chat)
+    return chats
+
+
+def analyze_chats(chat_data, api_key, model, process_media=True,
+                  max_workers=MAX_PARALLEL_CHATS, progress_callback=None):
+    # Cada grupo passa por process_all_media + analyze_with_claude de forma
+    # independente, em paralelo. O progresso dos workers é repassado para a
+    # thread chamadora, que é a única que pode atualizar a tela do Streamlit.
+    chats = [c for c, data in chat_data.items() if not data.get("error") and data.get("messages")]
+    results = {}
+    if not chats:
+        return results
+
+    events = queue.Queue()
+    finished = 0
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {
+            executor.submit(
+                _analyze_chat, chat, chat_data[chat], api_key, model, process_media, events.put
+            ): chat
+            for chat in chats
+        }
+        pending = set(futures)
+        while pending or not events.empty():
+            try:
+                message = events.get(timeout=0.1)
+                if progress_callback:
+                    progress_callback(finished, len(chats), message)
+            except queue.Empty:
+                pass
+
+            for future in [f for f in pending if f.done()]:
+                pending.discard(future)
+                chat = futures[future]
+                finished += 1
+                try:
+                    results[chat] = future.result()
+                except Exception as e:
+                    logger.warning("Erro ao analisar %s: %s", chat, e)
+                    results[chat] = {"transcriptions": [], "analysis": {"error": str(e)}}
+                if progress_callback:
+                    progress_callback(finished, len(chats), f"{chat}: concluído")
+
+    return results
+
+
+def _analyze_chat(chat, data, api_key, model, process_media, report):
+    transcriptions = []
+    if process_media:
+        transcriptions = process_all_media(
+            data["messages"],
+            data.get("media_files", []),
+            progress_callback=lambda current, total, message: report(
+                f"{chat}: [{current}/{total}] {message}"
+            ),
+        )
+
+    windows = prepare_analysis_windows(data["messages"], transcriptions, model=model)
+    status = StatusRecorder(on_update=lambda level, text: report(f"{chat}: {text}"))
+    analysis = analyze_with_claude(data["messages"], api_key, model, status, windows=windows)
+    return {"transcriptions": transcriptions, "analysis": analysis}
@@ -0,0 +1,30 @@
+import os
+import sqlite3
+import threading
+
+DATA_DIR = os.getenv("ANALYZER_DATA_DIR", "data")
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def data_path(*parts):
+    path = os.path.join(DATA_DIR, *parts)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    return path
+
+
+def connect(db_name, schema, journal_mode="WAL"):
+    # WAL precisa de memória compartilhada entre os processos e não funciona
+    # em diretórios de rede (NFS/SMB); bancos abertos de outras máquinas usam
+    # journal_mode="DELETE"
+    with _connections_lock:
+        conn = _connections.get(db_name)
+        if conn is None:
+            conn = sqlite3.connect(data_path(db_name), timeout=30, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute(f"PRAGMA journal_mode={journal_mode}")
+            conn.executescript(schema)
+            conn.commit()
+            _connections[db_name] = conn
+        return conn
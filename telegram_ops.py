@@ -1,25 +1,75 @@
 import os
+import asyncio
 import logging
 from contextlib import asynccontextmanager
 from telethon import TelegramClient
-from telethon.errors import SessionPasswordNeededError
+from telethon.errors import SessionPasswordNeededError, FloodWaitError
+from telethon.utils import get_peer_id
+
+import message_store
+import media_cache
+import transcript_cache
+from media_processing import extract_audio, extract_audio_from_stream
+from transcription import cache_settings
 
 logger = logging.getLogger(__name__)
 
+MEDIA_DOWNLOAD_CONCURRENCY = int(os.getenv("TG_MEDIA_DOWNLOAD_CONCURRENCY", "4"))
+MAX_FLOOD_RETRIES = 3
+FETCH_BATCH_SIZE = 100
+MAX_CONCURRENT_CHATS = int(os.getenv("TG_MAX_CONCURRENT_CHATS", "4"))
+
 
 def get_session_name(phone_number):
     clean_phone = "".join(filter(str.isdigit, phone_number))
     return f"session_{clean_phone}"
 
 
+# Clientes autorizados ficam abertos no event loop de background (ver
+# helpers.run_async_in_thread) e são reutilizados entre reruns do Streamlit.
+_clients = {}
+_client_locks = {}
+
+
+async def _get_client(session_name, api_id, api_hash):
+    lock = _client_locks.setdefault(session_name, asyncio.Lock())
+    async with lock:
+        client = _clients.get(session_name)
+        if client is not None and (client.api_id != int(api_id) or client.api_hash != api_hash):
+            await _close_client(session_name)
+            client = None
+
+        if client is None:
+            client = TelegramClient(session_name, api_id, api_hash)
+            _clients[session_name] = client
+
+        if not client.is_connected():
+            try:
+                await client.connect()
+            except Exception:
+                _clients.pop(session_name, None)
+                raise
+        return client
+
+
+async def _close_client(session_name):
+    client = _clients.pop(session_name, None)
+    if client is not None:
+        try:
+            await client.disconnect()
+        except Exception as e:
+            logger.warning("Erro ao desconectar cliente %s: %s", session_name, e)
+
+
 @asynccontextmanager
 async def telegram_client(session_name, api_id, api_hash):
-    client = TelegramClient(session_name, api_id, api_hash)
-    await client.connect()
+    client = await _get_client(session_name, api_id, api_hash)
     try:
         yield client
-    finally:
-        await client.disconnect()
+    except (ConnectionError, OSError):
+        # Conexão caiu: descarta o cliente para que a próxima chamada reconecte
+        await _close_client(session_name)
+        raise
 
 
 async def check_auth(session_name, api_id, api_hash):
@@ -57,43 +107,478 @@ async def sign_in_password(session_name, api_id, api_hash, password):
             return False, str(e)
 
 
-async def fetch_messages(session_name, api_id, api_hash, entity, limit, media_dir=None):
+async def fetch_messages(
+    session_name, api_id, api_hash, entity, limit, download_media=False,
+    max_concurrent_downloads=MEDIA_DOWNLOAD_CONCURRENCY, audio_only=False,
+    progress_callback=None,
+):
+    try:
+        msgs, media_files = await _collect_chat(
+            session_name, api_id, api_hash, entity, limit, download_media,
+            max_concurrent_downloads=max_concurrent_downloads,
+            audio_only=audio_only,
+            progress_callback=progress_callback,
+        )
+        return msgs, media_files, None
+    except Exception as e:
+        return [], [], str(e)
+
+
+async def fetch_many(
+    session_name, api_id, api_hash, entities, limit, download_media=False,
+    max_concurrent_chats=MAX_CONCURRENT_CHATS,
+    max_concurrent_downloads=MEDIA_DOWNLOAD_CONCURRENCY, audio_only=False,
+    progress_callback=None,
+):
+    # Vários grupos em paralelo sobre o mesmo cliente, com limites globais de
+    # grupos e downloads simultâneos
+    chat_semaphore = asyncio.Semaphore(max(1, max_concurrent_chats))
+    download_semaphore = asyncio.Semaphore(max(1, max_concurrent_downloads))
+    results = {}
+    finished = [0]
+
+    def report(message):
+        if progress_callback:
+            progress_callback(finished[0], len(entities), message)
+
+    async def fetch_one(entity):
+        def chat_progress(done, total, message):
+            report(f"{entity}: [{done}/{total}] {message}")
+
+        result = {"messages": [], "media_files": [], "error": None}
+        async with chat_semaphore:
+            for attempt in range(MAX_FLOOD_RETRIES + 1):
+                await _flood_gate.wait()
+                try:
+                    msgs, media_files = await _collect_chat(
+                        session_name, api_id, api_hash, entity, limit, download_media,
+                        download_semaphore=download_semaphore,
+                        audio_only=audio_only,
+                        progress_callback=chat_progress,
+                    )
+                    result = {"messages": msgs, "media_files": media_files, "error": None}
+                    break
+                except FloodWaitError as e:
+                    logger.warning("FloodWait de %ss ao buscar %s", e.seconds, entity)
+                    _flood_gate.hold(e.seconds)
+                    result["error"] = f"FloodWait de {e.seconds}s no Telegram"
+                except Exception as e:
+                    result["error"] = str(e)
+                    break
+
+        results[entity] = result
+        finished[0] += 1
+        if result["error"]:
+            report(f"{entity}: erro — {result['error']}")
+        else:
+            report(f"{entity}: {len(result['messages'])} mensagens")
+
+    await asyncio.gather(*(fetch_one(entity) for entity in entities))
+    return {entity: results[entity] for entity in entities}
+
+
+async def _collect_chat(session_name, api_id, api_hash, entity, limit, download_media, **kwargs):
+    msgs = []
+    media_files = []
+    async for batch in iter_message_batches(
+        session_name, api_id, api_hash, entity, limit, download_media, **kwargs
+    ):
+        msgs.extend(batch["messages"])
+        media_files.extend(batch["media_files"])
+
+    media_files.sort(key=lambda m: m["message_id"], reverse=True)
+    return msgs, media_files
+
+
+async def iter_message_batches(
+    session_name, api_id, api_hash, entity, limit, download_media=False,
+    batch_size=FETCH_BATCH_SIZE, max_concurrent_downloads=MEDIA_DOWNLOAD_CONCURRENCY,
+    download_semaphore=None, audio_only=False, progress_callback=None,
+):
     async with telegram_client(session_name, api_id, api_hash) as client:
-        msgs = []
-        media_files = []
+        downloads = None
         try:
             try:
                 chat = await client.get_entity(entity)
             except ValueError:
                 raise Exception(f"Não foi possível encontrar o grupo/canal: {entity}")
 
-            async for message in client.iter_messages(chat, limit=limit):
-                # Capturar mensagens de texto
-                if message.text:
-                    msgs.append({
-                        "date": message.date.strftime("%Y-%m-%d %H:%M:%S"),
-                        "sender_id": message.sender_id,
-                        "text": message.text,
-                    })
-
-                # Capturar vídeos enviados diretamente no chat
-                if media_dir and _is_video_message(message):
-                    try:
-                        path = await client.download_media(
-                            message, file=media_dir
-                        )
-                        if path and os.path.exists(path):
-                            media_files.append({
-                                "path": path,
-                                "date": message.date.strftime("%Y-%m-%d %H:%M:%S"),
-                                "filename": os.path.basename(path),
-                            })
-                    except Exception as e:
-                        logger.warning("Erro ao baixar mídia: %s", e)
-
-            return msgs, media_files, None
-        except Exception as e:
-            return [], [], str(e)
+            chat_id = get_peer_id(chat)
+            checkpoint = message_store.get_checkpoint(chat_id)
+            if download_media:
+                if download_semaphore is None:
+                    download_semaphore = asyncio.Semaphore(max(1, max_concurrent_downloads))
+                downloads = _MediaDownloads(
+                    client, chat_id, download_semaphore, progress_callback, audio_only
+                )
+            fetched = {}
+            count = 0
+
+            # 1) Mensagens novas desde o último checkpoint, direto da rede
+            min_id = checkpoint["max_id"] if checkpoint else 0
+            new_ids = []
+            rows = _iter_rows(client, chat, fetched, downloads, limit=limit, min_id=min_id)
+            async for batch in _batched(rows, batch_size):
+                message_store.save_messages(chat_id, batch)
+                new_ids.extend(r["message_id"] for r in batch)
+                count += len(batch)
+                yield _make_batch(batch, downloads, count)
+
+            if checkpoint is None or len(new_ids) >= limit:
+                # Primeira sincronização, ou tantas mensagens novas que ficou um buraco
+                # entre elas e o que já estava salvo: o intervalo contínuo recomeça aqui
+                low = min(new_ids) if new_ids else 0
+                complete = checkpoint is None and len(new_ids) < limit
+            else:
+                low = checkpoint["min_id"]
+                complete = checkpoint["complete"]
+            high = max(new_ids + [checkpoint["max_id"] if checkpoint else 0])
+
+            # 2) O que já estava salvo em disco
+            new_set = set(new_ids)
+            stored = [
+                r for r in message_store.load_messages(chat_id, limit, min_id=low)
+                if r["message_id"] not in new_set
+            ]
+            for i in range(0, len(stored), batch_size):
+                batch = stored[i:i + batch_size]
+                if downloads:
+                    await _submit_stored_media(client, chat, batch, fetched, downloads)
+                count += len(batch)
+                yield _make_batch(batch, downloads, count)
+
+            # 3) Histórico mais antigo, se o disco não tiver o suficiente
+            if count < limit and not complete and low:
+                missing = limit - count
+                backfilled = 0
+                rows = _iter_rows(client, chat, fetched, downloads, limit=missing, offset_id=low)
+                async for batch in _batched(rows, batch_size):
+                    message_store.save_messages(chat_id, batch)
+                    low = min(low, min(r["message_id"] for r in batch))
+                    backfilled += len(batch)
+                    count += len(batch)
+                    yield _make_batch(batch, downloads, count)
+                complete = backfilled < missing
+
+            message_store.save_checkpoint(chat_id, high, low, complete)
+
+            if downloads:
+                await downloads.wait()
+                yield _make_batch([], downloads, count)
+        finally:
+            if downloads:
+                downloads.cancel()
+
+
+async def _iter_rows(client, chat, fetched, downloads, **kwargs):
+    async for message in client.iter_messages(chat, **kwargs):
+        fetched[message.id] = message
+        row = {
+            "message_id": message.id,
+            "date": message.date.strftime("%Y-%m-%d %H:%M:%S"),
+            "sender_id": message.sender_id,
+            "text": message.text or "",
+            "media": _media_info(message) if _media_kind(message) else None,
+        }
+        # O download começa já, em paralelo com o resto da paginação
+        if downloads and row["media"]:
+            downloads.submit(message, row["date"])
+        yield row
+
+
+async def _batched(rows, batch_size):
+    batch = []
+    async for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _make_batch(rows, downloads, count):
+    return {
+        "messages": [
+            {
+                "message_id": r["message_id"],
+                "date": r["date"],
+                "sender_id": r["sender_id"],
+                "text": r["text"],
+            }
+            for r in rows
+            if r["text"]
+        ],
+        "media_files": downloads.pop_finished() if downloads else [],
+        "count": count,
+    }
+
+
+async def _submit_stored_media(client, chat, rows, fetched, downloads):
+    pending = []
+    for r in rows:
+        if not r["media"] or downloads.has(r["message_id"]):
+            continue
+        if not downloads.use_stored(r["message_id"], r["media"], r["date"]):
+            pending.append(r)
+
+    # Vídeos que vieram do disco sem arquivo local precisam ser buscados pelo id
+    missing_ids = [r["message_id"] for r in pending if r["message_id"] not in fetched]
+    if missing_ids:
+        for message in await client.get_messages(chat, ids=missing_ids):
+            if message is not None:
+                fetched[message.id] = message
+
+    for r in pending:
+        message = fetched.get(r["message_id"])
+        if message is not None:
+            downloads.submit(message, r["date"])
+
+
+class _FloodGate:
+    # Um FloodWait vale para a conta inteira: todas as tarefas pausam juntas
+    # até o horário liberado pelo Telegram.
+    def __init__(self):
+        self._resume_at = 0
+
+    def hold(self, seconds):
+        loop = asyncio.get_running_loop()
+        self._resume_at = max(self._resume_at, loop.time() + seconds)
+
+    async def wait(self):
+        delay = self._resume_at - asyncio.get_running_loop().time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+_flood_gate = _FloodGate()
+
+
+def _media_entry(message_id, media, date):
+    return {
+        "message_id": message_id,
+        "path": media.get("path"),
+        "audio_path": media.get("audio_path"),
+        "cache_key": media.get("cache_key"),
+        "date": date,
+        "duration": media.get("duration"),
+        "kind": media.get("kind", "video"),
+        "filename": media.get("filename") or os.path.basename(media.get("path") or media.get("audio_path") or ""),
+    }
+
+
+def _existing_media(media, audio_only=False):
+    # Só vale o que ainda está em disco (o cache pode ter removido o arquivo).
+    # Sem arquivo, a mídia só é aproveitada quando basta a transcrição e ela
+    # ainda está no cache com a configuração atual do Whisper
+    media = dict(media or {})
+    media.pop("transcribed", None)
+    for field in ("path", "audio_path"):
+        if media.get(field) and not os.path.exists(media[field]):
+            media.pop(field)
+    if media.get("path") or media.get("audio_path"):
+        return media
+    if audio_only and _transcript_cached(media.get("cache_key")):
+        return media
+    return None
+
+
+def _transcript_cached(cache_key):
+    return bool(cache_key) and transcript_cache.get([cache_key], *cache_settings()) is not None
+
+
+class _MediaDownloads:
+    def __init__(self, client, chat_id, semaphore, progress_callback=None, audio_only=False):
+        self.client = client
+        self.chat_id = chat_id
+        self.progress_callback = progress_callback
+        self.audio_only = audio_only
+        self.results = {}
+        self._finished_entries = []
+        self._semaphore = semaphore
+        self._tasks = {}
+        self._finished = 0
+
+    def pop_finished(self):
+        finished, self._finished_entries = self._finished_entries, []
+        return finished
+
+    def _add_result(self, message_id, media, date):
+        entry = _media_entry(message_id, media, date)
+        self.results[message_id] = entry
+        self._finished_entries.append(entry)
+
+    def has(self, message_id):
+        return message_id in self.results or message_id in self._tasks
+
+    def use_stored(self, message_id, media, date):
+        media = _existing_media(media, self.audio_only)
+        if media:
+            self._add_result(message_id, media, date)
+            return True
+        return False
+
+    def submit(self, message, date):
+        if self.has(message.id):
+            return
+        if self.use_stored(message.id, message_store.get_media(self.chat_id, message.id), date):
+            return
+        self._tasks[message.id] = asyncio.ensure_future(self._download(message, date))
+
+    async def wait(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks.values())
+
+    def cancel(self):
+        for task in self._tasks.values():
+            task.cancel()
+
+    async def _download(self, message, date):
+        kind = _media_kind(message)
+        name = getattr(message.file, "name", None) or f"{kind}_{message.id}"
+        if message.document:
+            cache_key = media_cache.telegram_key(message.document.id)
+        else:
+            cache_key = f"tg-msg:{self.chat_id}:{message.id}"
+
+        cached = self.audio_only and await asyncio.to_thread(_transcript_cached, cache_key)
+        if cached:
+            # Já transcrito: o arquivo foi apagado depois da transcrição e não
+            # precisa ser baixado de novo
+            media = {}
+        elif self.audio_only and kind == "video":
+            media = await self._fetch_audio(message, name, cache_key)
+        else:
+            media = await self._fetch_video(message, name, cache_key)
+
+        self._finished += 1
+        if media is not None:
+            media.update(_media_info(message))
+            media.update({"filename": name, "cache_key": cache_key})
+            if not cached:
+                # Só arquivos de verdade vão para o message_store; a transcrição
+                # em cache é conferida de novo a cada busca
+                message_store.update_media(self.chat_id, message.id, media)
+            self._add_result(message.id, media, date)
+            self._report(f"Baixado: {name}")
+        else:
+            self._report(f"Falha ao baixar: {name}")
+
+    async def _fetch_video(self, message, name, cache_key):
+        # get()/put() fora do event loop: put() calcula o hash do arquivo
+        # inteiro e move para o cache, o que travaria os outros downloads
+        path = await asyncio.to_thread(media_cache.get, cache_key)
+        if path is None:
+            async with self._semaphore:
+                reserved = await asyncio.to_thread(media_cache.reserve, _file_size(message))
+                with media_cache.download_dir(reserved) as tmp_dir:
+                    downloaded = await self._download_with_retries(message, name, tmp_dir)
+                    if downloaded and os.path.exists(downloaded):
+                        path = await asyncio.to_thread(media_cache.put, cache_key, downloaded)
+        return {"path": path} if path else None
+
+    async def _fetch_audio(self, message, name, cache_key):
+        # Só o áudio é usado: os bytes do vídeo vão direto do Telegram para o
+        # ffmpeg, sem gravar o arquivo de vídeo inteiro em disco
+        audio_key = f"{cache_key}:audio"
+        audio_path = await asyncio.to_thread(media_cache.get, audio_key)
+        if audio_path is None:
+            async with self._semaphore:
+                # Reserva o tamanho do vídeo: se o streaming falhar, ele é baixado inteiro
+                reserved = await asyncio.to_thread(media_cache.reserve, _file_size(message))
+                with media_cache.download_dir(reserved) as tmp_dir:
+                    extracted = await self._stream_audio(message, name, tmp_dir)
+                    if extracted is None:
+                        # Ex.: MP4 com o índice (moov) no fim, que não dá para ler de um pipe
+                        logger.info("Streaming falhou para %s, baixando o vídeo inteiro", name)
+                        downloaded = await self._download_with_retries(message, name, tmp_dir)
+                        if downloaded and os.path.exists(downloaded):
+                            extracted = await asyncio.to_thread(extract_audio, downloaded, tmp_dir)
+                    if extracted:
+                        audio_path = await asyncio.to_thread(media_cache.put, audio_key, extracted)
+        return {"audio_path": audio_path} if audio_path else None
+
+    async def _stream_audio(self, message, name, target_dir):
+        output_path = os.path.join(target_dir, f"{message.id}.wav")
+        report = self._reporter(name)
+        total = _file_size(message)
+
+        async def chunks():
+            received = 0
+            async for chunk in self.client.iter_download(message.media):
+                received += len(chunk)
+                report(received, total)
+                yield chunk
+
+        for attempt in range(MAX_FLOOD_RETRIES + 1):
+            await _flood_gate.wait()
+            try:
+                return await extract_audio_from_stream(chunks(), output_path)
+            except FloodWaitError as e:
+                logger.warning("FloodWait de %ss ao baixar %s", e.seconds, name)
+                _flood_gate.hold(e.seconds)
+            except Exception as e:
+                logger.warning("Erro no streaming de %s: %s", name, e)
+                return None
+        return None
+
+    async def _download_with_retries(self, message, name, target_dir):
+        for attempt in range(MAX_FLOOD_RETRIES + 1):
+            await _flood_gate.wait()
+            try:
+                return await self.client.download_media(
+                    message, file=target_dir, progress_callback=self._reporter(name)
+                )
+            except FloodWaitError as e:
+                logger.warning("FloodWait de %ss ao baixar %s", e.seconds, name)
+                _flood_gate.hold(e.seconds)
+            except Exception as e:
+                logger.warning("Erro ao baixar mídia: %s", e)
+                return None
+        return None
+
+    def _reporter(self, name):
+        last_step = [-1]
+
+        def report(current, total):
+            if not total:
+                return
+            step = int(current * 10 / total)
+            if step != last_step[0]:
+                last_step[0] = step
+                self._report(f"Baixando {name}: {step * 10}%")
+
+        return report
+
+    def _report(self, message):
+        if self.progress_callback:
+            self.progress_callback(self._finished, len(self._tasks), message)
+
+
+def _file_size(message):
+    return getattr(message.file, "size", None) or 0
+
+
+def _media_info(message):
+    # Duração e tamanho já vêm na mensagem: o planejamento não precisa baixar nada
+    return {
+        "video": True,
+        "kind": _media_kind(message),
+        "duration": getattr(message.file, "duration", None),
+        "size": getattr(message.file, "size", None),
+    }
+
+
+def _media_kind(message):
+    # Notas de voz e vídeos redondos são curtos e já quase só áudio: são
+    # baixados inteiros (sem ffmpeg) e transcritos em lote
+    if message.voice:
+        return "voice"
+    if message.video_note:
+        return "video_note"
+    if _is_video_message(message):
+        return "video"
+    return None
 
 
 def _is_video_message(message):
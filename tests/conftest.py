@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    # Bancos SQLite e cache de mídia num diretório temporário por teste
+    import storage
+    import media_cache
+
+    monkeypatch.setattr(storage, "DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(storage, "_connections", {})
+    monkeypatch.setattr(media_cache, "CACHE_DIR", str(tmp_path / "media_cache"))
+    monkeypatch.setattr(media_cache, "_pinned", {})
+    monkeypatch.setattr(media_cache, "_reserved", 0)
+    return tmp_path
@@ -0,0 +1,63 @@
+import time
+
+import analysis_cache
+import data_preparation
+import token_budget
+
+REQUEST = {
+    "model": "m",
+    "max_tokens": 4000,
+    "temperature": 0.1,
+    "messages": [{"role": "user", "content": "x"}],
+}
+
+
+def _age(key, seconds):
+    conn = analysis_cache._conn()
+    conn.execute("UPDATE analyses SET created_at = ? WHERE key = ?", (time.time() - seconds, key))
+    conn.commit()
+
+
+def test_request_key_changes_with_any_field_of_the_request():
+    key = analysis_cache.request_key(REQUEST)
+    assert analysis_cache.request_key(dict(reversed(list(REQUEST.items())))) == key
+    assert analysis_cache.request_key({**REQUEST, "model": "outro"}) != key
+    assert analysis_cache.request_key({**REQUEST, "max_tokens": 4001}) != key
+    assert analysis_cache.request_key(
+        {**REQUEST, "messages": [{"role": "user", "content": "y"}]}
+    ) != key
+
+
+def test_get_returns_stored_result_until_it_expires(data_dir, monkeypatch):
+    monkeypatch.setattr(analysis_cache, "TTL_SECONDS", 60)
+    key = analysis_cache.request_key(REQUEST)
+    analysis_cache.put(key, "m", {"resumo_executivo": "ok"})
+    assert analysis_cache.get(key) == {"resumo_executivo": "ok"}
+
+    _age(key, 61)
+    assert analysis_cache.get(key) is None
+    assert analysis_cache._conn().execute("SELECT COUNT(*) FROM analyses").fetchone()[0] == 0
+
+
+def test_put_evicts_least_recently_used_over_the_size_limit(data_dir, monkeypatch):
+    monkeypatch.setattr(analysis_cache, "MAX_CACHE_BYTES", 250)
+    analysis_cache.put("a", "m", {"texto": "a" * 100})
+    analysis_cache.put("b", "m", {"texto": "b" * 100})
+    analysis_cache.get("a")
+    analysis_cache.put("c", "m", {"texto": "c" * 100})
+
+    assert analysis_cache.get("b") is None
+    assert analysis_cache.get("a") is not None
+    assert analysis_cache.get("c") is not None
+
+
+def test_windows_do_not_depend_on_the_calibrated_ratio(monkeypatch):
+    messages = [
+        {"date": f"2024-01-01 10:00:{i:02d}", "text": "mensagem " + "x" * 200}
+        for i in range(60)
+    ]
+    monkeypatch.setattr(token_budget, "MAX_INPUT_TOKENS", 1000)
+    before = data_preparation.prepare_analysis_windows(messages, model="m")
+    monkeypatch.setitem(token_budget._chars_per_token, "m", 1.5)
+    assert data_preparation.prepare_analysis_windows(messages, model="m") == before
+    assert len(before) > 1
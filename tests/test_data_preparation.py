@@ -0,0 +1,101 @@
+import token_budget
+from claude_analysis import merge_results
+from data_preparation import TEXT_HEADER, VIDEO_HEADER, _split_windows, split_window
+
+
+def _tokens(text):
+    return token_budget.estimate_tokens(text)
+
+
+def test_split_windows_keeps_every_entry_in_order_within_budget():
+    texts = [f"[2024-01-01 10:00:{i:02d}] mensagem {i} " + "x" * 150 for i in range(40)]
+    videos = [f"[2024-01-02] Vídeo (link {i}):\n  " + "y" * 300 + "\n" for i in range(10)]
+    budget = 400
+    windows = _split_windows([(TEXT_HEADER, texts), (VIDEO_HEADER, videos)], budget)
+
+    assert len(windows) > 1
+    joined = "\n".join(windows)
+    positions = [joined.index(entry) for entry in texts + videos]
+    assert positions == sorted(positions)
+    for window in windows:
+        assert _tokens(window) <= budget + 5
+        assert window.startswith(TEXT_HEADER) or window.startswith(VIDEO_HEADER)
+
+
+def test_split_windows_repeats_section_header_in_each_window():
+    videos = [f"[2024-01-02] Vídeo {i}:\n  " + "y" * 300 + "\n" for i in range(6)]
+    windows = _split_windows([(TEXT_HEADER, []), (VIDEO_HEADER, videos)], 250)
+    assert len(windows) > 1
+    assert all(window.startswith(VIDEO_HEADER) for window in windows)
+    assert not any(TEXT_HEADER in window for window in windows)
+
+
+def test_split_windows_truncates_only_an_entry_larger_than_the_budget():
+    huge = "[2024-01-01] " + "z" * 5000
+    small = "[2024-01-01] pequena"
+    windows = _split_windows([(TEXT_HEADER, [huge, small])], 300)
+    assert len(windows) == 2
+    assert _tokens(windows[0]) <= 300 + 5
+    assert windows[0].startswith(TEXT_HEADER + "\n[2024-01-01] zzz")
+    assert windows[1] == f"{TEXT_HEADER}\n{small}"
+
+
+
+def test_split_window_cuts_at_an_entry_boundary_near_the_middle():
+    entries = [f"[2024-01-01 10:00:{i:02d}] mensagem {i}" for i in range(6)]
+    window = "\n".join([TEXT_HEADER] + entries)
+    first, second = split_window(window)
+    cut = first.count("\n[")
+    assert abs(cut - (len(entries) - cut)) <= 2
+    assert first == "\n".join([TEXT_HEADER] + entries[:cut])
+    assert second == "\n".join([TEXT_HEADER] + entries[cut:])
+
+
+def test_split_window_repeats_the_header_of_the_section_where_it_cuts():
+    texts = ["[2024-01-01] texto"]
+    videos = [f"[2024-01-02] Vídeo {i}:\n  fala {i}\n" for i in range(5)]
+    window = "\n".join([TEXT_HEADER] + texts + ["", VIDEO_HEADER] + videos)
+    first, second = split_window(window)
+    assert second.startswith(VIDEO_HEADER + "\n[2024-01-02]")
+    assert TEXT_HEADER not in second
+    assert first.startswith(TEXT_HEADER)
+    for entry in texts + videos:
+        assert entry.strip() in first + second
+
+
+def test_split_window_without_entries_cuts_in_half():
+    assert split_window("abcdef") == ["abc", "def"]
+
+
+def test_merge_results_concatenates_windows_and_drops_repeated_items():
+    first = {
+        "problemas_operacionais": [{"problema": "Atraso na entrega"}, {"problema": "Estoque"}],
+        "links_ferramentas": ["https://a.com"],
+        "_model_used": "m1",
+        "_raw_response": "r1",
+        "_usage": {"input_tokens": 10, "output_tokens": 5},
+    }
+    second = {
+        "problemas_operacionais": [{"problema": "atraso na entrega ", "area": "Logística"}],
+        "oportunidades_ia": [{"oportunidade": "Chatbot"}],
+        "links_ferramentas": ["https://a.com", "https://b.com"],
+        "_model_used": "m2",
+        "_raw_response": "r2",
+        "_usage": {"input_tokens": 7, "output_tokens": 3},
+    }
+    merged = merge_results([first, second])
+
+    assert merged["problemas_operacionais"] == [{"problema": "Atraso na entrega"}, {"problema": "Estoque"}]
+    assert merged["oportunidades_ia"] == [{"oportunidade": "Chatbot"}]
+    assert merged["links_ferramentas"] == ["https://a.com", "https://b.com"]
+    assert merged["_model_used"] == "m1, m2"
+    assert merged["_raw_response"] == "r1\n\nr2"
+    assert merged["_usage"]["input_tokens"] == 17
+    assert merged["_usage"]["output_tokens"] == 8
+    assert merged["_windows"] == 2
+    assert "_cached" not in merged
+
+
+def test_merge_results_is_cached_only_if_every_window_was():
+    assert merge_results([{"_cached": True}, {"_cached": True}])["_cached"]
+    assert "_cached" not in merge_results([{"_cached": True}, {}])
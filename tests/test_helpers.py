@@ -0,0 +1,18 @@
+import os
+
+from helpers import owner_alive, process_owner
+
+
+def test_owner_alive_recognizes_this_process():
+    assert owner_alive(process_owner())
+
+
+def test_owner_alive_rejects_same_pid_from_a_previous_run():
+    # Depois de um restart em contêiner o pid se repete, mas o token não
+    assert not owner_alive(f"{os.getpid()}-0123456789ab")
+
+
+def test_owner_alive_rejects_invalid_owner():
+    assert not owner_alive(None)
+    assert not owner_alive("")
+    assert not owner_alive("abc-def")
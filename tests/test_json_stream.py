@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+from json_stream import ItemStream
+
+KEYS = ("problemas_operacionais", "oportunidades_ia")
+
+
+def _stream(text, chunk_size):
+    found = []
+    parser = ItemStream(KEYS, lambda key, item: found.append((key, item)))
+    for i in range(0, len(text), chunk_size):
+        parser.feed(text[i:i + chunk_size])
+    return found
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 1000])
+def test_item_stream_emits_items_of_streamed_lists(chunk_size):
+    result = {
+        "problemas_operacionais": [{"problema": "a"}, {"problema": "b", "area": "RH"}],
+        "solucoes_ia_implementadas": [{"solucao": "ignorada"}],
+        "oportunidades_ia": [{"oportunidade": "c"}],
+        "links_ferramentas": ["https://exemplo.com"],
+    }
+    found = _stream(json.dumps(result), chunk_size)
+    assert found == [
+        ("problemas_operacionais", {"problema": "a"}),
+        ("problemas_operacionais", {"problema": "b", "area": "RH"}),
+        ("oportunidades_ia", {"oportunidade": "c"}),
+    ]
+
+
+def test_item_stream_handles_escapes_and_brackets_inside_strings():
+    tricky = 'aspas \\" e } { [ ] dentro da string \\\\'
+    text = '{"problemas_operacionais": [{"problema": "' + tricky + '"}]}'
+    found = _stream(text, 2)
+    assert found == [("problemas_operacionais", {"problema": json.loads(f'"{tricky}"')})]
+
+
+def test_item_stream_keeps_nested_objects_inside_an_item():
+    item = {"problema": "x", "detalhes": {"lista": [1, {"a": "}"}]}}
+    found = _stream(json.dumps({"oportunidades_ia": [item]}), 5)
+    assert found == [("oportunidades_ia", item)]
+
+
+def test_item_stream_ignores_code_fence_preamble():
+    text = '```json\n{"problemas_operacionais": [{"problema": "a"}]}\n```'
+    assert _stream(text, 4) == [("problemas_operacionais", {"problema": "a"})]
+
+
+def test_item_stream_does_not_emit_incomplete_item():
+    assert _stream('{"problemas_operacionais": [{"problema": "a"}, {"problema": "b', 3) == [
+        ("problemas_operacionais", {"problema": "a"})
+    ]
+
+
+def test_item_stream_ignores_lists_with_same_name_below_top_level():
+    text = json.dumps({"outro": {"problemas_operacionais": [{"problema": "aninhado"}]}})
+    assert _stream(text, 6) == []
@@ -0,0 +1,25 @@
+import time
+
+import link_index
+
+
+def _age(key, seconds):
+    conn = link_index._conn()
+    conn.execute("UPDATE links SET updated_at = ? WHERE key = ?", (time.time() - seconds, key))
+    conn.commit()
+
+
+def test_transient_failures_expire_before_permanent_ones(data_dir):
+    link_index.mark("url:a", "https://a", link_index.FAILED, "indisponível")
+    link_index.mark("url:b", "https://b", link_index.TRANSIENT, "download falhou")
+    assert link_index.get_statuses(["url:a", "url:b", "url:c"]) == {
+        "url:a": link_index.FAILED,
+        "url:b": link_index.TRANSIENT,
+    }
+
+    _age("url:a", link_index.RETRY_TRANSIENT_SECONDS + 1)
+    _age("url:b", link_index.RETRY_TRANSIENT_SECONDS + 1)
+    assert link_index.get_statuses(["url:a", "url:b"]) == {"url:a": link_index.FAILED}
+
+    _age("url:a", link_index.RETRY_FAILED_SECONDS + 1)
+    assert link_index.get_statuses(["url:a"]) == {}
@@ -0,0 +1,127 @@
+import os
+import threading
+
+import pytest
+
+import media_cache
+from helpers import process_owner
+
+
+def test_cleanup_removes_workspaces_of_a_previous_run_with_the_same_pid(data_dir):
+    root = os.path.join(media_cache.CACHE_DIR, "tmp")
+    with media_cache.download_dir() as current:
+        assert os.path.basename(current).startswith(process_owner() + "-")
+        # Mesmo pid (restart do contêiner), outra execução
+        stale = os.path.join(root, f"{os.getpid()}-0123456789ab-xyz")
+        legacy = os.path.join(root, f"{os.getpid()}-xyz")
+        for path in (stale, legacy):
+            os.makedirs(path)
+
+        media_cache.cleanup_workspaces()
+
+        assert os.path.isdir(current)
+        assert not os.path.exists(stale)
+        assert not os.path.exists(legacy)
+
+
+def _file(data_dir, name, size):
+    path = data_dir / name
+    path.write_bytes(os.urandom(size))
+    return str(path)
+
+
+def test_put_stores_identical_content_once(data_dir):
+    first = _file(data_dir, "a.mp4", 100)
+    copy = str(data_dir / "b.mp4")
+    with open(first, "rb") as src, open(copy, "wb") as dst:
+        dst.write(src.read())
+
+    blob = media_cache.put("url:a", first)
+    assert media_cache.put("url:b", copy) == blob
+    assert not os.path.exists(first) and not os.path.exists(copy)
+    assert media_cache.get("url:a") == media_cache.get("url:b") == blob
+
+
+def test_put_evicts_least_recently_used_blob_over_the_quota(data_dir, monkeypatch):
+    monkeypatch.setattr(media_cache, "MAX_CACHE_BYTES", 250)
+    old = media_cache.put("url:old", _file(data_dir, "old.mp4", 100))
+    recent = media_cache.put("url:recent", _file(data_dir, "recent.mp4", 100))
+    media_cache.get("url:old")
+
+    media_cache.put("url:new", _file(data_dir, "new.mp4", 100))
+    assert media_cache.get("url:recent") is None
+    assert not os.path.exists(recent)
+    assert media_cache.get("url:old") == old
+
+
+def test_pinned_blob_is_not_evicted(data_dir, monkeypatch):
+    monkeypatch.setattr(media_cache, "MAX_CACHE_BYTES", 150)
+    pinned = media_cache.put("url:a", _file(data_dir, "a.mp4", 100), pin=True)
+    media_cache.put("url:b", _file(data_dir, "b.mp4", 100))
+    assert media_cache.get("url:a") == pinned
+
+    media_cache.unpin(pinned)
+    assert media_cache._pinned == {}
+    media_cache.put("url:c", _file(data_dir, "c.mp4", 100))
+    assert media_cache.get("url:a") is None
+
+
+def test_reserve_evicts_unpinned_blobs_to_fit_the_download(data_dir, monkeypatch):
+    monkeypatch.setattr(media_cache, "MAX_CACHE_BYTES", 300)
+    media_cache.put("url:a", _file(data_dir, "a.mp4", 100))
+    media_cache.put("url:b", _file(data_dir, "b.mp4", 100))
+
+    reserved = media_cache.reserve(200)
+    assert reserved == 200
+    assert media_cache.get("url:a") is None
+    assert media_cache.get("url:b") is not None
+    media_cache.unreserve(reserved)
+    assert media_cache._reserved == 0
+
+
+def test_reserve_waits_for_pinned_blobs_to_be_released(data_dir, monkeypatch):
+    monkeypatch.setattr(media_cache, "MAX_CACHE_BYTES", 150)
+    pinned = media_cache.put("url:a", _file(data_dir, "a.mp4", 100), pin=True)
+    done = threading.Event()
+
+    def download():
+        media_cache.unreserve(media_cache.reserve(100))
+        done.set()
+
+    threading.Thread(target=download, daemon=True).start()
+    assert not done.wait(0.3)
+    media_cache.unpin(pinned)
+    assert done.wait(5)
+    assert media_cache.get("url:a") is None
+
+
+@pytest.mark.parametrize("url, expected", [
+    ("https://www.youtube.com/watch?v=dQw4w9WgXcQ", "youtube:dQw4w9WgXcQ"),
+    ("https://youtube.com/watch?feature=share&v=dQw4w9WgXcQ&t=10", "youtube:dQw4w9WgXcQ"),
+    ("https://youtu.be/dQw4w9WgXcQ?si=abc", "youtube:dQw4w9WgXcQ"),
+    ("https://www.youtube.com/shorts/dQw4w9WgXcQ", "youtube:dQw4w9WgXcQ"),
+    ("https://www.instagram.com/reel/C1a2b3/?igsh=xyz", "instagram:C1a2b3"),
+    ("https://www.instagram.com/usuario/p/C1a2b3/", "instagram:C1a2b3"),
+    ("https://www.tiktok.com/@perfil.x/video/7300000000000000000", "tiktok:7300000000000000000"),
+    ("https://twitter.com/perfil/status/1234567890", "x:1234567890"),
+    ("https://x.com/perfil/status/1234567890?s=20", "x:1234567890"),
+    ("https://vm.tiktok.com/ZMabc123/", None),
+])
+def test_canonical_id(url, expected):
+    assert media_cache.canonical_id(url) == expected
+
+
+def test_url_key_is_the_same_for_equivalent_links():
+    keys = {
+        media_cache.url_key("https://youtu.be/dQw4w9WgXcQ"),
+        media_cache.url_key("https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=42"),
+        media_cache.url_key("https://m.youtube.com/shorts/dQw4w9WgXcQ"),
+    }
+    assert keys == {"url:youtube:dQw4w9WgXcQ"}
+
+
+def test_url_key_normalizes_unrecognized_links():
+    assert media_cache.url_key("https://www.Exemplo.com/video/123/?utm_source=x") == (
+        "url:exemplo.com/video/123"
+    )
+    assert media_cache.url_key("https://vm.tiktok.com/ZMabc123/") == "url:vm.tiktok.com/ZMabc123"
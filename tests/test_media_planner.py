@@ -0,0 +1,57 @@
+from media_planner import DEFAULT_RTF, UNKNOWN_DURATION_SECONDS, estimate_seconds, plan_media
+
+
+def _item(name, date, duration=None, size=None, **extra):
+    return {"origin": name, "date": date, "duration": duration, "size": size, **extra}
+
+
+def _names(items):
+    return [item["origin"] for item in items]
+
+
+def test_estimate_seconds_uses_transcription_and_download_time():
+    assert estimate_seconds(_item("a", "", duration=100), rtf=0.5) == 50
+    assert estimate_seconds(_item("a", "", duration=1000), rtf=0.5, max_audio_seconds=100) == 50
+    assert estimate_seconds(_item("a", "")) == UNKNOWN_DURATION_SECONDS * DEFAULT_RTF
+
+
+def test_plan_skips_unavailable_and_oversized_items():
+    items = [
+        _item("morto", "2024-01-03", unavailable=True),
+        _item("enorme", "2024-01-02", size=500),
+        _item("ok", "2024-01-01", size=100),
+    ]
+    selected, skipped = plan_media(items, max_bytes=200)
+    assert _names(selected) == ["ok"]
+    assert [(item["origin"], reason) for item, reason in skipped] == [
+        ("morto", "indisponível"),
+        ("enorme", "grande demais"),
+    ]
+
+
+def test_plan_prefers_recent_and_short_items():
+    items = [
+        _item("antigo-longo", "2024-01-01", duration=600),
+        _item("recente-curto", "2024-01-03", duration=30),
+        _item("medio", "2024-01-02", duration=120),
+    ]
+    selected, skipped = plan_media(items)
+    assert _names(selected) == ["recente-curto", "medio", "antigo-longo"]
+    assert skipped == []
+
+
+def test_plan_cuts_what_does_not_fit_the_budgets():
+    items = [
+        _item("a", "2024-01-03", duration=100, size=10),
+        _item("b", "2024-01-02", duration=100, size=10),
+        _item("c", "2024-01-01", duration=100, size=10),
+    ]
+    selected, skipped = plan_media(items, time_budget=70, rtf=0.3)
+    assert _names(selected) == ["a", "b"]
+    assert [(item["origin"], reason) for item, reason in skipped] == [
+        ("c", "fora do orçamento de tempo")
+    ]
+
+    selected, skipped = plan_media(items, byte_budget=15)
+    assert _names(selected) == ["a"]
+    assert {reason for _, reason in skipped} == {"fora do orçamento de download"}
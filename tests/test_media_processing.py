@@ -0,0 +1,115 @@
+import os
+import threading
+
+import media_cache
+import media_processing
+import work_queue
+
+VIDEO_BYTES = 600
+
+
+class _FakeDownloader:
+    def __init__(self):
+        self.params = {}
+
+    def extract_info(self, url, download=True):
+        path = os.path.join(self.params["paths"]["home"], "video.mp4")
+        with open(path, "wb") as f:
+            f.write(url.encode().ljust(VIDEO_BYTES, b"\0"))
+        return {"requested_downloads": [{"filepath": path}]}
+
+
+def _worker(stop):
+    while not stop.is_set():
+        task = work_queue.claim("teste")
+        if task is None:
+            stop.wait(0.02)
+            continue
+        work_queue.complete(task, f"texto de {task['key']}")
+
+
+def test_workers_path_finishes_when_downloads_exceed_the_cache_quota(data_dir, monkeypatch):
+    # Cota para um vídeo só: cada download seguinte depende de um resultado
+    # já consumido liberar o arquivo anterior
+    monkeypatch.setattr(media_cache, "MAX_CACHE_BYTES", 1000)
+    monkeypatch.setattr(media_processing, "QUEUE_POLL_SECONDS", 0.05)
+    monkeypatch.setattr(media_processing, "_get_downloader", _FakeDownloader)
+
+    urls = [f"https://youtu.be/video{i}" for i in range(4)]
+    items = [
+        {
+            "index": i,
+            "source": "link",
+            "url": url,
+            "origin": url,
+            "cache_key": media_cache.url_key(url),
+            "size": VIDEO_BYTES,
+        }
+        for i, url in enumerate(urls)
+    ]
+
+    stop = threading.Event()
+    worker = threading.Thread(target=_worker, args=(stop,), daemon=True)
+    worker.start()
+    results = {}
+    runner = threading.Thread(
+        target=lambda: results.update(media_processing._run_with_workers(items, None)),
+        daemon=True,
+    )
+    runner.start()
+    runner.join(timeout=20)
+    stop.set()
+
+    assert not runner.is_alive(), "_run_with_workers travou esperando espaço na cota"
+    assert results == {i: f"texto de {item['cache_key']}" for i, item in enumerate(items)}
+    assert media_cache._pinned == {}
+
+
+class _FailingDownloader:
+    def __init__(self, message):
+        self.message = message
+
+    def extract_info(self, url, download=True):
+        raise RuntimeError(self.message)
+
+
+def test_probe_separates_transient_from_permanent_failures(monkeypatch):
+    for message, transient in [
+        ("ERROR: [youtube] x: Private video", False),
+        ("ERROR: Unsupported URL: https://exemplo.com", False),
+        ("ERROR: HTTP Error 404: Not Found", False),
+        ("ERROR: HTTP Error 503: Service Unavailable", True),
+        ("ERROR: Unable to download webpage: timed out", True),
+        ("ERROR: HTTP Error 429: Too Many Requests", True),
+    ]:
+        monkeypatch.setattr(media_processing, "_get_downloader", lambda: _FailingDownloader(message))
+        probe = media_processing.probe_video("https://www.youtube.com/watch?v=x")
+        assert probe == {"unavailable": True, "transient": transient}, message
+
+
+class _ProbedDownloader(_FakeDownloader):
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    def extract_info(self, url, download=True):
+        self.calls.append(("extract_info", download))
+        if not download:
+            return {"id": "x", "duration": 30, "filesize": VIDEO_BYTES}
+        return super().extract_info(url, download)
+
+    def process_ie_result(self, info, download=True):
+        self.calls.append(("process_ie_result", download))
+        return super().extract_info(info["id"], download)
+
+
+def test_download_reuses_the_probed_info(data_dir, monkeypatch):
+    downloader = _ProbedDownloader()
+    monkeypatch.setattr(media_processing, "_get_downloader", lambda: downloader)
+    url = "https://www.youtube.com/watch?v=x"
+
+    probe = media_processing.probe_video(url)
+    path = media_processing.download_video(url, expected_bytes=probe["size"], info=probe["info"])
+
+    assert os.path.exists(path)
+    assert downloader.calls == [("extract_info", False), ("process_ie_result", True)]
@@ -0,0 +1,110 @@
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+import message_store
+import telegram_ops
+
+CHAT_ID = 42
+
+
+class _FakeClient:
+    def __init__(self, count):
+        self.messages = []
+        self.calls = []
+        self.add(count)
+
+    def add(self, count):
+        start = len(self.messages) + 1
+        for message_id in range(start, start + count):
+            self.messages.append(SimpleNamespace(
+                id=message_id,
+                date=datetime(2024, 1, 1) + timedelta(minutes=message_id),
+                sender_id=7,
+                text=f"mensagem {message_id}",
+                voice=None, video_note=None, video=None, document=None,
+            ))
+
+    async def get_entity(self, entity):
+        return entity
+
+    async def iter_messages(self, chat, limit=None, min_id=0, offset_id=0):
+        self.calls.append({"limit": limit, "min_id": min_id, "offset_id": offset_id})
+        found = [
+            m for m in reversed(self.messages)
+            if m.id > min_id and (not offset_id or m.id < offset_id)
+        ]
+        for message in found[:limit]:
+            yield message
+
+
+@pytest.fixture
+def client(data_dir, monkeypatch):
+    fake = _FakeClient(10)
+
+    async def get_client(session_name, api_id, api_hash):
+        return fake
+
+    monkeypatch.setattr(telegram_ops, "_get_client", get_client)
+    monkeypatch.setattr(telegram_ops, "get_peer_id", lambda chat: CHAT_ID)
+    return fake
+
+
+def _sync(limit):
+    async def collect():
+        ids = []
+        batches = telegram_ops.iter_message_batches(
+            "sessao", 1, "hash", "@grupo", limit, batch_size=3
+        )
+        async for batch in batches:
+            ids.extend(m["message_id"] for m in batch["messages"])
+        return ids
+
+    return asyncio.run(collect())
+
+
+def test_first_sync_saves_a_partial_checkpoint(client):
+    assert _sync(5) == [10, 9, 8, 7, 6]
+    assert message_store.get_checkpoint(CHAT_ID) == {"max_id": 10, "min_id": 6, "complete": False}
+
+
+def test_next_sync_fetches_only_new_messages_and_reads_the_rest_from_disk(client):
+    _sync(5)
+    client.add(2)
+    client.calls.clear()
+
+    assert _sync(5) == [12, 11, 10, 9, 8]
+    assert client.calls == [{"limit": 5, "min_id": 10, "offset_id": 0}]
+    assert message_store.get_checkpoint(CHAT_ID) == {"max_id": 12, "min_id": 6, "complete": False}
+
+
+def test_larger_limit_backfills_older_history_below_the_checkpoint(client):
+    _sync(5)
+    client.calls.clear()
+
+    assert _sync(8) == [10, 9, 8, 7, 6, 5, 4, 3]
+    assert client.calls == [
+        {"limit": 8, "min_id": 10, "offset_id": 0},
+        {"limit": 3, "min_id": 0, "offset_id": 6},
+    ]
+    assert message_store.get_checkpoint(CHAT_ID) == {"max_id": 10, "min_id": 3, "complete": False}
+
+
+def test_sync_marks_the_history_complete_when_it_reaches_the_first_message(client):
+    _sync(5)
+    assert _sync(20) == list(range(10, 0, -1))
+    assert message_store.get_checkpoint(CHAT_ID) == {"max_id": 10, "min_id": 1, "complete": True}
+
+    client.calls.clear()
+    assert _sync(20) == list(range(10, 0, -1))
+    assert client.calls == [{"limit": 20, "min_id": 10, "offset_id": 0}]
+
+
+def test_gap_larger_than_the_limit_restarts_the_contiguous_range(client):
+    _sync(5)
+    client.add(10)
+
+    assert _sync(5) == [20, 19, 18, 17, 16]
+    assert message_store.get_checkpoint(CHAT_ID) == {"max_id": 20, "min_id": 16, "complete": False}
@@ -0,0 +1,14 @@
+import token_budget
+from claude_analysis import ANALYSIS_SYSTEM_PROMPT
+
+
+def test_system_prompt_is_cached_only_by_models_with_a_small_cache_minimum():
+    assert token_budget.prompt_cacheable("claude-sonnet-4-5-20250929", ANALYSIS_SYSTEM_PROMPT)
+    assert not token_budget.prompt_cacheable("claude-haiku-4-5-20251001", ANALYSIS_SYSTEM_PROMPT)
+    assert not token_budget.prompt_cacheable("claude-3-haiku-20240307", ANALYSIS_SYSTEM_PROMPT)
+
+
+def test_prompt_cacheable_ignores_the_calibrated_ratio(monkeypatch):
+    prefix = "x" * int(1024 * token_budget.DEFAULT_CHARS_PER_TOKEN)
+    monkeypatch.setitem(token_budget._chars_per_token, "modelo", 10.0)
+    assert token_budget.prompt_cacheable("modelo", prefix)
@@ -0,0 +1,85 @@
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+import transcription
+
+
+class _FakePool:
+    def __init__(self, broken):
+        self.broken = broken
+        self.submitted = 0
+        self.shut_down = False
+
+    def submit(self, func, samples, settings, wall_deadline):
+        self.submitted += 1
+        future = Future()
+        if self.broken:
+            future.set_exception(BrokenProcessPool("processo morreu"))
+        else:
+            future.set_result(f"trecho {self.submitted}")
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.shut_down = True
+
+
+def _long_audio():
+    return np.zeros(int(transcription.CHUNK_SECONDS * 2.5 * transcription.SAMPLE_RATE), np.float32)
+
+
+def _use_pools(monkeypatch, pools):
+    created = []
+
+    def get_pool():
+        if transcription._chunk_pool is None:
+            transcription._chunk_pool = pools.pop(0)
+            created.append(transcription._chunk_pool)
+        return transcription._chunk_pool
+
+    monkeypatch.setattr(transcription, "_chunk_pool", None)
+    monkeypatch.setattr(transcription, "_get_chunk_pool", get_pool)
+    return created
+
+
+def test_broken_chunk_pool_is_replaced_and_retried(monkeypatch):
+    created = _use_pools(monkeypatch, [_FakePool(broken=True), _FakePool(broken=False)])
+
+    text = transcription._transcribe_chunked(_long_audio(), None)
+
+    assert text == "trecho 1 trecho 2 trecho 3"
+    assert created[0].shut_down
+    assert transcription._chunk_pool is created[1]
+
+
+def test_chunked_transcription_gives_up_after_a_second_broken_pool(monkeypatch):
+    created = _use_pools(monkeypatch, [_FakePool(broken=True), _FakePool(broken=True)])
+
+    assert transcription._transcribe_chunked(_long_audio(), None) is None
+    assert all(pool.shut_down for pool in created)
+    assert transcription._chunk_pool is None
+
+
+def test_stitch_removes_words_repeated_by_the_overlap():
+    texts = ["o pedido chegou atrasado de novo", "Atrasado, de novo. Precisamos de um sistema"]
+    assert transcription._stitch(texts) == "o pedido chegou atrasado de novo Precisamos de um sistema"
+
+
+def test_stitch_marks_missing_chunks_once():
+    assert transcription._stitch(["começo", None, None, "fim"]) == "começo [...] fim"
+    assert transcription._stitch([None, "fim"]) == "[...] fim"
+
+
+def test_stitch_does_not_dedupe_across_a_missing_chunk():
+    assert transcription._stitch(["a b c", None, "c d"]) == "a b c [...] c d"
+
+
+def test_overlap_length_prefers_the_longest_match_up_to_the_limit():
+    assert transcription._overlap_length(["x", "a", "b"], ["a", "b", "c"]) == 2
+    assert transcription._overlap_length(["a", "b"], ["c", "d"]) == 0
+    words = [str(i) for i in range(30)]
+    assert transcription._overlap_length(words, words[-20:]) == 0
+    assert transcription._overlap_length(words, words[-transcription.MAX_OVERLAP_WORDS:]) == (
+        transcription.MAX_OVERLAP_WORDS
+    )
@@ -0,0 +1,92 @@
+import os
+import time
+
+import work_queue
+
+SETTINGS = {"model_size": "base"}
+
+
+def _expire(task_id):
+    conn = work_queue._conn()
+    conn.execute("UPDATE tasks SET lease_expires = ? WHERE id = ?", (time.time() - 1, task_id))
+    conn.commit()
+
+
+def test_claim_leases_each_task_once(data_dir):
+    first = work_queue.enqueue("a", str(data_dir / "a.mp4"), SETTINGS)
+    second = work_queue.enqueue("b", str(data_dir / "b.mp4"), SETTINGS)
+
+    tasks = [work_queue.claim("w1"), work_queue.claim("w2")]
+    assert [task["id"] for task in tasks] == [first, second]
+    assert tasks[0]["settings"] == SETTINGS
+    assert tasks[0]["attempts"] == 1
+    assert work_queue.claim("w3") is None
+
+
+def test_enqueue_reuses_pending_task_with_same_key_and_settings(data_dir):
+    task_id = work_queue.enqueue("a", "a.mp4", SETTINGS)
+    assert work_queue.enqueue("a", "a.mp4", SETTINGS) == task_id
+    assert work_queue.enqueue("a", "a.mp4", {"model_size": "small"}) != task_id
+    assert work_queue.pending_count() == 2
+
+
+def test_paths_inside_the_data_dir_are_resolved_by_each_worker(data_dir, monkeypatch):
+    work_queue.enqueue("a", str(data_dir / "media_cache" / "blobs" / "a.mp4"), SETTINGS)
+    row = work_queue._conn().execute("SELECT path FROM tasks").fetchone()
+    assert row["path"] == os.path.join("media_cache", "blobs", "a.mp4")
+
+    import storage
+    monkeypatch.setattr(storage, "DATA_DIR", "/mnt/analisador")
+    assert work_queue.claim("w1")["path"] == "/mnt/analisador/media_cache/blobs/a.mp4"
+
+
+def test_expired_lease_goes_back_to_the_queue(data_dir):
+    task_id = work_queue.enqueue("a", "a.mp4", SETTINGS)
+    lost = work_queue.claim("w1")
+    assert work_queue.claim("w2") is None
+
+    _expire(task_id)
+    task = work_queue.claim("w2")
+    assert task["id"] == task_id
+    assert task["attempts"] == 2
+    # O worker antigo perdeu o lease: não renova nem conclui
+    assert not work_queue.renew(lost)
+    assert not work_queue.complete(lost, "velho")
+    assert work_queue.renew(task)
+    assert work_queue.complete(task, "texto")
+    assert work_queue.get_results([task_id])[task_id]["result"] == "texto"
+
+
+def test_failed_task_is_retried_until_max_attempts(data_dir, monkeypatch):
+    monkeypatch.setattr(work_queue, "MAX_ATTEMPTS", 2)
+    task_id = work_queue.enqueue("a", "a.mp4", SETTINGS)
+
+    assert work_queue.fail(work_queue.claim("w1"), "erro 1")
+    assert work_queue.get_results([task_id])[task_id]["status"] == work_queue.PENDING
+    assert work_queue.fail(work_queue.claim("w1"), "erro 2")
+    result = work_queue.get_results([task_id])[task_id]
+    assert result["status"] == work_queue.FAILED
+    assert result["error"] == "erro 2"
+    assert work_queue.claim("w1") is None
+
+
+def test_expired_lease_after_last_attempt_fails_the_task(data_dir, monkeypatch):
+    monkeypatch.setattr(work_queue, "MAX_ATTEMPTS", 1)
+    task_id = work_queue.enqueue("a", "a.mp4", SETTINGS)
+    work_queue.claim("w1")
+    _expire(task_id)
+
+    assert work_queue.claim("w2") is None
+    result = work_queue.get_results([task_id])[task_id]
+    assert (result["status"], result["error"]) == (work_queue.FAILED, "lease expirado")
+
+
+def test_cancel_only_affects_pending_tasks(data_dir):
+    leased = work_queue.enqueue("a", "a.mp4", SETTINGS)
+    pending = work_queue.enqueue("b", "b.mp4", SETTINGS)
+    work_queue.claim("w1")
+
+    work_queue.cancel([leased, pending])
+    results = work_queue.get_results([leased, pending])
+    assert results[leased]["status"] == work_queue.LEASED
+    assert results[pending]["status"] == work_queue.CANCELLED
@@ -0,0 +1,133 @@
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Janela de contexto (tokens) de cada modelo em claude_analysis.CLAUDE_MODELS
+MODEL_CONTEXT_WINDOWS = {
+    "claude-sonnet-4-5-20250929": 200_000,
+    "claude-opus-4-6": 200_000,
+    "claude-haiku-4-5-20251001": 200_000,
+    "claude-3-haiku-20240307": 200_000,
+}
+DEFAULT_CONTEXT_WINDOW = 200_000
+
+# Limite de saída de cada modelo; a resposta cresce com o conteúdo enviado
+MODEL_MAX_OUTPUT_TOKENS = {
+    "claude-sonnet-4-5-20250929": 64_000,
+    "claude-opus-4-6": 32_000,
+    "claude-haiku-4-5-20251001": 64_000,
+    "claude-3-haiku-20240307": 4_096,
+}
+DEFAULT_MAX_OUTPUT_TOKENS = 4_096
+
+# Tamanho mínimo do prefixo para o cache de prompt valer; abaixo disso o
+# cache_control é ignorado pela API
+MODEL_MIN_CACHE_TOKENS = {
+    "claude-sonnet-4-5-20250929": 1_024,
+    "claude-opus-4-6": 4_096,
+    "claude-haiku-4-5-20251001": 4_096,
+    "claude-3-haiku-20240307": 2_048,
+}
+DEFAULT_MIN_CACHE_TOKENS = 1_024
+MIN_OUTPUT_TOKENS = 4000
+OUTPUT_TOKENS_PER_INPUT_TOKEN = 0.05
+# Instruções fixas do prompt (ANALYSIS_SYSTEM_PROMPT) + folga para o erro da estimativa
+PROMPT_RESERVE_TOKENS = 8000
+# Acima desta fração do orçamento, o conteúdo é contado pela API antes do envio
+EXACT_COUNT_RATIO = 0.8
+# Limite opcional para o conteúdo enviado (0 = a janela inteira do modelo)
+MAX_INPUT_TOKENS = int(os.getenv("ANALYSIS_MAX_INPUT_TOKENS", "0"))
+
+# Estimativa local: caracteres por token, recalibrada com a contagem da API.
+# Conservadora: datas, URLs e emojis das mensagens rendem poucos caracteres por token
+DEFAULT_CHARS_PER_TOKEN = 2.8
+CALIBRATION_INTERVAL_SECONDS = 3600
+MIN_CALIBRATION_CHARS = 2000
+
+_chars_per_token = {}
+_calibrated_at = {}
+_lock = threading.Lock()
+
+
+def input_budget(model):
+    window = MODEL_CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW)
+    budget = window - max_output_tokens(model) - PROMPT_RESERVE_TOKENS
+    if MAX_INPUT_TOKENS > 0:
+        budget = min(budget, MAX_INPUT_TOKENS)
+    return budget
+
+
+def max_output_tokens(model):
+    # Maior max_tokens que output_tokens pode pedir para um conteúdo que cabe na janela
+    window = MODEL_CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW)
+    limit = MODEL_MAX_OUTPUT_TOKENS.get(model, DEFAULT_MAX_OUTPUT_TOKENS)
+    return min(limit, max(MIN_OUTPUT_TOKENS, int(window * OUTPUT_TOKENS_PER_INPUT_TOKEN)))
+
+
+def output_tokens(model, text):
+    # Proporcional ao tamanho do conteúdo. Usa a razão fixa (não a calibrada)
+    # para que a mesma requisição tenha sempre o mesmo max_tokens
+    tokens = int(len(text) / DEFAULT_CHARS_PER_TOKEN * OUTPUT_TOKENS_PER_INPUT_TOKEN)
+    return min(max_output_tokens(model), max(MIN_OUTPUT_TOKENS, tokens))
+
+
+def prompt_cacheable(model, prefix):
+    return estimate_tokens(prefix) >= MODEL_MIN_CACHE_TOKENS.get(model, DEFAULT_MIN_CACHE_TOKENS)
+
+
+def near_budget(text, model):
+    return estimate_tokens(text, model) > input_budget(model) * EXACT_COUNT_RATIO
+
+
+def estimate_tokens(text, model=None):
+    with _lock:
+        ratio = _chars_per_token.get(model, DEFAULT_CHARS_PER_TOKEN)
+    return int(len(text) / ratio) + 1
+
+
+def truncate_to_tokens(text, tokens, model=None):
+    with _lock:
+        ratio = _chars_per_token.get(model, DEFAULT_CHARS_PER_TOKEN)
+    return text[: max(0, int((tokens - 1) * ratio))]
+
+
+def maybe_calibrate(client, model, text):
+    # No máximo uma chamada a count_tokens por modelo a cada
+    # CALIBRATION_INTERVAL_SECONDS; falhas só mantêm a estimativa atual
+    if len(text) < MIN_CALIBRATION_CHARS:
+        return
+    with _lock:
+        now = time.monotonic()
+        last = _calibrated_at.get(model)
+        if last is not None and now - last < CALIBRATION_INTERVAL_SECONDS:
+            return
+        _calibrated_at[model] = now
+
+    count_tokens(client, model, text)
+
+
+def count_tokens(client, model, text):
+    # Contagem exata pela API (gratuita); também recalibra a estimativa local.
+    # None se a contagem falhar
+    try:
+        counted = client.messages.count_tokens(
+            model=model, messages=[{"role": "user", "content": text}]
+        ).input_tokens
+    except Exception as e:
+        logger.info("Não foi possível contar os tokens de %s: %s", model, e)
+        return None
+    if counted <= 0:
+        return None
+
+    with _lock:
+        previous = _chars_per_token.get(model, DEFAULT_CHARS_PER_TOKEN)
+        # Média com a calibração anterior para suavizar variações entre textos
+        _chars_per_token[model] = (previous + len(text) / counted) / 2
+        logger.info(
+            "Tokens de %s: %.2f caracteres por token (%s tokens contados)",
+            model, _chars_per_token[model], counted,
+        )
+    return counted
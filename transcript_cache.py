@@ -0,0 +1,129 @@
+import os
+import time
+import threading
+
+import storage
+
+DB_NAME = "transcripts.db"
+MAX_CACHE_BYTES = int(os.getenv("TRANSCRIPT_CACHE_MAX_MB", "100")) * 1024 * 1024
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS transcripts (
+    key TEXT NOT NULL,
+    model TEXT NOT NULL,
+    language TEXT NOT NULL,
+    compute_type TEXT NOT NULL,
+    text TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL,
+    PRIMARY KEY (key, model, language, compute_type)
+);
+CREATE INDEX IF NOT EXISTS idx_transcripts_access ON transcripts (last_access);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+_lock = threading.Lock()
+
+
+def _conn():
+    return storage.connect(DB_NAME, _SCHEMA)
+
+
+def get(keys, model, language, compute_type):
+    # Retorna o texto da primeira chave encontrada ("" é um resultado válido:
+    # vídeo sem fala), ou None se nenhuma estiver no cache
+    with _lock:
+        conn = _conn()
+        for key in keys:
+            if not key:
+                continue
+            row = conn.execute(
+                "SELECT text FROM transcripts WHERE key = ? AND model = ? AND language = ? "
+                "AND compute_type = ?",
+                (key, model, language, compute_type),
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE transcripts SET last_access = ? WHERE key = ? AND model = ? "
+                    "AND language = ? AND compute_type = ?",
+                    (time.time(), key, model, language, compute_type),
+                )
+                conn.commit()
+                return row["text"]
+        return None
+
+
+def cached_keys(keys, model, language, compute_type):
+    # Quais chaves já têm transcrição com esta configuração (só leitura: não
+    # conta como acesso para o LRU)
+    keys = [k for k in keys if k]
+    if not keys:
+        return set()
+    with _lock:
+        rows = _conn().execute(
+            f"SELECT key FROM transcripts WHERE key IN ({','.join('?' * len(keys))}) "
+            "AND model = ? AND language = ? AND compute_type = ?",
+            (*keys, model, language, compute_type),
+        ).fetchall()
+    return {row["key"] for row in rows}
+
+
+def record(hit):
+    with _lock:
+        conn = _conn()
+        conn.execute(
+            "INSERT INTO stats (name, value) VALUES (?, 1) "
+            "ON CONFLICT (name) DO UPDATE SET value = value + 1",
+            ("hits" if hit else "misses",),
+        )
+        conn.commit()
+
+
+def put(keys, model, language, compute_type, text):
+    with _lock:
+        conn = _conn()
+        now = time.time()
+        conn.executemany(
+            "INSERT OR REPLACE INTO transcripts "
+            "(key, model, language, compute_type, text, size, last_access) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (key, model, language, compute_type, text, len(text.encode("utf-8")), now)
+                for key in keys
+                if key
+            ],
+        )
+        conn.commit()
+        _evict(conn)
+
+
+def stats():
+    with _lock:
+        conn = _conn()
+        counters = dict(conn.execute("SELECT name, value FROM stats").fetchall())
+        row = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM transcripts").fetchone()
+    return {
+        "hits": counters.get("hits", 0),
+        "misses": counters.get("misses", 0),
+        "entries": row[0],
+        "bytes": row[1],
+        "max_bytes": MAX_CACHE_BYTES,
+    }
+
+
+def _evict(conn):
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM transcripts").fetchone()[0]
+    if total <= MAX_CACHE_BYTES:
+        return
+    rows = conn.execute(
+        "SELECT rowid, size FROM transcripts ORDER BY last_access ASC"
+    ).fetchall()
+    for row in rows:
+        if total <= MAX_CACHE_BYTES:
+            break
+        conn.execute("DELETE FROM transcripts WHERE rowid = ?", (row["rowid"],))
+        total -= row["size"]
+    conn.commit()
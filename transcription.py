@@ -0,0 +1,480 @@
+import os
+import re
+import time
+import bisect
+import logging
+import threading
+import multiprocessing
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CPU_COUNT = os.cpu_count() or 2
+SAMPLE_RATE = 16000
+
+# Áudios longos são divididos em trechos (cortados em silêncios, com uma pequena
+# sobreposição) e transcritos em paralelo em processos separados
+LONG_AUDIO_SECONDS = 300
+CHUNK_SECONDS = 120
+CHUNK_OVERLAP_SECONDS = 1.5
+SILENCE_SEARCH_SECONDS = 10
+MAX_OVERLAP_WORDS = 12
+
+# Áudios curtos (notas de voz) são transcritos juntos: concatenados com um
+# silêncio entre eles, num único passe do modelo, e separados de volta pelos
+# tempos de cada palavra
+SHORT_AUDIO_SECONDS = 60
+BATCH_AUDIO_SECONDS = 120
+BATCH_GAP_SECONDS = 1.0
+
+# Configuração do faster-whisper. Por padrão os núcleos da máquina são divididos
+# entre num_workers transcrições simultâneas (cpu_threads = núcleos / workers).
+WHISPER_SETTINGS = {
+    "model_size": os.getenv("WHISPER_MODEL_SIZE", "base"),
+    "language": os.getenv("WHISPER_LANGUAGE", "pt"),
+    "compute_type": os.getenv("WHISPER_COMPUTE_TYPE", "int8"),
+    "beam_size": int(os.getenv("WHISPER_BEAM_SIZE", "5")),
+    "batch_size": int(os.getenv("WHISPER_BATCH_SIZE", "8")),
+    "vad_filter": os.getenv("WHISPER_VAD_FILTER", "1") != "0",
+    "num_workers": int(os.getenv("WHISPER_NUM_WORKERS", str(max(1, CPU_COUNT // 4)))),
+    "cpu_threads": int(os.getenv("WHISPER_CPU_THREADS", "0")),
+    # Cada processo de trechos carrega sua própria cópia do modelo
+    "chunk_workers": int(os.getenv("WHISPER_CHUNK_WORKERS", str(min(2, CPU_COUNT)))),
+    # Limites por vídeo (0 = sem limite): duração máxima de áudio considerada e
+    # tempo máximo de transcrição
+    "max_audio_seconds": int(os.getenv("WHISPER_MAX_AUDIO_SECONDS", "1800")),
+    "time_budget_seconds": int(os.getenv("WHISPER_TIME_BUDGET_SECONDS", "0")),
+}
+
+# Mudanças nestas opções exigem recarregar o modelo
+_MODEL_OPTIONS = ("model_size", "compute_type", "num_workers", "cpu_threads")
+
+_whisper_model = None
+_batched_pipeline = None
+_whisper_lock = threading.Lock()
+
+_stats = {"files": 0, "audio_seconds": 0.0, "processing_seconds": 0.0}
+_stats_lock = threading.Lock()
+
+
+def configure(**settings):
+    global _whisper_model, _batched_pipeline
+    changed = {k: v for k, v in settings.items() if v is not None and WHISPER_SETTINGS.get(k) != v}
+    if not changed:
+        return
+    with _whisper_lock:
+        WHISPER_SETTINGS.update(changed)
+        reload = any(k in _MODEL_OPTIONS for k in changed) and _whisper_model is not None
+        if reload:
+            _whisper_model = None
+            _batched_pipeline = None
+    # O modelo novo já começa a carregar, como na inicialização
+    if reload:
+        warm_up()
+
+
+def cpu_threads_per_worker():
+    if WHISPER_SETTINGS["cpu_threads"] > 0:
+        return WHISPER_SETTINGS["cpu_threads"]
+    return max(1, CPU_COUNT // max(1, WHISPER_SETTINGS["num_workers"]))
+
+
+def cache_settings():
+    # Parte da configuração que muda o texto gerado (chave do transcript_cache)
+    return (
+        WHISPER_SETTINGS["model_size"],
+        WHISPER_SETTINGS["language"],
+        WHISPER_SETTINGS["compute_type"],
+    )
+
+
+def _get_whisper_model():
+    global _whisper_model, _batched_pipeline
+    with _whisper_lock:
+        if _whisper_model is None:
+            from faster_whisper import WhisperModel
+            _whisper_model = WhisperModel(
+                WHISPER_SETTINGS["model_size"],
+                device="cpu",
+                compute_type=WHISPER_SETTINGS["compute_type"],
+                cpu_threads=cpu_threads_per_worker(),
+                num_workers=max(1, WHISPER_SETTINGS["num_workers"]),
+            )
+            _batched_pipeline = None
+            try:
+                from faster_whisper import BatchedInferencePipeline
+                _batched_pipeline = BatchedInferencePipeline(model=_whisper_model)
+            except ImportError:
+                logger.info("faster-whisper sem BatchedInferencePipeline; usando inferência simples")
+        return _whisper_model, _batched_pipeline
+
+
+def warm_up():
+    # Carrega o modelo em segundo plano (na inicialização do servidor), para
+    # a primeira transcrição não pagar o tempo de carga
+    def load():
+        try:
+            _get_whisper_model()
+            logger.info("Modelo Whisper %s carregado", WHISPER_SETTINGS["model_size"])
+        except Exception as e:
+            logger.warning("Erro ao pré-carregar o modelo Whisper: %s", e)
+
+    thread = threading.Thread(target=load, name="whisper-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+def max_concurrent_transcriptions():
+    # Quantas transcrições cabem nos núcleos ao mesmo tempo, somando todas as
+    # sessões e jobs do processo
+    return max(1, CPU_COUNT // cpu_threads_per_worker())
+
+
+class _Admission:
+    # Fila FIFO de transcrições: no máximo max_concurrent_transcriptions()
+    # rodam juntas; as demais esperam e recebem a posição na fila via on_wait
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._waiting = deque()
+        self._running = 0
+
+    def _can_start(self, ticket, weight):
+        limit = max_concurrent_transcriptions()
+        return self._waiting[0] is ticket and self._running + min(weight, limit) <= limit
+
+    @contextmanager
+    def slot(self, on_wait=None, weight=1):
+        # weight = quantas vagas a transcrição ocupa (a dividida em trechos usa
+        # todos os núcleos, então ocupa todas)
+        ticket = object()
+        with self._cond:
+            self._waiting.append(ticket)
+            last_position = None
+            try:
+                while not self._can_start(ticket, weight):
+                    position = self._waiting.index(ticket) + 1
+                    if on_wait and position != last_position:
+                        on_wait(position)
+                        last_position = position
+                    self._cond.wait(timeout=1)
+            except BaseException:
+                # Ex.: job cancelado pelo callback enquanto esperava
+                self._waiting.remove(ticket)
+                self._cond.notify_all()
+                raise
+            self._waiting.popleft()
+            weight = min(weight, max_concurrent_transcriptions())
+            self._running += weight
+            self._cond.notify_all()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._running -= weight
+                self._cond.notify_all()
+
+
+_admission = _Admission()
+
+
+def transcribe_audio(audio, on_wait=None):
+    # audio pode ser um caminho de arquivo ou um array float32 de 16 kHz mono;
+    # on_wait(posição) é chamado enquanto a transcrição espera na fila
+    if isinstance(audio, np.ndarray):
+        audio = _limit_duration(audio)
+    weight = max_concurrent_transcriptions() if _uses_chunks(audio) else 1
+    with _admission.slot(on_wait, weight):
+        return _transcribe(audio)
+
+
+def _uses_chunks(audio):
+    return (
+        isinstance(audio, np.ndarray)
+        and len(audio) > LONG_AUDIO_SECONDS * SAMPLE_RATE
+        and WHISPER_SETTINGS["chunk_workers"] > 1
+    )
+
+
+def _transcribe(audio):
+    start = time.monotonic()
+    budget = WHISPER_SETTINGS["time_budget_seconds"]
+    deadline = start + budget if budget > 0 else None
+    try:
+        if isinstance(audio, np.ndarray):
+            audio = _limit_duration(audio)
+            if _uses_chunks(audio):
+                text = _transcribe_chunked(audio, deadline)
+                if text is not None:
+                    _record_stats(len(audio) / SAMPLE_RATE, time.monotonic() - start)
+                    return text if text.strip() else ""
+                logger.warning("Transcrição em trechos indisponível; usando um passe só")
+
+        model, batched = _get_whisper_model()
+        text, duration = _run_model(model, batched, audio, WHISPER_SETTINGS, deadline)
+    except Exception as e:
+        label = audio if isinstance(audio, str) else "áudio em memória"
+        logger.warning("Erro ao transcrever %s: %s", label, e)
+        return None
+
+    _record_stats(duration, time.monotonic() - start)
+    return text if text.strip() else ""
+
+
+def _run_model(model, batched, audio, settings, deadline=None):
+    options = {
+        "language": settings["language"],
+        "beam_size": settings["beam_size"],
+        "vad_filter": settings["vad_filter"],
+    }
+    # O pipeline em lote depende do VAD para recortar os trechos com fala
+    if batched is not None and options["vad_filter"] and settings["batch_size"] > 1:
+        segments, info = batched.transcribe(audio, batch_size=settings["batch_size"], **options)
+    else:
+        segments, info = model.transcribe(audio, **options)
+
+    # Os segmentos são gerados sob demanda: parar de consumir interrompe a
+    # transcrição quando o orçamento de tempo do vídeo acaba
+    texts = []
+    for segment in segments:
+        texts.append(segment.text.strip())
+        if deadline and time.monotonic() > deadline:
+            logger.info("Orçamento de tempo esgotado; transcrição parcial")
+            texts.append("[...]")
+            break
+    return " ".join(texts), info.duration
+
+
+def transcribe_batch(clips, on_wait=None):
+    # Lista de arrays float32 de 16 kHz -> lista de textos, ou None em caso de erro
+    with _admission.slot(on_wait):
+        return _transcribe_batch(clips)
+
+
+def _transcribe_batch(clips):
+    start = time.monotonic()
+    gap = np.zeros(int(BATCH_GAP_SECONDS * SAMPLE_RATE), dtype=np.float32)
+    parts = []
+    starts = []
+    offset = 0
+    for clip in clips:
+        starts.append(offset / SAMPLE_RATE)
+        parts.extend([clip, gap])
+        offset += len(clip) + len(gap)
+
+    try:
+        model, _ = _get_whisper_model()
+        segments, info = model.transcribe(
+            np.concatenate(parts),
+            language=WHISPER_SETTINGS["language"],
+            beam_size=WHISPER_SETTINGS["beam_size"],
+            vad_filter=WHISPER_SETTINGS["vad_filter"],
+            word_timestamps=True,
+        )
+        words = [[] for _ in clips]
+        for segment in segments:
+            for word in segment.words or []:
+                # A palavra pertence ao último clipe que começa antes dela
+                index = max(bisect.bisect_right(starts, word.start) - 1, 0)
+                words[index].append(word.word)
+    except Exception as e:
+        logger.warning("Erro ao transcrever lote de %s áudios curtos: %s", len(clips), e)
+        return None
+
+    _record_stats(info.duration, time.monotonic() - start)
+    return ["".join(w).strip() for w in words]
+
+
+def _limit_duration(samples):
+    max_seconds = WHISPER_SETTINGS["max_audio_seconds"]
+    if max_seconds > 0 and len(samples) > max_seconds * SAMPLE_RATE:
+        logger.info(
+            "Áudio de %.0fs cortado para os primeiros %ss", len(samples) / SAMPLE_RATE, max_seconds
+        )
+        return samples[:max_seconds * SAMPLE_RATE]
+    return samples
+
+
+def split_on_silence(samples):
+    # Corta perto de cada múltiplo de CHUNK_SECONDS, no quadro de menor energia
+    # dentro de uma janela de busca, e estende cada trecho pela sobreposição
+    frame = int(0.03 * SAMPLE_RATE)
+    n_frames = len(samples) // frame
+    energy = np.sqrt(np.mean(samples[:n_frames * frame].reshape(n_frames, frame) ** 2, axis=1))
+
+    chunk = CHUNK_SECONDS * SAMPLE_RATE
+    search = SILENCE_SEARCH_SECONDS * SAMPLE_RATE
+    overlap = int(CHUNK_OVERLAP_SECONDS * SAMPLE_RATE)
+
+    cuts = [0]
+    while len(samples) - cuts[-1] > chunk * 1.5:
+        target = cuts[-1] + chunk
+        lo = max(cuts[-1] + frame, target - search) // frame
+        hi = min(n_frames, (target + search) // frame)
+        cut = (lo + int(np.argmin(energy[lo:hi]))) * frame if hi > lo else target
+        cuts.append(cut)
+    cuts.append(len(samples))
+
+    return [
+        samples[max(0, a - overlap):min(len(samples), b + overlap)]
+        for a, b in zip(cuts, cuts[1:])
+    ]
+
+
+def _transcribe_chunked(samples, deadline):
+    # Um processo do pool que morre (falta de memória, por exemplo) quebra o
+    # pool inteiro de vez: ele é recriado e os trechos são enviados de novo uma
+    # vez. None se falhar outra vez (quem chama transcreve num passe só).
+    for attempt in range(2):
+        pool = _get_chunk_pool()
+        try:
+            return _run_chunks(pool, samples, deadline)
+        except BrokenProcessPool as e:
+            logger.warning("Pool de transcrição em trechos quebrou (tentativa %s): %s", attempt + 1, e)
+            _discard_chunk_pool(pool)
+    return None
+
+
+def _run_chunks(pool, samples, deadline):
+    chunks = split_on_silence(samples)
+    settings = dict(WHISPER_SETTINGS)
+    # Os processos do pool não compartilham o relógio monotônico: o prazo vai
+    # em horário de parede
+    wall_deadline = time.time() + (deadline - time.monotonic()) if deadline else None
+    futures = [
+        pool.submit(_transcribe_chunk, chunk, settings, wall_deadline) for chunk in chunks
+    ]
+
+    timeout = max(0, deadline - time.monotonic()) if deadline else None
+    done, not_done = wait(futures, timeout=timeout)
+    if not_done:
+        # Os que não começaram são cancelados; os que estão rodando param no
+        # próximo segmento (o prazo é conferido dentro do worker) e entregam
+        # o texto parcial. Esperar por eles libera os núcleos antes de a
+        # próxima transcrição entrar.
+        for future in not_done:
+            future.cancel()
+        done, _ = wait(futures)
+        logger.info("Orçamento de tempo esgotado na transcrição em trechos")
+
+    finished = [f for f in futures if f in done and not f.cancelled()]
+    if any(isinstance(f.exception(), BrokenProcessPool) for f in finished):
+        raise BrokenProcessPool("um processo do pool terminou durante a transcrição")
+
+    texts = []
+    for future in futures:
+        if future in finished and future.exception() is None:
+            texts.append(future.result())
+        else:
+            texts.append(None)
+    return _stitch(texts)
+
+
+def _stitch(texts):
+    # Junta os trechos em ordem, removendo as palavras repetidas por causa da
+    # sobreposição; trechos que faltaram viram "[...]"
+    words = []
+    previous_ok = False
+    for text in texts:
+        if text is None:
+            if not words or words[-1] != "[...]":
+                words.append("[...]")
+            previous_ok = False
+            continue
+        new_words = text.split()
+        if previous_ok:
+            new_words = new_words[_overlap_length(words, new_words):]
+        words.extend(new_words)
+        previous_ok = True
+    return " ".join(words)
+
+
+def _overlap_length(words, new_words):
+    def norm(w):
+        return re.sub(r"[^\w]", "", w.lower())
+
+    for k in range(min(MAX_OVERLAP_WORDS, len(words), len(new_words)), 0, -1):
+        if [norm(w) for w in words[-k:]] == [norm(w) for w in new_words[:k]]:
+            return k
+    return 0
+
+
+_chunk_pool = None
+_chunk_pool_key = None
+_chunk_pool_lock = threading.Lock()
+
+
+def _get_chunk_pool():
+    # Processos "spawn" para não herdar threads do Streamlit; o pool é recriado
+    # se a configuração do modelo mudar
+    global _chunk_pool, _chunk_pool_key
+    workers = max(1, WHISPER_SETTINGS["chunk_workers"])
+    key = (workers,) + tuple(WHISPER_SETTINGS[k] for k in ("model_size", "compute_type"))
+    with _chunk_pool_lock:
+        if _chunk_pool is None or _chunk_pool_key != key:
+            if _chunk_pool is not None:
+                _chunk_pool.shutdown(wait=False, cancel_futures=True)
+            _chunk_pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            _chunk_pool_key = key
+        return _chunk_pool
+
+
+def _discard_chunk_pool(pool):
+    # Só descarta se ninguém já tiver trocado o pool
+    global _chunk_pool
+    with _chunk_pool_lock:
+        if _chunk_pool is pool:
+            _chunk_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+_worker_model = None
+
+
+def _transcribe_chunk(samples, settings, wall_deadline=None):
+    # Roda dentro de um processo do pool; cada processo carrega seu modelo uma vez
+    global _worker_model
+    deadline = None
+    if wall_deadline:
+        remaining = wall_deadline - time.time()
+        if remaining <= 0:
+            return None
+        deadline = time.monotonic() + remaining
+    if _worker_model is None:
+        from faster_whisper import WhisperModel
+        _worker_model = WhisperModel(
+            settings["model_size"],
+            device="cpu",
+            compute_type=settings["compute_type"],
+            cpu_threads=max(1, CPU_COUNT // max(1, settings["chunk_workers"])),
+        )
+    text, duration = _run_model(_worker_model, None, samples, settings, deadline)
+    return text
+
+
+def get_transcription_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["rtf"] = (
+        stats["processing_seconds"] / stats["audio_seconds"] if stats["audio_seconds"] else None
+    )
+    return stats
+
+
+def _record_stats(audio_seconds, processing_seconds):
+    with _stats_lock:
+        _stats["files"] += 1
+        _stats["audio_seconds"] += audio_seconds
+        _stats["processing_seconds"] += processing_seconds
+    if audio_seconds:
+        logger.info(
+            "Transcrição: %.1fs de áudio em %.1fs (RTF %.2f)",
+            audio_seconds, processing_seconds, processing_seconds / audio_seconds,
+        )
@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import uuid
+import threading
+
+import storage
+
+DB_NAME = "work_queue.db"
+LEASE_SECONDS = int(os.getenv("WORK_QUEUE_LEASE_SECONDS", "120"))
+MAX_ATTEMPTS = int(os.getenv("WORK_QUEUE_MAX_ATTEMPTS", "3"))
+# Tarefas terminadas ficam disponíveis para leitura por um dia
+KEEP_FINISHED_SECONDS = 24 * 3600
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id TEXT PRIMARY KEY,
+    key TEXT NOT NULL,
+    path TEXT NOT NULL,
+    settings TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_token TEXT,
+    lease_expires REAL,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (status, created_at);
+CREATE INDEX IF NOT EXISTS idx_tasks_key ON tasks (key, settings);
+"""
+
+_lock = threading.Lock()
+
+
+def _conn():
+    # Workers em outras máquinas abrem o mesmo arquivo por um diretório
+    # compartilhado, onde o WAL não funciona: usa o journal tradicional
+    return storage.connect(DB_NAME, _SCHEMA, journal_mode="DELETE")
+
+
+def _stored_path(path):
+    # Arquivos dentro de ANALYZER_DATA_DIR são gravados relativos a ele, para
+    # que cada worker os encontre no seu próprio ponto de montagem
+    root = os.path.abspath(storage.DATA_DIR)
+    path = os.path.abspath(path)
+    if os.path.commonpath([root, path]) == root:
+        return os.path.relpath(path, root)
+    return path
+
+
+def _local_path(path):
+    return os.path.join(storage.DATA_DIR, path)
+
+
+def enqueue(key, path, settings):
+    # Mesma chave e mesma configuração já na fila (outra sessão): reaproveita a tarefa
+    settings = json.dumps(settings, sort_keys=True)
+    path = _stored_path(path)
+    now = time.time()
+    with _lock:
+        conn = _conn()
+        conn.execute(
+            f"DELETE FROM tasks WHERE status IN ({','.join('?' * len(FINISHED))}) AND updated_at < ?",
+            (*FINISHED, now - KEEP_FINISHED_SECONDS),
+        )
+        row = conn.execute(
+            "SELECT id FROM tasks WHERE key = ? AND settings = ? AND status IN (?, ?)",
+            (key, settings, PENDING, LEASED),
+        ).fetchone()
+        if row is not None:
+            conn.commit()
+            return row["id"]
+        task_id = uuid.uuid4().hex
+        conn.execute(
+            "INSERT INTO tasks (id, key, path, settings, status, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (task_id, key, path, settings, PENDING, now, now),
+        )
+        conn.commit()
+    return task_id
+
+
+def claim(worker_id):
+    # Um único UPDATE escolhe e aluga a tarefa: é atômico mesmo com vários
+    # processos/máquinas usando o mesmo arquivo. Tarefas com lease vencido
+    # (worker caiu) voltam a ser distribuídas até MAX_ATTEMPTS tentativas.
+    now = time.time()
+    token = uuid.uuid4().hex
+    with _lock:
+        conn = _conn()
+        conn.execute(
+            "UPDATE tasks SET status = ?, error = ?, updated_at = ? "
+            "WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+            (FAILED, "lease expirado", now, LEASED, now, MAX_ATTEMPTS),
+        )
+        conn.execute(
+            "UPDATE tasks SET status = ?, lease_owner = ?, lease_token = ?, lease_expires = ?, "
+            "attempts = attempts + 1, updated_at = ? "
+            "WHERE id = (SELECT id FROM tasks "
+            "WHERE status = ? OR (status = ? AND lease_expires < ?) "
+            "ORDER BY created_at LIMIT 1)",
+            (LEASED, worker_id, token, now + LEASE_SECONDS, now, PENDING, LEASED, now),
+        )
+        conn.commit()
+        row = conn.execute(
+            "SELECT id, key, path, settings, attempts FROM tasks WHERE lease_token = ?", (token,)
+        ).fetchone()
+    if row is None:
+        return None
+    task = dict(row)
+    task["settings"] = json.loads(task["settings"])
+    task["path"] = _local_path(task["path"])
+    task["token"] = token
+    return task
+
+
+def renew(task):
+    # Heartbeat do worker; False se o lease já foi perdido
+    return _update_leased(task, lease_expires=time.time() + LEASE_SECONDS)
+
+
+def complete(task, text):
+    return _update_leased(task, status=DONE, result=text, lease_token=None)
+
+
+def fail(task, error):
+    # Volta para a fila enquanto houver tentativas
+    status = FAILED if task["attempts"] >= MAX_ATTEMPTS else PENDING
+    return _update_leased(task, status=status, error=str(error)[:500], lease_token=None)
+
+
+def cancel(task_ids):
+    with _lock:
+        conn = _conn()
+        conn.executemany(
+            "UPDATE tasks SET status = ?, updated_at = ? WHERE id = ? AND status = ?",
+            [(CANCELLED, time.time(), task_id, PENDING) for task_id in task_ids],
+        )
+        conn.commit()
+
+
+def get_results(task_ids):
+    # {id: {"status", "result", "error"}}
+    task_ids = list(task_ids)
+    if not task_ids:
+        return {}
+    with _lock:
+        rows = _conn().execute(
+            f"SELECT id, status, result, error FROM tasks WHERE id IN ({','.join('?' * len(task_ids))})",
+            task_ids,
+        ).fetchall()
+    return {row["id"]: dict(row) for row in rows}
+
+
+def pending_count():
+    with _lock:
+        return _conn().execute(
+            "SELECT COUNT(*) FROM tasks WHERE status = ?", (PENDING,)
+        ).fetchone()[0]
+
+
+def _update_leased(task, **fields):
+    fields["updated_at"] = time.time()
+    with _lock:
+        conn = _conn()
+        cursor = conn.execute(
+            f"UPDATE tasks SET {', '.join(f'{k} = ?' for k in fields)} "
+            "WHERE id = ? AND lease_token = ? AND status = ?",
+            (*fields.values(), task["id"], task["token"], LEASED),
+        )
+        conn.commit()
+    return cursor.rowcount == 1
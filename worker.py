@@ -0,0 +1,95 @@
+import os
+import time
+import socket
+import logging
+import argparse
+import threading
+
+import work_queue
+from media_processing import decode_audio
+from transcription import configure, max_concurrent_transcriptions, transcribe_audio, warm_up
+
+logger = logging.getLogger("worker")
+
+POLL_SECONDS = 2
+
+
+def run_task(task):
+    # A configuração do modelo vem da tarefa: o texto precisa bater com a
+    # chave de cache usada pelo app
+    configure(**task["settings"])
+    if not os.path.exists(task["path"]):
+        raise RuntimeError(f"Arquivo não encontrado: {task['path']}")
+    samples = decode_audio(task["path"])
+    if samples is None or not len(samples):
+        raise RuntimeError(f"Não foi possível decodificar o áudio de {task['path']}")
+    text = transcribe_audio(samples)
+    if text is None:
+        raise RuntimeError("Erro na transcrição")
+    return text
+
+
+def work(worker_id, once=False):
+    while True:
+        task = work_queue.claim(worker_id)
+        if task is None:
+            if once:
+                return
+            time.sleep(POLL_SECONDS)
+            continue
+
+        logger.info("Tarefa %s (tentativa %s): %s", task["id"], task["attempts"], task["path"])
+        stop = threading.Event()
+        threading.Thread(target=_heartbeat, args=(task, stop), daemon=True).start()
+        try:
+            text = run_task(task)
+        except Exception as e:
+            logger.warning("Tarefa %s falhou: %s", task["id"], e)
+            work_queue.fail(task, e)
+        else:
+            if not work_queue.complete(task, text):
+                logger.warning("Lease da tarefa %s perdido; resultado descartado", task["id"])
+        finally:
+            stop.set()
+
+
+def _heartbeat(task, stop):
+    # Renova o lease enquanto a transcrição roda; se o processo cair, o lease
+    # vence e outro worker pega a tarefa
+    while not stop.wait(work_queue.LEASE_SECONDS / 3):
+        if not work_queue.renew(task):
+            return
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Worker de transcrição: consome a fila em ANALYZER_DATA_DIR/work_queue.db"
+    )
+    parser.add_argument("--id", default=f"{socket.gethostname()}-{os.getpid()}")
+    parser.add_argument(
+        "--concurrency", type=int, default=0,
+        help="Transcrições simultâneas (0 = de acordo com os núcleos)",
+    )
+    parser.add_argument("--once", action="store_true", help="Sai quando a fila esvaziar")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+    warm_up()
+
+    concurrency = args.concurrency or max_concurrent_transcriptions()
+    threads = [
+        threading.Thread(target=work, args=(f"{args.id}-{i}", args.once), daemon=True)
+        for i in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    logger.info("Worker %s com %s transcrições simultâneas", args.id, concurrency)
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        logger.info("Encerrando")
+
+
+if __name__ == "__main__":
+    main()